@@ -1,107 +1,1715 @@
-import os, sklearn, collections
-from sklearn.metrics.pairwise import pairwise_distances
-from sklearn.externals import joblib
-from utils import io_handler
+import os, sklearn, collections, json, functools, threading, contextlib, copy
+try:
+  from sklearn.externals import joblib
+except ImportError: # scikit-learn >= 0.23 no longer vendors joblib
+  import joblib
 import pandas as pd
 import numpy as np
-from data_postp import similarity_computations
+from core.indexes import IVFIndex, HNSWIndex, QuantizedIndex, CascadeIndex, BinaryCodeIndex, ClassRoutingIndex, \
+  BlockBoundIndex, normalize_rows, top_k_indices
+from core.quantization import CODECS
+from core.query_cache import QueryCache
+from core.metadata_index import MetadataIndex
+from core.episode_store import EpisodeStore, GrowableArray
+from core.reembedding import ReembeddingJob
+from core.online_classifier import ONLINE_CLASSIFIERS
+from utils.file_manifest import FileManifest
+
+Episode = collections.namedtuple('Episode', ['id', 'hidden_repr', 'metadata', 'video_episode'])
+
+# float32 matrices of a memory bundle, each stored as <name>.npy
+BUNDLE_MATRICES = ['hidden_reps', 'hidden_reps_normed', 'hidden_reps_transformed', 'hidden_reps_transformed_normed']
+
+# immutable version of a memory that readers pin for the duration of a query: views on the first n_episodes rows of the
+# matrices and of the id / label / video path columns and the PCA / indexes / metadata index that belong to them
+MemoryVersion = collections.namedtuple('MemoryVersion', ['number', 'n_episodes', 'matrices', 'columns',
+                                                         'inter_class_pca', 'indexes', 'default_backend', 'classifier',
+                                                         'metadata_index'])
+
+EVICTION_POLICIES = ('lru', 'reservoir', 'redundancy')
+
+class LazyVideoEpisode:
+
+  def __init__(self, video_path, load=None):
+    ''' frames of a stored episode, the video file is only decoded when the frames are accessed the first time
+    :param video_path: absolute path of the video file, None for latent-only episodes
+    :param load: (optional) callable that returns the frames instead of the video file, e.g. a read from a FrameStore
+                 or a reconstruction by the decoder of the memory
+    '''
+    self.video_path = video_path
+    self.load = load
+    self._frames = None
+
+  @property
+  def frames(self):
+    if self._frames is None:
+      if self.load is not None:
+        self._frames = self.load()
+      else:
+        assert self.video_path is not None, 'latent-only episode, attach a decoder to the memory to recall its frames'
+        from utils import io_handler # video decoding (moviepy / tensorflow) is only imported when it is needed
+        self._frames = io_handler.load_video_frames(self.video_path)
+    return self._frames
 
 
 class Memory:
 
-  def __init__(self, memory_df, base_dir, label_col="category", video_path_col="video_file_path", inter_class_pca_path=None):
+  def __init__(self, memory_df, base_dir, label_col="category", video_path_col="video_file_path", inter_class_pca_path=None,
+               check_sanity=True):
     ''' Initializes the Memory class
     :param memory_df: pandas dataframe that contains the hidden_reps, labels and video_paths of the episodes
     :param label_col: specifies the label column name within the df
-    :param video_path_col: specifies the video path column name within the df
+    :param video_path_col: specifies the video path column name within the df, the memory is latent-only if the df has no
+                           such column (frames are then only available through a decoder, see attach_decoder)
     :param inter_class_pca_path: specifies the path to the model object of a previously trained PCA
+    :param check_sanity: if True, checks in a background thread whether the video files of all episodes exist
     '''
     assert label_col in memory_df.columns, str(label_col) + ' must be a dataframe category'
     assert isinstance(memory_df, pd.DataFrame)
 
-    self.memory_df = memory_df
-    self.hidden_reps = np.stack([h.flatten() for h in memory_df['hidden_repr']])
-    self.labels = memory_df[["id", label_col]]
-    self.labels.set_index('id')
-    self.video_paths = memory_df[["id", video_path_col]]
-    self.video_paths.set_index('id')
-    self.base_dir = base_dir
-
+    hidden_reps = np.stack([h.flatten() for h in memory_df['hidden_repr']])
+    self._set_metadata(memory_df, base_dir, label_col, video_path_col)
 
     #get fitted PCA object
     if inter_class_pca_path:
       assert os.path.isfile(inter_class_pca_path)
       self.inter_class_pca = joblib.load(inter_class_pca_path)
     else:
-      self.inter_class_pca = fit_inter_class_pca(self.hidden_reps, self.labels, n_components=50, verbose=False)
+      self.inter_class_pca = fit_inter_class_pca(hidden_reps, memory_df[label_col], n_components=50, verbose=False)
 
     # PCA transform the hidden_reps
-    self.hidden_reps_transformed = self.inter_class_pca.transform(self.hidden_reps)
+    self._set_matrices(hidden_reps, self.inter_class_pca.transform(hidden_reps))
+    self._init_state()
+    self._load_aliases(memory_df)
+    self._load_model_fingerprint(memory_df)
+
+    if check_sanity:
+      self.check_memory_sanity()
+
+  def _set_metadata(self, memory_df, base_dir, label_col, video_path_col):
+    # the dataframe is only concatenated with the metadata of stored episodes when memory_df is accessed
+    if video_path_col not in memory_df.columns:
+      memory_df = memory_df.assign(**{video_path_col: None})
+    self._metadata_frames = [memory_df]
+    self._ids = GrowableArray(np.asarray(memory_df['id'].values, dtype=object))
+    self._label_values = GrowableArray(np.asarray(memory_df[label_col].values, dtype=object))
+    self._video_path_values = GrowableArray(np.asarray(memory_df[video_path_col].values, dtype=object))
+    self._id_to_row = None
+    self.label_col = label_col
+    self.video_path_col = video_path_col
+    self.base_dir = base_dir
+
+  def _set_matrices(self, hidden_reps, hidden_reps_transformed, hidden_reps_normed=None, hidden_reps_transformed_normed=None):
+    # unit length float32 copies of the memory, cosine similarity then reduces to a single matrix product
+    if hidden_reps_normed is None:
+      hidden_reps_normed = normalize_rows(hidden_reps)
+    if hidden_reps_transformed_normed is None:
+      hidden_reps_transformed_normed = normalize_rows(hidden_reps_transformed)
+    self._matrices = {'hidden_reps': GrowableArray(hidden_reps),
+                      'hidden_reps_transformed': GrowableArray(hidden_reps_transformed),
+                      'hidden_reps_normed': GrowableArray(hidden_reps_normed),
+                      'hidden_reps_transformed_normed': GrowableArray(hidden_reps_transformed_normed)}
+
+  def _init_state(self):
+    # approximate search indexes keyed by (backend, use_transform), the exact scan is used if none is available
+    self.indexes = {}
+    self.index_builders = {}
+    self.default_backend = 'exact'
+    self.episode_store = None
+
+    # concurrency: writers are serialized by write_lock and build the next version copy-on-write (the matrices are
+    # append-only, indexes are copied before episodes are added). The version is published atomically when the
+    # outermost write finishes, readers pin self.version and never block
+    self.write_lock = threading.RLock()
+    self._write_depth = 0
+    self.version = None
+
+    # incremental inter class PCA (disabled by default, set pca_update_threshold e.g. to 0.05 to enable it): running
+    # per-class sums / counts (computed on the first store), the PCA is refitted on the class means and replaces the
+    # current one (also one loaded from inter_class_pca_path) if the basis changed by more than pca_update_threshold.
+    # The existing rows are then re-projected in batches into new matrices, the new PCA and matrices are published
+    # together once all rows are re-projected
+    self.pca_update_threshold = None
+    self.pca_refit_interval = 1000
+    self.reproject_batch_size = 10000
+    self.class_sums = None
+    self.class_counts = None
+    self._episodes_since_pca_fit = 0
+    self._pending_projection = None
+
+    self.sanity_check = None
+    self.missing_episode_ids = []
+
+    # matching results of recent queries, cleared whenever the memory or its indexes change (None disables caching)
+    self.query_cache = QueryCache(max_size=1024)
+
+    # inverted indexes over the metadata columns used in filters. Filters that select less than filter_exact_fraction
+    # of the memory are answered by an exact scan of the selected rows instead of the (filtered) index backend
+    self.metadata_index = MetadataIndex()
+    self.filter_exact_fraction = 0.05
+
+    # capacity bound (see set_capacity): once a store exceeds capacity episodes or capacity_bytes, episodes are evicted
+    # by eviction_policy. Recalls (returned matches, get_episode) are tracked per row with a logical clock
+    self.capacity = None
+    self.capacity_bytes = None
+    self.eviction_policy = 'lru'
+    self.eviction_slack = 0.05
+    self._eviction_random_state = np.random.RandomState()
+    self._recall_clock = 0
+    self._last_recall = GrowableArray(np.zeros(self._ids.size, dtype=np.int64))
+    self._recall_counts = GrowableArray(np.zeros(self._ids.size, dtype=np.int64))
+    self._renumbered_version = 0
+    self.eviction_counters = collections.Counter(evicted=0, eviction_runs=0, evicted_never_recalled=0, recalls=0)
+
+    # near-duplicate consolidation: stored episodes whose cosine similarity to an episode of the memory (of the same
+    # class) is at least consolidation_threshold are not stored but become aliases of that representative
+    # (None disables the consolidation at insert time, see also consolidate)
+    self.consolidation_threshold = None
+    self.consolidation_candidates = 4
+    self.aliases = {} # representative id -> list of alias ids
+    self.alias_of = {} # alias id -> representative id
+
+    # decoder that regenerates the frames of episodes from their hidden_reps (see attach_decoder), decoded clips are
+    # kept in an LRU cache keyed by (id, kind)
+    self.decoder = None
+    self.decode_batch_size = 32
+    self.clip_cache = None
+
+    # frames of the episodes in a FrameStore keyed by episode id (see attach_frame_store), used instead of the videos
+    self.frame_store = None
+
+    # fingerprint of the checkpoint that embedded the episodes (see utils.helpers.checkpoint_fingerprint), stored per
+    # episode in the 'model_fingerprint' metadata column. After retraining, a ReembeddingJob re-encodes the episodes
+    # with the new checkpoint in the background and swaps the new embeddings in (see start_reembedding)
+    self.model_fingerprint = None
+    self.reembedding_job = None
+
+    # online classifier of the episode labels for composite matching (see enable_online_classifier), updated with every
+    # store / eviction in O(batch) instead of being retrained. Updates are applied to a shallow copy, the published
+    # versions keep answering with the classifier they were published with
+    self.classifier = None
+    self.classifier_builder = None
+    self._publish()
+
+  def _load_aliases(self, memory_df):
+    ''' reads the aliases of consolidated episodes from the 'aliases' column (see consolidate_memory_pickle) '''
+    if 'aliases' not in memory_df.columns:
+      return
+    for id, aliases in zip(memory_df['id'], memory_df['aliases']):
+      if isinstance(aliases, (list, tuple, np.ndarray)) and len(aliases) > 0:
+        self._add_aliases(id, list(aliases))
+
+  def _load_model_fingerprint(self, memory_df):
+    ''' the memory is in the vector space of the checkpoint that embedded most of its episodes '''
+    if 'model_fingerprint' not in memory_df.columns:
+      return
+    fingerprints = memory_df['model_fingerprint'].dropna()
+    if len(fingerprints) > 0:
+      counts = fingerprints.value_counts()
+      self.model_fingerprint = counts.index[0]
+      if len(counts) > 1 or len(fingerprints) < len(memory_df):
+        print('Memory contains %i episodes that were not embedded by %s, see stale_ids' % (
+          len(memory_df) - counts.iloc[0], self.model_fingerprint))
+
+  def _add_aliases(self, representative_id, alias_ids):
+    '''
+    :return: ids of the representatives whose aliases changed
+    '''
+    changed = [representative_id]
+    for alias_id in alias_ids:
+      # aliases of an alias are moved to the representative
+      if alias_id in self.aliases:
+        changed.append(alias_id)
+        alias_ids = alias_ids + self.aliases.pop(alias_id)
+    self.aliases.setdefault(representative_id, []).extend(alias_ids)
+    self.alias_of.update((alias_id, representative_id) for alias_id in alias_ids)
+    return changed
+
+  def _persist_aliases(self, representative_ids):
+    ''' writes the current aliases of the representatives to the attached episode store, so that from_store restores them '''
+    if self.episode_store is not None and len(representative_ids) > 0:
+      self.episode_store.write_aliases(dict((id, self.aliases.get(id, [])) for id in representative_ids))
+
+  def _publish(self):
+    ''' publishes the current state as new immutable version, readers that pinned an older version keep using it '''
+    self.version = self._working_version(self.version.number + 1 if self.version is not None else 0)
 
-    self.check_memory_sanity()
+  def _working_version(self, number=None):
+    ''' the current state as MemoryVersion, including a write in progress. Writers search it without publishing it '''
+    return MemoryVersion(number=number, n_episodes=self._ids.size,
+                         matrices=dict((name, matrix.array) for name, matrix in self._matrices.items()),
+                         columns={'ids': self._ids.array, 'labels': self._label_values.array,
+                                  'video_paths': self._video_path_values.array},
+                         inter_class_pca=self.inter_class_pca, indexes=dict(self.indexes),
+                         default_backend=self.default_backend, classifier=self.classifier,
+                         metadata_index=self.metadata_index)
+
+  @contextlib.contextmanager
+  def _writing(self):
+    ''' serializes writers, the state is published as new version when the outermost write finishes '''
+    with self.write_lock:
+      self._write_depth += 1
+      try:
+        yield
+      finally:
+        self._write_depth -= 1
+        if self._write_depth == 0:
+          self._publish()
+
+  @property
+  def hidden_reps(self):
+    return self.version.matrices['hidden_reps']
+
+  @property
+  def hidden_reps_transformed(self):
+    return self.version.matrices['hidden_reps_transformed']
+
+  @property
+  def hidden_reps_normed(self):
+    return self.version.matrices['hidden_reps_normed']
+
+  @property
+  def hidden_reps_transformed_normed(self):
+    return self.version.matrices['hidden_reps_transformed_normed']
+
+  def _live_matrix(self, name):
+    ''' matrix including the episodes of a write in progress, only for writers '''
+    return self._matrices[name].array
+
+  @property
+  def memory_df(self):
+    if len(self._metadata_frames) > 1:
+      with self.write_lock:
+        self._metadata_frames = [pd.concat(self._metadata_frames, ignore_index=True)]
+    return self._metadata_frames[0]
+
+  @property
+  def id_to_row(self):
+    ''' hash index from episode id to memory row, built on first use and kept up to date by store_episodes '''
+    if self._id_to_row is None:
+      with self.write_lock:
+        if self._id_to_row is None:
+          self._id_to_row = dict(zip(self._ids.array, range(self._ids.size)))
+    return self._id_to_row
+
+  @property
+  def labels(self):
+    return self.memory_df[["id", self.label_col]]
+
+  @property
+  def video_paths(self):
+    return self.memory_df[["id", self.video_path_col]]
+
+  @classmethod
+  def load(cls, bundle_dir, base_dir=None, mmap_mode='r', check_sanity=False):
+    '''
+    loads a memory from a bundle directory (see dump_bundle / write_memory_bundle). The matrices are memory mapped
+    and the PCA is not refitted, so loading takes about the same time regardless of the memory size
+    :param bundle_dir: path to the bundle directory
+    :param base_dir: (optional) base directory of the episode videos, defaults to the one stored in the bundle
+    :param mmap_mode: mmap_mode for np.load, None loads the matrices into RAM
+    :param check_sanity: if True, checks whether the video files of all episodes exist
+    :return: Memory object, its memory_df contains the metadata of the episodes but no hidden_repr column
+    '''
+    with open(os.path.join(bundle_dir, 'bundle.json'), 'r') as f:
+      bundle_info = json.load(f)
+
+    memory = cls.__new__(cls)
+    memory._set_matrices(**dict([(name, np.load(os.path.join(bundle_dir, name + '.npy'), mmap_mode=mmap_mode))
+                                 for name in BUNDLE_MATRICES]))
+    memory._set_metadata(pd.read_pickle(os.path.join(bundle_dir, 'metadata.pickle')),
+                         base_dir if base_dir is not None else bundle_info['base_dir'],
+                         bundle_info['label_col'], bundle_info['video_path_col'])
+    memory.inter_class_pca = joblib.load(os.path.join(bundle_dir, 'inter_class_pca.pickle'))
+
+    memory._init_state()
+    memory._load_aliases(memory.memory_df)
+    memory._load_model_fingerprint(memory.memory_df)
+    if os.path.isfile(os.path.join(bundle_dir, 'indexes.pickle')):
+      with memory._writing():
+        memory.indexes = joblib.load(os.path.join(bundle_dir, 'indexes.pickle'))
+        memory.default_backend = bundle_info['default_backend']
+    if os.path.isfile(os.path.join(bundle_dir, 'classifier.pickle')):
+      with memory._writing():
+        memory.classifier = joblib.load(os.path.join(bundle_dir, 'classifier.pickle'))
+        if bundle_info.get('classifier_kwargs') is not None:
+          memory.classifier_builder = functools.partial(memory.enable_online_classifier, **bundle_info['classifier_kwargs'])
+
+    assert memory.hidden_reps.shape[0] == memory._ids.size == bundle_info['n_episodes']
+    if check_sanity:
+      memory.check_memory_sanity()
+    return memory
+
+  def dump_bundle(self, bundle_dir):
+    '''
+    dumps the memory as bundle directory that can be loaded with Memory.load. The bundle contains the float32
+    matrices as .npy files, the fitted inter class PCA, the built indexes, the online classifier and the metadata of the episodes
+    (memory_df without the hidden_repr column)
+    :param bundle_dir: path to the bundle directory, created if it does not exist
+    '''
+    self.reproject()
+    if not os.path.isdir(bundle_dir):
+      os.makedirs(bundle_dir)
+    with self.write_lock:
+      version, memory_df = self.version, self.memory_df
+    for name in BUNDLE_MATRICES:
+      np.save(os.path.join(bundle_dir, name + '.npy'), np.ascontiguousarray(version.matrices[name], dtype=np.float32))
+    joblib.dump(version.inter_class_pca, os.path.join(bundle_dir, 'inter_class_pca.pickle'))
+    if version.indexes:
+      joblib.dump(version.indexes, os.path.join(bundle_dir, 'indexes.pickle'))
+    if version.classifier is not None:
+      joblib.dump(version.classifier, os.path.join(bundle_dir, 'classifier.pickle'))
+    metadata_df = memory_df.drop('hidden_repr', axis=1) if 'hidden_repr' in memory_df.columns else memory_df.copy()
+    if self.aliases:
+      metadata_df['aliases'] = [list(self.aliases.get(id, [])) for id in version.columns['ids']]
+    metadata_df.to_pickle(os.path.join(bundle_dir, 'metadata.pickle'))
+
+    bundle_info = {'label_col': self.label_col, 'video_path_col': self.video_path_col, 'base_dir': self.base_dir,
+                   'n_episodes': int(version.n_episodes), 'default_backend': version.default_backend,
+                   'classifier_kwargs': self.classifier_builder.keywords if self.classifier_builder is not None else None}
+    with open(os.path.join(bundle_dir, 'bundle.json'), 'w') as f:
+      json.dump(bundle_info, f)
+    print("Dumped memory bundle to", bundle_dir)
+
+  def check_memory_sanity(self, block=False, manifest_cache_path=None, n_threads=16):
+    '''
+    checks whether the video files of all episodes exist. The lookups go through a FileManifest cache of base_dir, so
+    only directories that changed since the last check are listed again, in parallel. Ids of episodes without video
+    file are appended to missing_episode_ids as soon as their directory is validated
+    :param block: if False, the check runs in a background thread and the method returns immediately
+    :param manifest_cache_path: (optional) path of the manifest cache, see FileManifest
+    :param n_threads: number of threads that stat the directories
+    :return: the background thread if block is False, else the number of episodes whose video file exists
+    '''
+    video_paths = self._video_path_values.array
+    episode_ids = self._ids.array
+    self.missing_episode_ids = []
+
+    def check():
+      rows_by_path = collections.defaultdict(list)
+      for row, v_path in enumerate(video_paths):
+        if v_path is not None: # latent-only episode
+          rows_by_path[v_path].append(row)
+      manifest = FileManifest(self.base_dir, cache_path=manifest_cache_path, n_threads=n_threads)
+      missing_paths = manifest.validate(rows_by_path.keys(), on_missing=lambda paths: self.missing_episode_ids.extend(
+        episode_ids[row] for v_path in paths for row in rows_by_path[v_path]))
+      num_episodes = len(video_paths)
+      num_with_video = sum(len(rows) for rows in rows_by_path.values())
+      num_vids_found = num_with_video - sum(len(rows_by_path[v_path]) for v_path in missing_paths)
+      print("Memory contains %i episodes. Video file exists for %i out of %i episodes" % (num_episodes, num_vids_found, num_with_video))
+      return num_vids_found
+
+    if block:
+      return check()
+    self.sanity_check = threading.Thread(target=check, name='memory_sanity_check')
+    self.sanity_check.daemon = True
+    self.sanity_check.start()
+    return self.sanity_check
+
+  @classmethod
+  def from_store(cls, store_dir, base_dir, label_col="category", inter_class_pca_path=None, compaction_interval=None,
+                 check_sanity=True, memory_df=None):
+    '''
+    builds a memory from all episodes of an episode store (sealed segments and tail) and attaches the store, so that
+    episodes stored later on are persisted to it. An empty (e.g. new) store is initialized with the episodes of memory_df
+    :param store_dir: directory of the EpisodeStore
+    :param base_dir: base directory of the episode videos
+    :param label_col: specifies the label column name within the stored metadata
+    :param inter_class_pca_path: specifies the path to the model object of a previously trained PCA
+    :param compaction_interval: (optional) seconds between background compactions of the store
+    :param check_sanity: if True, checks whether the video files of all episodes exist
+    :param memory_df: (optional) dataframe with the hidden_reps, labels and video_file_paths of the initial episodes,
+                      only used (and required) if the store is empty. The episodes are written to the store
+    :return: Memory object
+    '''
+    episode_store = EpisodeStore(store_dir)
+    embeddings, store_df = episode_store.read_all()
+    if store_df.shape[0] == 0:
+      assert memory_df is not None, 'the episode store %s is empty, provide memory_df to initialize it' % store_dir
+      memory = cls(memory_df, base_dir, label_col=label_col, video_path_col='video_file_path',
+                   inter_class_pca_path=inter_class_pca_path, check_sanity=check_sanity)
+      memory.attach_store(episode_store, compaction_interval=compaction_interval)
+      return memory
+
+    store_df['hidden_repr'] = list(embeddings)
+    memory = cls(store_df, base_dir, label_col=label_col, video_path_col='video_file_path',
+                 inter_class_pca_path=inter_class_pca_path, check_sanity=check_sanity)
+    # aliases of episodes that were evicted (or never stored, after a crash during store_episodes) are dropped
+    for id, alias_ids in episode_store.aliases.items():
+      if id in memory.id_to_row:
+        memory._add_aliases(id, list(alias_ids))
+    memory.attach_store(episode_store, compaction_interval=compaction_interval, persist_episodes=False)
+    return memory
+
+  def attach_store(self, episode_store, compaction_interval=None, persist_episodes=True):
+    '''
+    persists the episodes of the memory and all episodes that are stored from now on to the provided episode store
+    :param episode_store: EpisodeStore object, must be empty if persist_episodes is True
+    :param compaction_interval: (optional) seconds between background compactions of the store, compaction only
+                                merges segments on disk and does not change the episodes of the memory
+    :param persist_episodes: if True, the current episodes of the memory are written to the store as one segment. False
+                             is only correct if the store already holds exactly these episodes (see from_store)
+    '''
+    with self._writing():
+      if persist_episodes:
+        assert len(episode_store) == 0, 'the episode store is not empty, use Memory.from_store to load its episodes'
+        episode_store.rewrite(self._live_matrix('hidden_reps'), self._store_metadata_df(self.memory_df))
+        if self.aliases:
+          episode_store.write_aliases(self.aliases)
+      self.episode_store = episode_store
+    if compaction_interval:
+      episode_store.start_background_compaction(compaction_interval)
 
-  def check_memory_sanity(self):
-    num_vids_found = np.sum([os.path.isfile( os.path.join(self.base_dir, v_path) ) for v_path in self.video_paths["video_file_path"].values])
-    num_episodes = self.labels.shape[0]
-    print("Memory contains %i episodes. Video file exists for %i out of %i episodes" % (num_episodes, num_vids_found, num_episodes))
+  def _store_metadata_df(self, memory_df):
+    ''' metadata of the episodes as written to an episode store, the aliases are recorded separately (see _persist_aliases) '''
+    store_df = memory_df.drop([column for column in ['hidden_repr', 'aliases'] if column in memory_df.columns], axis=1)
+    return store_df.rename(columns={self.video_path_col: 'video_file_path'})
 
-  def store_episodes(self, ids, hidden_reps, metadata_dicts, video_file_paths):
+  def store_episodes(self, ids, hidden_reps, metadata_dicts, video_file_paths=None):
     '''
-    stores provided episodes in mongo database (memory)
-    :param ids:
-    :param hidden_reps:
-    :param metadata_dicts:
-    :param video_file_path:
-    :return mongodb_ids corresponding to the persisted documents
+    stores provided episodes in the memory: the matrices grow in amortized O(n_new) and the episodes are added to all
+    built indexes. If an episode store is attached, the episodes are persisted to it first
+    :param ids: ids of the episodes
+    :param hidden_reps: hidden representations of the episodes
+    :param metadata_dicts: one json serializable metadata dict per episode, must contain the label column
+    :param video_file_paths: paths of the episode videos relative to the base directory of the memory, None (for all
+                             or single episodes) stores latent-only episodes without video, see attach_decoder
+    :return: memory indices of the stored episodes, -1 for episodes that were evicted right away (see set_capacity).
+             Episodes that were consolidated (see consolidation_threshold) get the index of their representative
     '''
+    if video_file_paths is None:
+      video_file_paths = [None] * len(ids)
     assert len(ids) == len(hidden_reps) == len(metadata_dicts) == len(video_file_paths)
-    assert all([os.path.isfile(path) for path in video_file_paths])
+    assert all([os.path.isfile(os.path.join(self.base_dir, path)) for path in video_file_paths if path is not None])
+    assert all([self.label_col in metadata for metadata in metadata_dicts])
+    if self.model_fingerprint is not None:
+      assert all([metadata.get('model_fingerprint', self.model_fingerprint) == self.model_fingerprint
+                  for metadata in metadata_dicts]), 'episodes were embedded by another model than the memory'
+      metadata_dicts = [dict(metadata, model_fingerprint=self.model_fingerprint) for metadata in metadata_dicts]
+
+    hidden_reps = np.stack([np.ravel(h) for h in hidden_reps])
+    with self._writing():
+      assert hidden_reps.shape[1] == self._live_matrix('hidden_reps').shape[1], \
+        'hidden_reps must have %i dimensions (model %s)' % (self._live_matrix('hidden_reps').shape[1], self.model_fingerprint)
+      n_consolidated = 0
+      if self.consolidation_threshold is not None:
+        representatives = self._consolidate_new_episodes(ids, hidden_reps, [m[self.label_col] for m in metadata_dicts])
+        new = np.flatnonzero(representatives < 0)
+        n_consolidated = len(ids) - len(new)
+        stored_ids, hidden_reps = [ids[i] for i in new], hidden_reps[new]
+        metadata_dicts, video_file_paths = [metadata_dicts[i] for i in new], [video_file_paths[i] for i in new]
+      else:
+        stored_ids = ids
+
+      rows = np.empty(0, dtype=np.int64)
+      if len(stored_ids) > 0:
+        if self.episode_store is not None:
+          self.episode_store.append(stored_ids, hidden_reps, metadata_dicts, video_file_paths)
+        rows = self._append_episodes(stored_ids, hidden_reps, metadata_dicts, video_file_paths)
+      evicted = self.enforce_capacity()
+      if n_consolidated > 0 or len(evicted) > 0:
+        # rows of representatives, the rows were renumbered if episodes were evicted
+        id_to_row = self.id_to_row
+        rows = np.array([id_to_row.get(self.alias_of.get(id, id), -1) for id in ids], dtype=np.int64)
+      return rows
+
+  def _consolidate_new_episodes(self, ids, hidden_reps, labels):
+    '''
+    finds near duplicates of new episodes among the episodes of the memory (through the default index) and among each
+    other, and registers them as aliases of their representative
+    :return: int array with the memory row of the representative of every new episode, -1 for episodes that are stored
+    '''
+    hidden_reps_normed = normalize_rows(hidden_reps)
+    representatives = -np.ones(len(ids), dtype=np.int64)
+    changed = []
+    version = self.version
+    k = min(self.consolidation_candidates, version.n_episodes)
+    if k > 0:
+      neighbours, similarities = self._search(version, version.matrices['hidden_reps_normed'], hidden_reps_normed, k,
+                                              False, 1024, None, raw_query_hidden_reprs=hidden_reps)
+      # the most similar candidate of the same class above the threshold
+      matches = (similarities >= self.consolidation_threshold) & \
+                (version.columns['labels'][neighbours] == np.asarray(labels, dtype=object)[:, None])
+      consolidated = np.flatnonzero(matches.any(axis=1))
+      representatives[consolidated] = neighbours[consolidated, np.argmax(matches[consolidated], axis=1)]
+      for i in consolidated:
+        changed += self._add_aliases(version.columns['ids'][representatives[i]], [ids[i]])
+      self._record_recalls(representatives[consolidated], version)
+
+    # duplicates within the new episodes, their representatives are stored
+    new = np.flatnonzero(representatives < 0)
+    new_representatives = near_duplicate_representatives(hidden_reps_normed[new], self.consolidation_threshold,
+                                                         np.asarray(labels, dtype=object)[new])
+    for i, j in zip(new, new[new_representatives]):
+      if i != j:
+        changed += self._add_aliases(ids[j], [ids[i]])
+        representatives[i] = j # any value >= 0, the rows are looked up once the representative is stored
+    self._persist_aliases(sorted(set(changed)))
+    return representatives
+
+  def consolidate(self, threshold=0.98, batch_size=1024):
+    '''
+    bulk near-duplicate consolidation of the episodes of the memory (e.g. augmented copies of an episode): every episode
+    whose cosine similarity to an earlier episode of the same class is at least threshold is removed and becomes an
+    alias of that representative
+    :param threshold: cosine similarity threshold
+    :return: number of consolidated episodes
+    '''
+    with self._writing():
+      representatives = near_duplicate_representatives(self._live_matrix('hidden_reps_normed'), threshold,
+                                                       self._label_values.array, batch_size=batch_size)
+      duplicates = np.flatnonzero(representatives != np.arange(len(representatives)))
+      ids, changed = self._ids.array, []
+      for row in duplicates:
+        changed += self._add_aliases(ids[representatives[row]], [ids[row]])
+      self._persist_aliases(sorted(set(changed)))
+      self.remove_rows(duplicates)
+      return len(duplicates)
+
+  def duplicate_counts(self, indices, version=None):
+    '''
+    :param indices: memory indices of episodes
+    :param version: (optional) MemoryVersion the indices refer to, defaults to the latest published version
+    :return: int array with the number of episodes every episode represents (1 + number of its aliases)
+    '''
+    ids = (version or self.version).columns['ids'][indices]
+    return np.reshape([1 + len(self.aliases.get(id, ())) for id in np.ravel(ids)], np.shape(ids))
+
+  def _append_episodes(self, ids, hidden_reps, metadata_dicts, video_file_paths):
+    start = self._ids.size
+    self._update_inter_class_pca(hidden_reps, [metadata[self.label_col] for metadata in metadata_dicts])
+    hidden_reps_transformed = self.inter_class_pca.transform(hidden_reps)
+    self._matrices['hidden_reps'].append(hidden_reps)
+    self._matrices['hidden_reps_transformed'].append(hidden_reps_transformed)
+    self._matrices['hidden_reps_normed'].append(normalize_rows(hidden_reps))
+    self._matrices['hidden_reps_transformed_normed'].append(normalize_rows(hidden_reps_transformed))
+    if self._pending_projection is not None:
+      pending_transformed = self._pending_projection['pca'].transform(hidden_reps)
+      self._pending_projection['matrices']['hidden_reps_transformed'].append(pending_transformed)
+      self._pending_projection['matrices']['hidden_reps_transformed_normed'].append(normalize_rows(pending_transformed))
+
+    metadata_df = pd.DataFrame(list(metadata_dicts))
+    metadata_df['id'] = list(ids)
+    metadata_df[self.video_path_col] = list(video_file_paths)
+    if 'hidden_repr' in self._metadata_frames[0].columns:
+      metadata_df['hidden_repr'] = list(hidden_reps)
+    self._metadata_frames.append(metadata_df)
+    self.metadata_index.add(metadata_df, start)
+    self._ids.append(np.asarray(list(ids), dtype=object))
+    if self._id_to_row is not None:
+      self._id_to_row.update(zip(ids, range(start, start + len(ids))))
+    self._label_values.append(np.asarray(list(metadata_df[self.label_col]), dtype=object))
+    self._video_path_values.append(np.asarray(list(video_file_paths), dtype=object))
+    # storing counts as a recall for the lru eviction policy
+    self._last_recall.append(np.full(len(ids), self._recall_clock, dtype=np.int64))
+    self._recall_counts.append(np.zeros(len(ids), dtype=np.int64))
+
+    # the indexes of the published version stay untouched, the episodes are added to shallow copies
+    rows = np.arange(start, self._ids.size)
+    indexes = {}
+    for (backend, use_transform), index in self.indexes.items():
+      index = copy.copy(index)
+      self._add_to_index(index, rows, use_transform)
+      indexes[(backend, use_transform)] = index
+    self.indexes = indexes
+    if self.classifier is not None:
+      self.classifier = copy.copy(self.classifier).partial_fit(hidden_reps, self._label_values.array[rows])
+
+    # amortize the re-projection of rows that are still in an old PCA basis over the stores
+    self.reproject(max_rows=self.reproject_batch_size)
+    self.invalidate_query_cache()
+    return rows
+
+  def _add_to_index(self, index, rows, use_transform):
+    ''' adds memory rows to an index, with the labels or PCA transformed vectors if the index requires them '''
+    memory_hidden_reps = self._live_matrix('hidden_reps_transformed_normed' if use_transform else 'hidden_reps_normed')
+    if getattr(index, 'requires_labels', False):
+      index.add(memory_hidden_reps, rows, self._label_values.array[rows])
+    elif getattr(index, 'requires_transformed', False):
+      index.add(memory_hidden_reps, rows, self._live_matrix('hidden_reps_transformed')[rows])
+    else:
+      index.add(memory_hidden_reps, rows)
+
+  def invalidate_query_cache(self):
+    if self.query_cache is not None:
+      self.query_cache.clear()
+
+  def _update_inter_class_pca(self, hidden_reps, labels):
+    '''
+    updates the per-class sums and counts with new episodes in O(n_new) and refits the inter class PCA on the class
+    means (O(n_classes)) after pca_refit_interval episodes or if a new class arrived. If the basis changed by more
+    than pca_update_threshold, the existing rows are re-projected with the new PCA in batches (see reproject), the
+    current PCA stays in use until all rows are re-projected
+    '''
+    if self.pca_update_threshold is None:
+      return
+    if self.class_sums is None:
+      self.class_sums, self.class_counts = collections.defaultdict(lambda: 0), collections.defaultdict(lambda: 0)
+      self._accumulate_class_statistics(self._live_matrix('hidden_reps'), self._label_values.array)
+    new_classes = any(label not in self.class_counts for label in set(labels))
+    self._accumulate_class_statistics(hidden_reps, labels)
+    self._episodes_since_pca_fit += len(labels)
+    if not new_classes and self._episodes_since_pca_fit < self.pca_refit_interval:
+      return
+
+    self._episodes_since_pca_fit = 0
+    class_means = np.stack([self.class_sums[label] / self.class_counts[label] for label in self.class_sums])
+    n_components = min(self.inter_class_pca.n_components_, class_means.shape[0])
+    pca = sklearn.decomposition.PCA(n_components).fit(class_means)
+    if pca_basis_change(self.inter_class_pca, pca) > self.pca_update_threshold:
+      # the rows [0, stop) are re-projected by reproject, rows stored from now on are projected with both PCAs
+      n_episodes, dtype = self._ids.size, self._live_matrix('hidden_reps_transformed').dtype
+      self._pending_projection = {'pca': pca, 'next': 0, 'stop': n_episodes, 'matrices': dict(
+        (name, GrowableArray(np.empty((n_episodes, pca.n_components_), dtype=dtype)))
+        for name in ['hidden_reps_transformed', 'hidden_reps_transformed_normed'])}
+
+  def _accumulate_class_statistics(self, hidden_reps, labels):
+    ''' adds the episodes to the per-class sums and counts, one numpy reduction per call instead of one per episode '''
+    labels = np.asarray(labels)
+    _, first_rows, class_of_row = np.unique(labels.astype(str), return_index=True, return_inverse=True)
+    sums = np.zeros((len(first_rows), hidden_reps.shape[1]))
+    np.add.at(sums, class_of_row, hidden_reps)
+    for label, class_sum, count in zip(labels[first_rows], sums, np.bincount(class_of_row, minlength=len(first_rows))):
+      self.class_sums[label] = self.class_sums[label] + class_sum
+      self.class_counts[label] += int(count)
+
+  def reproject(self, max_rows=None):
+    '''
+    projects the rows with a new inter class PCA (see _update_inter_class_pca), in batches of reproject_batch_size rows.
+    Once all rows are re-projected, the new PCA and transformed matrices replace the current ones and the indexes
+    on the transformed vectors are rebuilt, all of them are published together. Such indexes that can not be rebuilt
+    (registered by add_index / load_index without a builder) are dropped
+    :param max_rows: (optional) maximum number of rows that are re-projected in this call, defaults to all
+    '''
+    with self._writing():
+      pending = self._pending_projection
+      if pending is None:
+        return
+      stop = pending['stop'] if max_rows is None else min(pending['stop'], pending['next'] + max_rows)
+      for start in range(pending['next'], stop, self.reproject_batch_size):
+        rows = slice(start, min(start + self.reproject_batch_size, stop))
+        hidden_reps_transformed = pending['pca'].transform(self._live_matrix('hidden_reps')[rows])
+        pending['matrices']['hidden_reps_transformed'].write(start, hidden_reps_transformed)
+        pending['matrices']['hidden_reps_transformed_normed'].write(start, normalize_rows(hidden_reps_transformed))
+      pending['next'] = stop
+
+      if pending['next'] >= pending['stop']:
+        self._matrices.update(pending['matrices'])
+        self.inter_class_pca = pending['pca']
+        self._pending_projection = None
+        stale = [key for key in self.indexes if key[1] or key[0] == 'cascade']
+        for key in stale:
+          if key in self.index_builders:
+            self.index_builders[key]()
+          else:
+            print('Dropped the %s index (use_transform=%s), it was built on the old inter class PCA' % key)
+            self.indexes = dict((k, index) for k, index in self.indexes.items() if k != key)
+
+  def set_capacity(self, max_episodes=None, max_bytes=None, policy='lru', slack=0.05, seed=None):
+    '''
+    bounds the size of the memory, episodes are evicted whenever a store exceeds the capacity
+    :param max_episodes: (optional) maximum number of episodes
+    :param max_bytes: (optional) maximum size in bytes of the vector matrices and index codes, see memory_footprint
+    :param policy: 'lru' (least recently recalled episodes first), 'reservoir' (uniform sample within every class,
+                   large classes are reduced first) or 'redundancy' (episodes most similar to their nearest neighbour first)
+    :param slack: fraction of the capacity that is freed in addition, evictions compact the matrices and indexes and
+                  are amortized over several stores this way
+    :param seed: random seed of the reservoir sampling
+    :return: ids of the episodes evicted to meet the new capacity
+    '''
+    assert policy in EVICTION_POLICIES, 'policy must be one of ' + str(EVICTION_POLICIES)
+    assert 0 <= slack < 1
+    with self._writing():
+      self.capacity, self.capacity_bytes = max_episodes, max_bytes
+      self.eviction_policy, self.eviction_slack = policy, slack
+      self._eviction_random_state = np.random.RandomState(seed)
+      return self.enforce_capacity()
+
+  def enforce_capacity(self):
+    '''
+    evicts episodes by eviction_policy if the memory exceeds its capacity
+    :return: ids of the evicted episodes
+    '''
+    with self._writing():
+      n_episodes = self._ids.size
+      limits = [self.capacity] if self.capacity is not None else []
+      if self.capacity_bytes is not None and n_episodes > 0:
+        bytes_per_episode = sum(self.memory_footprint().values()) / float(n_episodes)
+        limits.append(int(self.capacity_bytes / bytes_per_episode))
+      if not limits or n_episodes <= min(limits):
+        return np.empty(0, dtype=object)
+
+      n_evict = n_episodes - int(min(limits) * (1 - self.eviction_slack))
+      if self.eviction_policy == 'lru':
+        rows = np.argsort(self._last_recall.array, kind='mergesort')[:n_evict] # ties: the oldest episodes first
+      elif self.eviction_policy == 'reservoir':
+        rows = self._reservoir_evictions(n_evict)
+      else:
+        rows = self._redundancy_evictions(n_evict)
+
+      self.eviction_counters['eviction_runs'] += 1
+      self.eviction_counters['evicted'] += len(rows)
+      self.eviction_counters['evicted_never_recalled'] += int(np.count_nonzero(self._recall_counts.array[rows] == 0))
+      return self.remove_rows(rows)
+
+  def _reservoir_evictions(self, n_evict):
+    ''' every class keeps a uniform random sample of its episodes, the per-class quotas are filled up fairly '''
+    classes, class_of_row, counts = np.unique(self._label_values.array.astype(str), return_inverse=True,
+                                              return_counts=True)
+    quotas, n_keep = counts.copy(), self._ids.size - n_evict
+    for i, c in enumerate(np.argsort(counts)):
+      quotas[c] = min(counts[c], n_keep // (len(classes) - i))
+      n_keep -= quotas[c]
+    rows = [self._eviction_random_state.choice(np.flatnonzero(class_of_row == c), counts[c] - quotas[c], replace=False)
+            for c in np.flatnonzero(counts > quotas)]
+    return np.concatenate(rows)
+
+  def _redundancy_evictions(self, n_evict):
+    '''
+    redundancy score of an episode: cosine similarity to its nearest neighbour (through the default index). The most
+    redundant episodes are evicted first, but an episode is kept if its nearest neighbour was already evicted
+    '''
+    version = self._working_version()
+    memory_hidden_reps = version.matrices['hidden_reps_normed']
+    neighbours, similarities = self._search(version, memory_hidden_reps, memory_hidden_reps, 2, False, 1024, None,
+                                            raw_query_hidden_reprs=version.matrices['hidden_reps'])
+    # the episode itself is usually the first match, except for exact duplicates
+    is_self = neighbours[:, 0] == np.arange(len(neighbours))
+    nearest = np.where(is_self, neighbours[:, 1], neighbours[:, 0])
+    scores = np.where(is_self, similarities[:, 1], similarities[:, 0])
+
+    evicted = np.zeros(len(nearest), dtype=bool)
+    order = np.argsort(-scores, kind='mergesort')
+    for row in order:
+      if not evicted[nearest[row]]:
+        evicted[row] = True
+        if np.count_nonzero(evicted) == n_evict:
+          break
+    rows = np.flatnonzero(evicted)
+    if len(rows) < n_evict:
+      rows = np.concatenate((rows, order[~evicted[order]][:n_evict - len(rows)]))
+    return rows
+
+  def remove_rows(self, rows):
+    '''
+    removes episodes from the memory: the matrices, ids and metadata are compacted, the indexes renumbered, the class
+    statistics of the inter class PCA updated and the episodes deleted from an attached episode store
+    :param rows: memory indices of the episodes to remove
+    :return: ids of the removed episodes
+    '''
+    with self._writing():
+      self.reproject()
+      keep = np.ones(self._ids.size, dtype=bool)
+      keep[rows] = False
+      removed_ids = self._ids.array[~keep]
+      if len(removed_ids) == 0:
+        return removed_ids
+
+      if self.class_sums is not None:
+        for label, hidden_rep in zip(self._label_values.array[~keep], self._live_matrix('hidden_reps')[~keep]):
+          self.class_sums[label] = self.class_sums[label] - hidden_rep
+          self.class_counts[label] -= 1
+          if self.class_counts[label] == 0:
+            del self.class_sums[label], self.class_counts[label]
+        self._episodes_since_pca_fit += len(removed_ids)
+      if self.classifier is not None:
+        self.classifier = copy.copy(self.classifier).remove(self._live_matrix('hidden_reps')[~keep],
+                                                            self._label_values.array[~keep])
+
+      indexes = {}
+      for (backend, use_transform), index in self.indexes.items():
+        index = copy.copy(index)
+        index.compact(self._live_matrix('hidden_reps_transformed_normed' if use_transform else 'hidden_reps_normed'), keep)
+        indexes[(backend, use_transform)] = index
+      self.indexes = indexes
+
+      # new arrays, the published versions keep the old ones
+      memory_df = self.memory_df[keep].reset_index(drop=True)
+      for name, matrix in list(self._matrices.items()):
+        self._matrices[name] = GrowableArray(matrix.array[keep])
+      self._set_metadata(memory_df, self.base_dir, self.label_col, self.video_path_col)
+      # rows of versions before this one must not be used with the new arrays, the version is advanced before they
+      # are swapped in so that readers of older versions stop recording recalls first
+      self._renumbered_version = self.version.number + 1
+      self._last_recall = GrowableArray(self._last_recall.array[keep])
+      self._recall_counts = GrowableArray(self._recall_counts.array[keep])
+      # new index in the new row numbering, the published versions keep the old one
+      metadata_index = MetadataIndex()
+      for column in list(self.metadata_index.postings):
+        metadata_index.index_column(column, memory_df[column].values)
+      self.metadata_index = metadata_index
+
+      removed_representatives = [id for id in removed_ids if id in self.aliases]
+      for id in removed_representatives:
+        for alias_id in self.aliases.pop(id):
+          self.alias_of.pop(alias_id, None)
+      self._persist_aliases(removed_representatives)
+
+      if self.episode_store is not None:
+        self.episode_store.delete(removed_ids)
+      if self.frame_store is not None:
+        self.frame_store.delete(removed_ids)
+      self.invalidate_query_cache()
+      if self.clip_cache is not None: # evicted ids may be stored again with other hidden_reps
+        self.clip_cache.clear()
+      return removed_ids
+
+  def _record_recalls(self, rows, version=None):
+    '''
+    marks episodes as recalled for the lru eviction policy and the recall statistics. Recalls are counted without
+    locking, concurrent recalls may be lost and recalls that race with an eviction may be dropped or attributed to
+    the wrong episode, but recording never fails
+    :param rows: memory indices of the recalled episodes (-1 entries are ignored)
+    :param version: (optional) MemoryVersion the rows refer to, rows of the current episodes if not provided
+    '''
+    if version is not None and version.number < self._renumbered_version:
+      return
+    last_recall, recall_counts = self._last_recall.array, self._recall_counts.array
+    rows = np.ravel(rows)
+    rows = rows[(rows >= 0) & (rows < min(len(last_recall), len(recall_counts)))]
+    self._recall_clock += 1
+    last_recall[rows] = self._recall_clock
+    np.add.at(recall_counts, rows, 1)
+    self.eviction_counters['recalls'] += len(rows)
+
+  def memory_stats(self):
+    '''
+    :return: dict with the size and capacity of the memory, the eviction counters and recall statistics:
+             recalled_episodes is the number of current episodes that were recalled at least once,
+             consolidated_episodes the number of aliases of near-duplicate episodes. Includes the checkpoint
+             fingerprint and the progress of a re-embedding job (see start_reembedding)
+    '''
+    recall_counts = self._recall_counts.array
+    stats = dict(self.eviction_counters)
+    stats.update({'n_episodes': int(self._ids.size), 'nbytes': int(sum(self.memory_footprint().values())),
+                  'capacity': self.capacity, 'capacity_bytes': self.capacity_bytes, 'policy': self.eviction_policy,
+                  'recalled_episodes': int(np.count_nonzero(recall_counts)), 'consolidated_episodes': len(self.alias_of),
+                  'recall_hit_rate': float(np.count_nonzero(recall_counts)) / len(recall_counts) if len(recall_counts) else 0.0,
+                  'model_fingerprint': self.model_fingerprint})
+    if self.reembedding_job is not None:
+      stats['reembedding'] = self.reembedding_job.progress()
+    return stats
+
+  def stale_ids(self, model_fingerprint=None):
+    '''
+    :param model_fingerprint: (optional) checkpoint fingerprint, defaults to the one of the memory
+    :return: list with the ids of the episodes that were not embedded by the checkpoint with model_fingerprint
+    '''
+    model_fingerprint = model_fingerprint or self.model_fingerprint
+    memory_df = self.memory_df
+    if 'model_fingerprint' not in memory_df.columns:
+      return list(memory_df['id'])
+    return list(memory_df['id'][memory_df['model_fingerprint'].values != model_fingerprint])
+
+  def start_reembedding(self, encoder, model_fingerprint, frame_source=None, batch_size=256, n_threads=4,
+                        report_interval=10.0, block=False):
+    '''
+    starts a ReembeddingJob that re-encodes the stale episodes (see stale_ids) with another checkpoint from their frames
+    in a background thread. Queries keep using the current version until the job swaps in the new embeddings
+    :param encoder: object with an encode(clips) method that maps a batch of clips to hidden_reps (e.g.
+                    core.Model.LatentEncoder of the new checkpoint)
+    :param model_fingerprint: fingerprint of the new checkpoint (see utils.helpers.checkpoint_fingerprint)
+    :param frame_source: (optional) FrameStore with the frames of the episodes, defaults to the attached frame store.
+                         Episodes that are not in it are read from their video files
+    :param batch_size: number of episodes that are encoded with one encoder call
+    :param n_threads: number of threads that read the frames of a batch
+    :param report_interval: seconds between progress reports
+    :param block: if True, waits until the job finished
+    :return: the ReembeddingJob, see ReembeddingJob.progress
+    '''
+    assert self.reembedding_job is None or not self.reembedding_job.is_alive(), 'a re-embedding job is already running'
+    frame_source = frame_source if frame_source is not None else self.frame_store
+    self.reembedding_job = ReembeddingJob(self, encoder, model_fingerprint, frame_source=frame_source,
+                                          batch_size=batch_size, n_threads=n_threads, report_interval=report_interval)
+    self.reembedding_job.start()
+    if block:
+      self.reembedding_job.join()
+    return self.reembedding_job
+
+  def swap_embeddings(self, ids, hidden_reps, model_fingerprint):
+    '''
+    replaces the embeddings of all episodes by the ones of another checkpoint: the inter class PCA is refitted, the
+    matrices are replaced by new ones and the indexes rebuilt (indexes without builder, e.g. loaded ones, are dropped).
+    Everything is published as one version, queries that pinned an older version keep using the old embeddings.
+    Episodes without new embedding keep their embedding if they were embedded by the same checkpoint, the others are
+    removed since they are not comparable with the re-embedded ones
+    :param ids: ids of the re-embedded episodes (ids that are no longer in the memory are ignored)
+    :param hidden_reps: new hidden_reps of the episodes, shape (n_ids, n_dim_repr)
+    :param model_fingerprint: fingerprint of the checkpoint that produced hidden_reps
+    :return: ids of the removed episodes
+    '''
+    hidden_reps = np.stack([np.ravel(h) for h in hidden_reps])
+    with self._writing():
+      self.reproject()
+      new_rows = dict(zip(ids, range(len(ids))))
+      memory_df = self.memory_df
+      up_to_date = memory_df['model_fingerprint'].values == model_fingerprint if 'model_fingerprint' in memory_df.columns \
+        else np.zeros(len(memory_df), dtype=bool)
+      keep = np.array([id in new_rows or current for id, current in zip(self._ids.array, up_to_date)], dtype=bool)
+      current_hidden_reps = self._live_matrix('hidden_reps')
+      hidden_reps = np.stack([hidden_reps[new_rows[id]] if id in new_rows else current_hidden_reps[row]
+                              for row, id in zip(np.flatnonzero(keep), self._ids.array[keep])])
+      # the PCA is fitted before the memory is modified, a failing fit leaves it untouched
+      labels = self._label_values.array[keep]
+      inter_class_pca = fit_inter_class_pca(hidden_reps, labels, n_components=min(
+        self.inter_class_pca.n_components_, hidden_reps.shape[1], len(set(labels))))
+
+      removed_ids = self.remove_rows(np.flatnonzero(~keep))
+      self.inter_class_pca = inter_class_pca
+      self._set_matrices(hidden_reps, self.inter_class_pca.transform(hidden_reps))
+      self._pending_projection = None
+      self.class_sums, self.class_counts, self._episodes_since_pca_fit = None, None, 0
 
-    #TODO: store as document in mongodb
+      memory_df = self.memory_df.copy()
+      if 'hidden_repr' in memory_df.columns:
+        memory_df['hidden_repr'] = list(hidden_reps)
+      memory_df['model_fingerprint'] = model_fingerprint
+      self._metadata_frames = [memory_df]
+      if self.metadata_index.is_indexed('model_fingerprint'):
+        # the published versions keep the postings of the old fingerprints
+        self.metadata_index = copy.copy(self.metadata_index)
+        self.metadata_index.postings = dict(self.metadata_index.postings)
+        del self.metadata_index.postings['model_fingerprint']
+        self.metadata_index.index_column('model_fingerprint', memory_df['model_fingerprint'].values)
+      self.model_fingerprint = model_fingerprint
 
-    #for i, id in enumerate(ids):
-    #  if id not in self.memory_df:
+      self.indexes = {}
+      if self.default_backend not in [backend for backend, _ in self.index_builders]:
+        self.default_backend = 'exact'
+      for builder in list(self.index_builders.values()):
+        builder()
+      if self.classifier_builder is not None:
+        self.classifier_builder()
+
+      if self.episode_store is not None:
+        self.episode_store.rewrite(hidden_reps, self._store_metadata_df(memory_df))
+      self.invalidate_query_cache()
+      if self.clip_cache is not None: # the decoder of the old checkpoint does not match the new embeddings
+        self.clip_cache.clear()
+    return removed_ids
 
   def get_episode(self, id):
     '''
-    queries a single episode by its id
-    :return: tuple of four objects (id, hidden_reps, metadata_dicts, video_episode)
+    queries a single episode by its id in O(1), aliases of consolidated episodes resolve to their representative
+    :return: Episode tuple of four objects (id, hidden_repr, metadata, video_episode), the frames of the video_episode
+             are read lazily on first access of video_episode.frames: from the frame store if one is attached and holds
+             the episode, else from the video file, else regenerated by the decoder (if one is attached)
     '''
-    # TODO
-    #pass
+    id = self.alias_of.get(id, id)
+    assert id in self.id_to_row, 'episode %s is not in the memory' % str(id)
+    row = self.id_to_row[id]
+    self._record_recalls([row])
+    metadata = self.memory_df.iloc[row].to_dict()
+    metadata.pop('hidden_repr', None)
+    video_path = self._video_path_values.array[row]
+    video_path = None if video_path is None else os.path.join(self.base_dir, video_path)
+    load = None
+    if self.frame_store is not None and id in self.frame_store:
+      load = functools.partial(self.frame_store.get, id)
+    elif self.decoder is not None and (video_path is None or not os.path.exists(video_path)):
+      load = lambda: self.recall_frames([id])[0]
+    return Episode(id, self._live_matrix('hidden_reps')[row], metadata, LazyVideoEpisode(video_path, load))
 
-  def matching(self, query_hidden_repr, n_closest_matches = 5, use_transform=False):
+  def attach_frame_store(self, frame_store):
+    '''
+    attaches a FrameStore with the frames of the episodes keyed by episode id (e.g. written by
+    core.frame_store.convert_memory_videos), episodes are then recalled from it instead of their video files.
+    Evicted episodes are deleted from the frame store
+    :param frame_store: FrameStore
+    '''
+    self.frame_store = frame_store
+
+  def stored_frames(self, ids, frames=None):
+    '''
+    reads the frames of episodes from the attached frame store, aliases of consolidated episodes resolve to their
+    representative
+    :param ids: episode ids, e.g. returned by episode_ids for the indices of matching
+    :param frames: (optional) slice of the frames to read of every episode
+    :return: list with one uint8 array of shape (n_frames, height, width, n_channels) per id, zero-copy views on the
+             memory map of the frame store for uncompressed episodes
+    '''
+    assert self.frame_store is not None, 'no frame store attached to the memory, see attach_frame_store'
+    return [self.frame_store.get(self.alias_of.get(id, id), frames) for id in ids]
+
+  def attach_decoder(self, decoder, batch_size=32, cache_size=256):
+    '''
+    attaches a decoder that regenerates the frames of episodes from their hidden_reps, see recall_frames and
+    predict_future. With a decoder, the memory does not need to keep a video file per episode
+    :param decoder: object with a decode(hidden_reps, kind) method that maps a batch of hidden_reps to uint8 clips of
+                    shape (batch_size, n_frames, height, width, n_channels), kind is 'reconst' or 'future'
+                    (e.g. core.Model.LatentDecoder)
+    :param batch_size: number of episodes that are decoded with one decoder call
+    :param cache_size: number of decoded clips that are kept in an LRU cache (0 disables caching)
+    '''
+    self.decoder = decoder
+    self.decode_batch_size = batch_size
+    self.clip_cache = QueryCache(max_size=cache_size) if cache_size else None
+
+  def recall_frames(self, ids):
+    '''
+    reconstructs the frames of episodes with the attached decoder
+    :param ids: episode ids, e.g. returned by episode_ids for the indices of matching
+    :return: list with one uint8 array of shape (n_frames, height, width, n_channels) per id
+    '''
+    return self._decode_clips(ids, 'reconst')
+
+  def predict_future(self, ids):
+    '''
+    predicts the frames that follow the episodes with the attached decoder
+    :param ids: episode ids, e.g. returned by episode_ids for the indices of matching
+    :return: list with one uint8 array of shape (n_future_frames, height, width, n_channels) per id
+    '''
+    return self._decode_clips(ids, 'future')
+
+  def _decode_clips(self, ids, kind):
+    assert self.decoder is not None, 'no decoder attached to the memory, see attach_decoder'
+    ids = [self.alias_of.get(id, id) for id in ids]
+    clips = {}
+    if self.clip_cache is not None:
+      for id in set(ids):
+        clip = self.clip_cache.get((id, kind))
+        if clip is not None:
+          clips[id] = clip
+
+    # the misses are decoded in batches, the hidden_reps are gathered from the live matrix under the write lock so that
+    # an eviction does not renumber the rows in between
+    missing = [id for id in collections.OrderedDict.fromkeys(ids) if id not in clips]
+    if missing:
+      with self.write_lock:
+        id_to_row = self.id_to_row
+        assert all(id in id_to_row for id in missing), 'episodes are not in the memory: ' + str(
+          [id for id in missing if id not in id_to_row])
+        rows = [id_to_row[id] for id in missing]
+        hidden_reps = self._live_matrix('hidden_reps')[rows]
+        self._record_recalls(rows)
+      for start in range(0, len(missing), self.decode_batch_size):
+        decoded = self.decoder.decode(hidden_reps[start:start + self.decode_batch_size], kind)
+        for id, clip in zip(missing[start:start + self.decode_batch_size], decoded):
+          clips[id] = clip
+          if self.clip_cache is not None:
+            self.clip_cache.put((id, kind), clip)
+    return [clips[id] for id in ids]
+
+  def episode_ids(self, indices, version=None):
+    '''
+    :param indices: memory indices of episodes (e.g. returned by matching)
+    :param version: (optional) MemoryVersion the indices refer to, defaults to the latest published version
+    :return: array with the ids of the episodes
+    '''
+    return (version or self.version).columns['ids'][indices]
+
+  def matching(self, query_hidden_repr, n_closest_matches = 5, use_transform=False, backend=None, filters=None):
     '''
     finds the closest vector matches (cos_similarity) for a given query vector
     :param query_hidden_repr: the query vector
     :param n_clostest_matches: (optional) the number of closest matches returned, defaults to 5
     :param use_transform: boolean that denotes whether the matching shall performed on transformed hidden vectors
+    :param backend: (optional) 'exact' or the name of a built index (e.g. 'ivf', 'hnsw'), defaults to self.default_backend
+    :param filters: (optional) dict with predicates on metadata columns, only matching episodes are returned, see filter_mask
     :return: four arrays, containing:
           1. the n_clostest_matches by id
           2. the n_closest_matches by computed pairwise cos distance
           3. the n_closest_matches hidden representations
           4. the n_closest_matches absolute paths to the memory episodes in the base directory of the memory
     '''
+    version = self.version
+    if use_transform:
+      memory_hidden_reps = version.matrices['hidden_reps_transformed']
+    else:
+      memory_hidden_reps = version.matrices['hidden_reps']
+
+    indices_closest, cos_distances, absolute_paths = self.match_batch(np.expand_dims(np.ravel(query_hidden_repr), axis=0),
+                                                                      n_closest_matches=n_closest_matches, use_transform=use_transform,
+                                                                      backend=backend, filters=filters, version=version)
+
+    return indices_closest[0], cos_distances[0], memory_hidden_reps[indices_closest[0]], absolute_paths[0]
+
+  def match_batch(self, query_hidden_reprs, n_closest_matches=5, use_transform=False, batch_size=1024, backend=None,
+                  filters=None, version=None):
+    '''
+    finds the closest vector matches (cos_similarity) for a batch of query vectors. The queries are scored in blocks
+    of batch_size against the normalized float32 memory (one matrix product per block) and only the top n_closest_matches
+    of each query are sorted. Results of queries that are (nearly) identical to recent ones are taken from query_cache
+    :param query_hidden_reprs: the query vectors, shape (n_queries, n_dim_repr)
+    :param n_closest_matches: (optional) the number of closest matches returned per query, defaults to 5
+    :param use_transform: boolean that denotes whether the matching shall performed on transformed hidden vectors
+    :param batch_size: (optional) number of queries that are scored at once, bounds the size of the score matrix
+    :param backend: (optional) 'exact' or the name of a built index (e.g. 'ivf', 'hnsw'), defaults to self.default_backend
+    :param filters: (optional) dict with predicates on metadata columns, only matching episodes are returned, see filter_mask
+    :param version: (optional) MemoryVersion to search, defaults to the latest published version
+    :return: three objects, containing:
+          1. array of shape (n_queries, n_closest_matches) with the memory indices of the closest matches
+          2. array of shape (n_queries, n_closest_matches) with the corresponding cos distances
+          3. list with one list of absolute paths to the matched memory episodes per query
+    '''
+    version = version or self.version
+    query_hidden_reprs = np.asarray(query_hidden_reprs)
+    query_hidden_reprs = raw_query_hidden_reprs = query_hidden_reprs.reshape(query_hidden_reprs.shape[0], -1)
+    if use_transform:
+      memory_hidden_reps = version.matrices['hidden_reps_transformed_normed']
+      query_hidden_reprs = version.inter_class_pca.transform(query_hidden_reprs)
+    else:
+      memory_hidden_reps = version.matrices['hidden_reps_normed']
+    assert memory_hidden_reps.shape[1] == query_hidden_reprs.shape[1]
+
+    query_hidden_reprs = normalize_rows(query_hidden_reprs)
+    mask = self.filter_mask(filters, version=version) if filters else None
+    n_selected = memory_hidden_reps.shape[0] if mask is None else int(np.count_nonzero(mask))
+    n_closest_matches = min(n_closest_matches, n_selected)
+    if n_closest_matches == 0:
+      return np.empty((query_hidden_reprs.shape[0], 0), dtype=np.int64), \
+             np.empty((query_hidden_reprs.shape[0], 0), dtype=np.float32), [[] for _ in query_hidden_reprs]
+
+    # results of filters with callable predicates are not cached, the predicates cannot be compared
+    if self.query_cache is None or (filters and any(callable(p) for p in filters.values())):
+      indices_closest, cos_similarities = self._search(version, memory_hidden_reps, query_hidden_reprs, n_closest_matches,
+                                                       use_transform, batch_size, backend, mask, raw_query_hidden_reprs)
+    else:
+      # only the queries that are not cached are searched
+      search_params = (version.number, n_closest_matches, use_transform,
+                       backend if backend is not None else version.default_backend,
+                       sorted((column, repr(predicate)) for column, predicate in (filters or {}).items()))
+      keys = [self.query_cache.key(query, *search_params) for query in query_hidden_reprs]
+      cached = [self.query_cache.get(key) for key in keys]
+      indices_closest = np.empty((query_hidden_reprs.shape[0], n_closest_matches), dtype=np.int64)
+      cos_similarities = np.empty((query_hidden_reprs.shape[0], n_closest_matches), dtype=np.float32)
+      misses = [i for i, result in enumerate(cached) if result is None]
+      if misses:
+        indices_closest[misses], cos_similarities[misses] = self._search(version, memory_hidden_reps,
+                                                                         query_hidden_reprs[misses], n_closest_matches,
+                                                                         use_transform, batch_size, backend, mask,
+                                                                         raw_query_hidden_reprs[misses])
+      for i, result in enumerate(cached):
+        if result is None:
+          self.query_cache.put(keys[i], (indices_closest[i].copy(), cos_similarities[i].copy()))
+        else:
+          indices_closest[i], cos_similarities[i] = result
+
+    self._record_recalls(indices_closest, version)
+    return indices_closest, 1.0 - cos_similarities, \
+           [self.absolute_video_paths(indices, version) for indices in indices_closest]
+
+  def _search(self, version, memory_hidden_reps, query_hidden_reprs, n_closest_matches, use_transform, batch_size,
+              backend, mask=None, raw_query_hidden_reprs=None):
+    '''
+    :param mask: (optional) boolean array over the memory rows, only selected rows are scored / returned
+    :param raw_query_hidden_reprs: the queries before normalization, required by indexes that scan PCA transformed
+                                   vectors (see CascadeIndex)
+    :return: memory indices and cos similarities of the n_closest_matches of the normalized queries
+    '''
+    index = self.select_index(backend, use_transform, version)
+    if index is None or (mask is not None and np.count_nonzero(mask) < self.filter_exact_fraction * mask.shape[0]):
+      return self._exact_search(memory_hidden_reps, query_hidden_reprs, n_closest_matches, batch_size, mask)
+
+    search_kwargs = {'mask': mask}
+    if getattr(index, 'requires_transformed', False):
+      search_kwargs['transformed_queries'] = version.inter_class_pca.transform(raw_query_hidden_reprs)
+    indices_closest, cos_similarities = index.search(memory_hidden_reps, query_hidden_reprs, n_closest_matches,
+                                                     **search_kwargs)
+    # with a filter, the HNSW graph may not connect k selected rows to the entry point, the missing matches are padded
+    # with row -1. These queries are answered by the exact scan of the selected rows instead
+    incomplete = np.flatnonzero((indices_closest < 0).any(axis=1))
+    if len(incomplete) > 0:
+      indices_closest[incomplete], cos_similarities[incomplete] = self._exact_search(
+        memory_hidden_reps, query_hidden_reprs[incomplete], n_closest_matches, batch_size, mask)
+    return indices_closest, cos_similarities
+
+  def _exact_search(self, memory_hidden_reps, query_hidden_reprs, n_closest_matches, batch_size, mask=None):
+    '''
+    exact scan, restricted to the selected rows if a mask is given
+    :return: memory indices and cos similarities of the n_closest_matches of the normalized queries
+    '''
+    selected_rows = None if mask is None else np.flatnonzero(mask)
+    if selected_rows is not None:
+      memory_hidden_reps = memory_hidden_reps[selected_rows]
+    indices_closest = np.empty((query_hidden_reprs.shape[0], n_closest_matches), dtype=np.int64)
+    cos_similarities = np.empty((query_hidden_reprs.shape[0], n_closest_matches), dtype=np.float32)
+    for start in range(0, query_hidden_reprs.shape[0], batch_size):
+      block = slice(start, start + batch_size)
+      similarities = np.dot(query_hidden_reprs[block], memory_hidden_reps.T) #shape(batch_size, n_episodes)
+      indices_closest[block] = top_k_indices(similarities, n_closest_matches)
+      cos_similarities[block] = similarities[np.arange(similarities.shape[0])[:, None], indices_closest[block]]
+    if selected_rows is not None:
+      indices_closest = selected_rows[indices_closest]
+    return indices_closest, cos_similarities
+
+  def radius_search(self, query_hidden_repr, radius, use_transform=False, filters=None):
+    '''
+    finds all episodes within a cosine distance of the query. With a block bound index of the vector space (see
+    build_block_bound_index), blocks that cannot contain such episodes are skipped, otherwise the memory is scanned
+    :param query_hidden_repr: the query vector
+    :param radius: maximum cosine distance (1 - cos similarity)
+    :param use_transform: boolean that denotes whether the matching shall performed on transformed hidden vectors
+    :param filters: (optional) dict with predicates on metadata columns, see filter_mask
+    :return: memory indices and cos distances of the episodes within the radius, sorted by distance
+    '''
+    version = self.version
+    rows, similarities = self._radius_search(version, query_hidden_repr, radius, use_transform, filters)
+    order = np.argsort(-similarities, kind='mergesort')
+    self._record_recalls(rows, version)
+    return rows[order], 1.0 - similarities[order]
+
+  def any_within(self, query_hidden_repr, radius, use_transform=False, filters=None):
+    '''
+    early exit variant of radius_search, e.g. to check whether an episode is novel before storing it
+    :return: True if at least one episode is within a cosine distance of radius to the query
+    '''
+    rows, _ = self._radius_search(self.version, query_hidden_repr, radius, use_transform, filters, first_only=True)
+    return len(rows) > 0
 
-    query_hidden_repr = np.expand_dims(query_hidden_repr, axis=0)
+  def _radius_search(self, version, query_hidden_repr, radius, use_transform, filters, first_only=False,
+                     block_size=65536):
+    query_hidden_repr = np.ravel(query_hidden_repr)[None]
     if use_transform:
-      memory_hidden_reps = self.hidden_reps_transformed
-      query_hidden_repr = self.inter_class_pca.transform(query_hidden_repr)
+      memory_hidden_reps = version.matrices['hidden_reps_transformed_normed']
+      query_hidden_repr = version.inter_class_pca.transform(query_hidden_repr)
     else:
-      memory_hidden_reps = self.hidden_reps
-    assert memory_hidden_reps.ndim == 2 #memory_hidden_reps must have shape (n_episodes, n_dim_repr)
-    assert query_hidden_repr.ndim == 2 #query_hidden_repr must have shape (1, n_dim_repr)
-    assert memory_hidden_reps.shape[1] == query_hidden_repr.shape[1]
+      memory_hidden_reps = version.matrices['hidden_reps_normed']
+    query_hidden_repr = normalize_rows(query_hidden_repr)[0]
+    mask = self.filter_mask(filters, version=version) if filters else None
 
-    cos_distances = pairwise_distances(memory_hidden_reps, query_hidden_repr, metric='cosine')[:,0] #shape(n_episodes, 1)
-    # get indices of n maximum values in ndarray, reverse the list (highest is leftmost)
-    indices_closest = cos_distances.argsort()[:-n_closest_matches:-1]
+    index = version.indexes.get((BlockBoundIndex.name, use_transform))
+    if index is not None:
+      return index.radius_search(memory_hidden_reps, query_hidden_repr, 1.0 - radius, mask=mask, first_only=first_only)
 
-    relative_paths = self.video_paths.iloc[indices_closest]["video_file_path"].values
-    absolute_paths = [os.path.join(self.base_dir, path) for i, path in enumerate(relative_paths)]
+    # scan in blocks, any_within stops at the first block with a match
+    rows, similarities = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.float32)]
+    for start in range(0, memory_hidden_reps.shape[0], block_size):
+      block_similarities = np.dot(memory_hidden_reps[start:start + block_size], query_hidden_repr)
+      matches = block_similarities >= 1.0 - radius
+      if mask is not None:
+        matches &= mask[start:start + block_size]
+      if matches.any():
+        rows.append(start + np.flatnonzero(matches))
+        similarities.append(block_similarities[matches])
+        if first_only:
+          break
+    return np.concatenate(rows), np.concatenate(similarities)
 
-    return indices_closest, cos_distances[indices_closest], memory_hidden_reps[indices_closest], absolute_paths
+  def filter_mask(self, filters, n_episodes=None, version=None):
+    '''
+    evaluates filter predicates on metadata columns through inverted indexes (built on the first use of a column and
+    updated by store_episodes). Predicates on different columns are combined by AND
+    :param filters: dict mapping column names to a value, a list of accepted values or a callable that gets a value
+                    of the column and returns a boolean, e.g. {'category': ['a', 'b'], 'id': lambda id: '_9' in id}
+    :param n_episodes: (optional) number of rows of the mask, defaults to the rows of the version
+    :param version: (optional) MemoryVersion the mask refers to, defaults to the latest published version
+    :return: boolean array of shape (n_episodes,) with the selected episodes
+    '''
+    version = version or self.version
+    metadata_index = version.metadata_index
+    for column in filters:
+      if not metadata_index.is_indexed(column):
+        with self.write_lock:
+          if not self.metadata_index.is_indexed(column):
+            assert column in self.memory_df.columns, 'unknown metadata column: ' + str(column)
+            self.metadata_index.index_column(column, self.memory_df[column].values)
+          if not metadata_index.is_indexed(column):
+            # the version was pinned before an eviction renumbered the rows: the values are looked up by episode id
+            # in a copy of its index, episodes evicted since are not selected
+            values, id_to_row = self.memory_df[column].values, self.id_to_row
+            rows = [id_to_row.get(id, -1) for id in version.columns['ids']]
+            metadata_index = copy.copy(metadata_index)
+            metadata_index.postings = dict(metadata_index.postings)
+            metadata_index.index_column(column, [values[row] if row >= 0 else None for row in rows])
+    return metadata_index.select(filters, n_episodes if n_episodes is not None else version.n_episodes)
+
+  def enable_online_classifier(self, kind='ncm', batch_size=10000, **classifier_kwargs):
+    '''
+    fits an online classifier of the episode labels on the memory in batches. It is owned by the memory: stores update
+    it incrementally (partial_fit on the new episodes), evictions remove the evicted episodes (nearest class mean only),
+    it is refitted when the embeddings are swapped and dumped with the bundle. composite_match_batch uses it by default
+    :param kind: 'ncm' (streaming nearest class mean, exact under stores and evictions) or 'sgd' (multinomial
+                 logistic regression trained with SGD), see core.online_classifier
+    :param batch_size: number of episodes per partial_fit call of the initial fit
+    :param classifier_kwargs: keyword arguments of the classifier, e.g. temperature for 'ncm' or alpha / eta0 for 'sgd'
+    :return: the fitted classifier
+    '''
+    assert kind in ONLINE_CLASSIFIERS, 'kind must be one of ' + str(list(ONLINE_CLASSIFIERS))
+    with self._writing():
+      self.reproject()
+      classifier = ONLINE_CLASSIFIERS[kind](**classifier_kwargs)
+      hidden_reps, labels = self._live_matrix('hidden_reps'), self._label_values.array
+      for start in range(0, hidden_reps.shape[0], batch_size):
+        classifier.partial_fit(hidden_reps[start:start + batch_size], labels[start:start + batch_size])
+      self.classifier = classifier
+      self.classifier_builder = functools.partial(self.enable_online_classifier, kind=kind, batch_size=batch_size,
+                                                  **classifier_kwargs)
+      self.invalidate_query_cache()
+    return classifier
+
+  def disable_online_classifier(self):
+    ''' composite_match_batch then requires a classifier argument again '''
+    with self._writing():
+      self.classifier, self.classifier_builder = None, None
+
+  def composite_match_batch(self, query_hidden_reprs, classifier=None, classifier_pca=None, lambda_weight=0.5,
+                            n_closest_matches=5, use_transform=False, batch_size=1024):
+    '''
+    finds the closest matches of a batch of queries by the composite score (1 - lambda_weight) * p(label of episode |
+    query) + lambda_weight * cos_similarity(episode, query). The class probabilities of all queries are computed
+    with one predict_proba call, the scores are computed block-wise, see composite_top_k
+    :param query_hidden_reprs: the query vectors, shape (n_queries, n_dim_repr)
+    :param classifier: (optional) fitted classifier with predict_proba and classes_ (e.g. sklearn LogisticRegression),
+                       defaults to the online classifier of the version the queries are matched against (see
+                       enable_online_classifier), so that composite matching never waits for a retrain
+    :param classifier_pca: (optional) fitted PCA the queries are transformed with before they are classified
+    :param lambda_weight: weight of the cos similarity, 1 - lambda_weight is the weight of the class probability
+    :param n_closest_matches: (optional) the number of closest matches returned per query, defaults to 5
+    :param use_transform: boolean that denotes whether the cos similarities are computed on transformed hidden vectors
+    :param batch_size: (optional) number of queries that are scored at once, bounds the size of the score matrix
+    :return: three objects, containing:
+          1. array of shape (n_queries, n_closest_matches) with the memory indices of the closest matches
+          2. array of shape (n_queries, n_closest_matches) with the corresponding composite scores
+          3. list with one list of absolute paths to the matched memory episodes per query
+    '''
+    query_hidden_reprs = np.asarray(query_hidden_reprs)
+    query_hidden_reprs = query_hidden_reprs.reshape(query_hidden_reprs.shape[0], -1)
+    version = self.version
+    if classifier is None:
+      assert version.classifier is not None, 'no classifier given and no online classifier enabled, see enable_online_classifier'
+      classifier = version.classifier
+    classifier_input = classifier_pca.transform(query_hidden_reprs) if classifier_pca is not None else query_hidden_reprs
+    class_probs = classifier.predict_proba(classifier_input)
+
+    if use_transform:
+      memory_hidden_reps = version.matrices['hidden_reps_transformed_normed']
+      query_hidden_reprs = version.inter_class_pca.transform(query_hidden_reprs)
+    else:
+      memory_hidden_reps = version.matrices['hidden_reps_normed']
 
+    label_codes = class_label_codes(version.columns['labels'], classifier.classes_)
+    indices_closest, composite_scores = composite_top_k(memory_hidden_reps, label_codes, class_probs,
+                                                        normalize_rows(query_hidden_reprs), n_closest_matches,
+                                                        lambda_weight=lambda_weight, batch_size=batch_size)
+    self._record_recalls(indices_closest, version)
+    return indices_closest, composite_scores, \
+           [self.absolute_video_paths(indices, version) for indices in indices_closest]
+
+  def select_index(self, backend, use_transform, version=None):
+    '''
+    :param backend: 'exact', the name of a built index or None for the default backend
+    :param use_transform: boolean that denotes whether the matching shall performed on transformed hidden vectors
+    :param version: (optional) MemoryVersion whose indexes are used, defaults to the latest published version
+    :return: the index object or None if the exact scan shall be used. The default backend falls back to the exact scan
+    if it has not been built for the requested vector space
+    '''
+    version = version or self.version
+    if backend is None:
+      return version.indexes.get((version.default_backend, use_transform))
+    if backend == 'exact':
+      return None
+    assert (backend, use_transform) in version.indexes, "no '%s' index built for use_transform=%s" % (backend, use_transform)
+    return version.indexes[(backend, use_transform)]
+
+  def add_index(self, index, use_transform=False, set_default=True, builder=None):
+    '''
+    registers an index as matching backend under its name
+    :param index: index object (e.g. IVFIndex, HNSWIndex) that contains all episodes of the memory
+    :param use_transform: boolean that denotes whether the index was built on the transformed hidden vectors
+    :param set_default: if True, matching and match_batch use the index unless another backend is requested
+    :param builder: (optional) callable that builds and registers the index from scratch, used by rebuild_indexes
+    :return: the index object
+    '''
+    with self._writing():
+      # episodes that were stored while the index was built
+      rows = np.arange(index.ntotal, self._ids.size)
+      if len(rows) > 0:
+        self._add_to_index(index, rows, use_transform)
+      self.indexes = dict(self.indexes)
+      self.indexes[(index.name, use_transform)] = index
+      if builder is not None:
+        self.index_builders[(index.name, use_transform)] = builder
+      if set_default:
+        self.default_backend = index.name
+    self.invalidate_query_cache()
+    return index
+
+  def rebuild_indexes(self):
+    '''
+    rebuilds all indexes that were built by the build_*_index methods from scratch (e.g. retrains the k-means of IVF
+    indexes after many episodes were stored). Stores are blocked during the rebuild, queries keep using the old index
+    objects until the rebuilt ones are registered
+    '''
+    with self._writing():
+      for builder in list(self.index_builders.values()):
+        builder()
+
+  def build_ivf_index(self, n_clusters=None, nprobe=8, use_transform=False, set_default=True, seed=None):
+    '''
+    trains an inverted file index (k-means coarse quantizer) on the memory and assigns all episodes to it
+    :param n_clusters: (optional) number of inverted lists, defaults to 4 * sqrt(n_episodes)
+    :param nprobe: number of lists scored per query, trades recall for latency (can be changed on the index later)
+    :param use_transform: boolean that denotes whether the index is built on the transformed hidden vectors
+    :param set_default: if True, matching and match_batch use the index instead of the exact scan
+    :param seed: random seed of the k-means
+    :return: the IVFIndex object
+    '''
+    memory_hidden_reps = self._live_matrix('hidden_reps_transformed_normed' if use_transform else 'hidden_reps_normed')
+    index = IVFIndex(n_clusters=n_clusters or int(4 * np.sqrt(memory_hidden_reps.shape[0])), nprobe=nprobe, seed=seed)
+    index.train(memory_hidden_reps)
+    index.add(memory_hidden_reps, np.arange(memory_hidden_reps.shape[0]))
+    builder = functools.partial(self.build_ivf_index, n_clusters=n_clusters, nprobe=nprobe, use_transform=use_transform,
+                                set_default=False, seed=seed)
+    return self.add_index(index, use_transform=use_transform, set_default=set_default, builder=builder)
+
+  def build_class_routing_index(self, n_route=3, use_transform=False, set_default=True):
+    '''
+    routes queries over the class centroids of the memory labels, only the episodes of the n_route closest classes
+    are scored by cosine similarity
+    :param n_route: number of classes scored per query, trades recall for latency (can be changed on the index later)
+    :param use_transform: boolean that denotes whether the index is built on the transformed hidden vectors
+    :param set_default: if True, matching and match_batch use the index unless another backend is requested
+    :return: the ClassRoutingIndex object
+    '''
+    memory_hidden_reps = self._live_matrix('hidden_reps_transformed_normed' if use_transform else 'hidden_reps_normed')
+    index = ClassRoutingIndex(n_route=n_route)
+    index.add(memory_hidden_reps, np.arange(memory_hidden_reps.shape[0]), self._label_values.array)
+    builder = functools.partial(self.build_class_routing_index, n_route=n_route, use_transform=use_transform,
+                                set_default=False)
+    return self.add_index(index, use_transform=use_transform, set_default=set_default, builder=builder)
+
+  def build_hnsw_index(self, M=16, ef_construction=100, ef_search=50, use_transform=False, set_default=True, seed=None,
+                       dump_path=None, max_deleted_fraction=0.1):
+    '''
+    inserts all episodes of the memory into a hierarchical navigable small world graph
+    :param M: number of neighbours per node (2 * M on the bottom layer)
+    :param ef_construction: size of the candidate list while inserting, higher values give a better graph
+    :param ef_search: size of the candidate list while searching, trades recall for latency (can be changed on the index later)
+    :param use_transform: boolean that denotes whether the index is built on the transformed hidden vectors
+    :param set_default: if True, matching and match_batch use the index unless another backend is requested
+    :param seed: random seed for drawing the node levels
+    :param dump_path: if provided, the index object is dumped to the provided path (e.g. next to the memory pickle)
+    :param max_deleted_fraction: fraction of evicted (deleted) nodes above which their neighbours are relinked
+    :return: the HNSWIndex object
+    '''
+    memory_hidden_reps = self._live_matrix('hidden_reps_transformed_normed' if use_transform else 'hidden_reps_normed')
+    index = HNSWIndex(M=M, ef_construction=ef_construction, ef_search=ef_search,
+                      max_deleted_fraction=max_deleted_fraction, seed=seed)
+    index.add(memory_hidden_reps, np.arange(memory_hidden_reps.shape[0]))
+    if dump_path:
+      joblib.dump(index, dump_path)
+    builder = functools.partial(self.build_hnsw_index, M=M, ef_construction=ef_construction, ef_search=ef_search,
+                                use_transform=use_transform, set_default=False, seed=seed,
+                                max_deleted_fraction=max_deleted_fraction)
+    return self.add_index(index, use_transform=use_transform, set_default=set_default, builder=builder)
+
+  def build_quantized_index(self, codec='int8', n_rerank=100, use_transform=False, set_default=True, **codec_kwargs):
+    '''
+    encodes the memory in a compressed form ('float16', per-dimension 'int8' or product quantization 'pq') that is
+    scanned for candidates, the n_rerank best candidates are rescored exactly in float32
+    :param codec: name of the codec, one of core.quantization.CODECS
+    :param n_rerank: number of candidates per query that are rescored exactly
+    :param use_transform: boolean that denotes whether the index is built on the transformed hidden vectors
+    :param set_default: if True, matching and match_batch use the index unless another backend is requested
+    :param codec_kwargs: passed to the codec, e.g. n_subspaces for 'pq'
+    :return: the QuantizedIndex object, registered under the codec name as backend
+    '''
+    assert codec in CODECS, 'codec must be one of ' + str(list(CODECS.keys()))
+    memory_hidden_reps = self._live_matrix('hidden_reps_transformed_normed' if use_transform else 'hidden_reps_normed')
+    index = QuantizedIndex(CODECS[codec](**codec_kwargs), n_rerank=n_rerank)
+    index.train(memory_hidden_reps)
+    index.add(memory_hidden_reps, np.arange(memory_hidden_reps.shape[0]))
+    builder = functools.partial(self.build_quantized_index, codec=codec, n_rerank=n_rerank, use_transform=use_transform,
+                                set_default=False, **codec_kwargs)
+    return self.add_index(index, use_transform=use_transform, set_default=set_default, builder=builder)
+
+  def build_cascade_index(self, n_candidates=100, n_components=None, set_default=True):
+    '''
+    two-stage retrieval: the top n_candidates are retrieved in the space of the leading inter class PCA components and
+    reranked on the full dimensional hidden_reps
+    :param n_candidates: number of candidates per query that are reranked on the full vectors
+    :param n_components: (optional) number of leading inter class PCA components used for candidate generation,
+                         defaults to all components of self.inter_class_pca
+    :param set_default: if True, matching and match_batch use the index unless another backend is requested
+    :return: the CascadeIndex object
+    '''
+    index = CascadeIndex(self.inter_class_pca, n_components=n_components, n_candidates=n_candidates)
+    self._add_to_index(index, np.arange(self._ids.size), use_transform=False)
+    builder = functools.partial(self.build_cascade_index, n_candidates=n_candidates, n_components=n_components, set_default=False)
+    return self.add_index(index, use_transform=False, set_default=set_default, builder=builder)
+
+  def build_binary_index(self, n_bits=256, method='srp', n_candidates=200, use_transform=False, set_default=True, seed=None):
+    '''
+    encodes the memory as packed binary codes (sign random projection or ITQ) that serve as Hamming prefilter before
+    the cosine scoring
+    :param n_bits: code length, a multiple of 64 (e.g. 64 to 512) - trades memory and scan time for recall
+    :param method: 'srp' or 'itq'
+    :param n_candidates: number of Hamming nearest candidates per query that are rescored by cosine similarity
+    :param use_transform: boolean that denotes whether the index is built on the transformed hidden vectors
+    :param set_default: if True, matching and match_batch use the index unless another backend is requested
+    :param seed: random seed for the projections / rotation
+    :return: the BinaryCodeIndex object
+    '''
+    memory_hidden_reps = self._live_matrix('hidden_reps_transformed_normed' if use_transform else 'hidden_reps_normed')
+    index = BinaryCodeIndex(n_bits=n_bits, method=method, n_candidates=n_candidates, seed=seed)
+    index.train(memory_hidden_reps)
+    index.add(memory_hidden_reps, np.arange(memory_hidden_reps.shape[0]))
+    builder = functools.partial(self.build_binary_index, n_bits=n_bits, method=method, n_candidates=n_candidates,
+                                use_transform=use_transform, set_default=False, seed=seed)
+    return self.add_index(index, use_transform=use_transform, set_default=set_default, builder=builder)
+
+  def build_block_bound_index(self, block_size=256, use_transform=False, set_default=False, seed=None):
+    '''
+    partitions the memory into k-means blocks with centroid / angular radius bounds, used by radius_search and
+    any_within to skip blocks. As matching backend it gives exact top-k results
+    :param block_size: average number of episodes per block
+    :param use_transform: boolean that denotes whether the index is built on the transformed hidden vectors
+    :param set_default: if True, matching and match_batch use the index unless another backend is requested
+    :param seed: random seed of the k-means
+    :return: the BlockBoundIndex object
+    '''
+    memory_hidden_reps = self._live_matrix('hidden_reps_transformed_normed' if use_transform else 'hidden_reps_normed')
+    index = BlockBoundIndex(block_size=block_size, seed=seed)
+    index.train(memory_hidden_reps)
+    index.add(memory_hidden_reps, np.arange(memory_hidden_reps.shape[0]))
+    builder = functools.partial(self.build_block_bound_index, block_size=block_size, use_transform=use_transform,
+                                set_default=False, seed=seed)
+    return self.add_index(index, use_transform=use_transform, set_default=set_default, builder=builder)
+
+  def memory_footprint(self):
+    '''
+    :return: dict with the resident size in bytes of the vector matrices and of the compressed codes of quantized indexes
+    '''
+    footprint = dict([(name, self._live_matrix(name).nbytes) for name in BUNDLE_MATRICES])
+    for (backend, use_transform), index in self.indexes.items():
+      if hasattr(index, 'nbytes'):
+        footprint['%s_codes%s' % (backend, '_transformed' if use_transform else '')] = index.nbytes
+    return footprint
+
+  def load_index(self, index_path, use_transform=False, set_default=True):
+    '''
+    loads a previously dumped index (that was built on this memory) and registers it as matching backend
+    :param index_path: path to the dumped index object
+    :param use_transform: boolean that denotes whether the index was built on the transformed hidden vectors
+    :param set_default: if True, matching and match_batch use the index unless another backend is requested
+    :return: the index object
+    '''
+    assert os.path.isfile(index_path)
+    index = joblib.load(index_path)
+    assert index.ntotal == self.hidden_reps.shape[0], 'index does not match the number of episodes in the memory'
+    return self.add_index(index, use_transform=use_transform, set_default=set_default)
+
+  def recall_at_k(self, query_hidden_reprs, n_closest_matches=5, use_transform=False, backend=None):
+    '''
+    measures how many of the exact closest matches are found by an (approximate) backend
+    :param query_hidden_reprs: the query vectors, shape (n_queries, n_dim_repr)
+    :param n_closest_matches: k of recall@k
+    :param use_transform: boolean that denotes whether the matching shall performed on transformed hidden vectors
+    :param backend: (optional) the backend to evaluate, defaults to self.default_backend
+    :return: recall@k averaged over the queries, between 0 and 1
+    '''
+    indices_approx, _, _ = self.match_batch(query_hidden_reprs, n_closest_matches, use_transform=use_transform, backend=backend)
+    indices_exact, _, _ = self.match_batch(query_hidden_reprs, n_closest_matches, use_transform=use_transform, backend='exact')
+    return np.mean([len(np.intersect1d(a, e)) / float(len(e)) for a, e in zip(indices_approx, indices_exact)])
+
+  def absolute_video_paths(self, indices, version=None):
+    '''
+    :param indices: memory indices of episodes
+    :param version: (optional) MemoryVersion the indices refer to, defaults to the latest published version
+    :return: list with the absolute paths to the episodes in the base directory of the memory, None for latent-only
+             episodes (see recall_frames)
+    '''
+    relative_paths = (version or self.version).columns['video_paths'][indices]
+    return [None if path is None else os.path.join(self.base_dir, path) for path in relative_paths]
+
+  def episode_video_paths(self, ids):
+    '''
+    :param ids: episode ids
+    :return: list with the absolute paths of the videos of the episodes, None for latent-only episodes and ids that are
+             not in the memory
+    '''
+    with self.write_lock:
+      id_to_row, video_paths = self.id_to_row, self._video_path_values.array
+      relative_paths = [video_paths[id_to_row[id]] if id in id_to_row else None for id in ids]
+    return [None if path is None else os.path.join(self.base_dir, path) for path in relative_paths]
+
+
+def write_memory_bundle(memory_pickle_path, bundle_dir, base_dir='', label_col="category", video_path_col="video_file_path",
+                        inter_class_pca_path=None):
+  '''
+  converts a memory dataframe pickle (e.g. metadata_and_hidden_rep_df_*.pickle from the memory_prep valid mode) into
+  a bundle directory that can be loaded with Memory.load
+  :param memory_pickle_path: path to the pickled memory dataframe
+  :param bundle_dir: path to the bundle directory
+  :param base_dir: base directory of the episode videos that is stored in the bundle
+  :param label_col: specifies the label column name within the df
+  :param video_path_col: specifies the video path column name within the df
+  :param inter_class_pca_path: (optional) path to a previously trained PCA, otherwise the PCA is fitted
+  :return: the Memory object
+  '''
+  memory = Memory(pd.read_pickle(memory_pickle_path), base_dir, label_col=label_col, video_path_col=video_path_col,
+                  inter_class_pca_path=inter_class_pca_path, check_sanity=False)
+  memory.dump_bundle(bundle_dir)
+  return memory
+
+def near_duplicate_representatives(hidden_reps_normed, threshold, labels=None, batch_size=1024):
+  '''
+  greedy near-duplicate grouping in row order: every row becomes an alias of the most similar earlier representative
+  with cosine similarity >= threshold (and the same label, if labels are provided) or a representative itself.
+  Rows are scored against the representatives block-wise, within a block against the new representatives of the block
+  :param hidden_reps_normed: unit length vectors, shape (n, n_dim)
+  :param threshold: cosine similarity threshold
+  :param labels: (optional) label of every row, only rows with the same label are grouped
+  :return: int array of shape (n,) with the row of the representative of every row (the row itself for representatives)
+  '''
+  n = hidden_reps_normed.shape[0]
+  label_codes = np.unique(np.asarray(labels).astype(str), return_inverse=True)[1] if labels is not None else np.zeros(n, dtype=np.int64)
+  representatives = np.arange(n)
+  representative_rows = GrowableArray(np.empty(0, dtype=np.int64))
+  for start in range(0, n, batch_size):
+    block = np.arange(start, min(start + batch_size, n))
+    # earlier blocks
+    rows = representative_rows.array
+    if len(rows) > 0:
+      similarities = np.dot(hidden_reps_normed[block], hidden_reps_normed[rows].T)
+      similarities[label_codes[block][:, None] != label_codes[rows][None, :]] = -np.inf
+      best = np.argmax(similarities, axis=1)
+      duplicates = similarities[np.arange(len(block)), best] >= threshold
+      representatives[block[duplicates]] = rows[best[duplicates]]
+      block = block[~duplicates]
+
+    # within the block, in row order
+    similarities = np.dot(hidden_reps_normed[block], hidden_reps_normed[block].T)
+    similarities[label_codes[block][:, None] != label_codes[block][None, :]] = -np.inf
+    is_representative = np.zeros(len(block), dtype=bool)
+    for i in range(len(block)):
+      candidates = np.flatnonzero(is_representative[:i] & (similarities[i, :i] >= threshold))
+      if len(candidates) > 0:
+        representatives[block[i]] = block[candidates[np.argmax(similarities[i, candidates])]]
+      else:
+        is_representative[i] = True
+    representative_rows.append(block[is_representative])
+  return representatives
+
+def consolidate_memory_pickle(memory_pickle_path, output_path, threshold=0.98, label_col="category", batch_size=1024):
+  '''
+  offline near-duplicate consolidation of a memory dataframe pickle (e.g. metadata_and_hidden_rep_df_*.pickle with
+  augmented copies of the episodes): only the representatives are kept, with an 'aliases' column (ids of the merged
+  episodes, read by Memory) and a 'duplicate_count' column
+  :param memory_pickle_path: path to the pickled memory dataframe
+  :param output_path: path of the consolidated dataframe pickle
+  :param threshold: cosine similarity threshold, only episodes with the same label are merged
+  :param label_col: specifies the label column name within the df
+  :return: the consolidated dataframe
+  '''
+  memory_df = pd.read_pickle(memory_pickle_path)
+  hidden_reps_normed = normalize_rows(np.stack([h.flatten() for h in memory_df['hidden_repr']]))
+  representatives = near_duplicate_representatives(hidden_reps_normed, threshold, memory_df[label_col].values,
+                                                   batch_size=batch_size)
+  ids = memory_df['id'].values
+  aliases = collections.defaultdict(list)
+  for row in np.flatnonzero(representatives != np.arange(len(representatives))):
+    aliases[representatives[row]].append(ids[row])
+
+  consolidated_df = memory_df[representatives == np.arange(len(representatives))].copy()
+  consolidated_df['aliases'] = [aliases.get(row, []) for row in np.flatnonzero(representatives == np.arange(len(representatives)))]
+  consolidated_df['duplicate_count'] = [1 + len(a) for a in consolidated_df['aliases']]
+  consolidated_df = consolidated_df.reset_index(drop=True)
+  consolidated_df.to_pickle(output_path)
+  print("Consolidated %i of %i episodes into %i representatives, dumped to %s" % (
+    len(memory_df) - len(consolidated_df), len(memory_df), len(consolidated_df), output_path))
+  return consolidated_df
 
 def mean_vectors_of_classes(hidden_reps, labels):
   """
@@ -116,6 +1724,54 @@ def mean_vectors_of_classes(hidden_reps, labels):
   return pd.DataFrame.from_dict(dict([(label, np.mean(vectors, axis=0)) for label, vectors in vector_dict.items()]),
                                 orient='index')
 
+def class_label_codes(labels, classes):
+  '''
+  :param labels: label of every memory row
+  :param classes: class labels of a classifier (classes_)
+  :return: int array with the index of every label in classes, -1 for labels that are not in classes
+  '''
+  return np.asarray(pd.Index(classes).get_indexer(np.asarray(labels)), dtype=np.int64)
+
+def composite_top_k(memory_hidden_reps, label_codes, class_probs, query_hidden_reprs, n_closest_matches,
+                    lambda_weight=0.5, batch_size=1024):
+  '''
+  top k of the composite scores (1 - lambda_weight) * class_probs[query, label of row] + lambda_weight * cos_similarity
+  of every query with every memory row, computed block-wise as one matrix product plus a gather of the class probabilities
+  :param memory_hidden_reps: normalized memory vectors, shape (n_episodes, n_dim)
+  :param label_codes: index of the label of every memory row in the classifier classes, -1 for unknown labels (p = 0)
+  :param class_probs: class probabilities of the queries, shape (n_queries, n_classes)
+  :param query_hidden_reprs: normalized query vectors, shape (n_queries, n_dim)
+  :return: memory indices and composite scores of the n_closest_matches per query, shape (n_queries, n_closest_matches)
+  '''
+  n_closest_matches = min(n_closest_matches, memory_hidden_reps.shape[0])
+  # unknown labels point to an appended column of zeros
+  class_probs = np.hstack([class_probs, np.zeros((class_probs.shape[0], 1))]).astype(np.float32)
+  label_codes = np.where(label_codes < 0, class_probs.shape[1] - 1, label_codes)
+
+  indices_closest = np.empty((query_hidden_reprs.shape[0], n_closest_matches), dtype=np.int64)
+  composite_scores = np.empty((query_hidden_reprs.shape[0], n_closest_matches), dtype=np.float32)
+  for start in range(0, query_hidden_reprs.shape[0], batch_size):
+    block = slice(start, start + batch_size)
+    scores = np.dot(query_hidden_reprs[block], memory_hidden_reps.T)
+    scores *= lambda_weight
+    scores += (1 - lambda_weight) * class_probs[block].take(label_codes, axis=1)
+    indices_closest[block] = top_k_indices(scores, n_closest_matches)
+    composite_scores[block] = scores[np.arange(scores.shape[0])[:, None], indices_closest[block]]
+  return indices_closest, composite_scores
+
+def pca_basis_change(pca_a, pca_b):
+  '''
+  measures how much the projection of two fitted PCAs differs: the distance between the spanned subspaces
+  (0 for identical, 1 for orthogonal subspaces) plus the shift of the means relative to the standard deviation
+  captured by pca_a
+  :return: scalar >= 0
+  '''
+  n_components = min(pca_a.components_.shape[0], pca_b.components_.shape[0])
+  overlap = np.sum(np.dot(pca_a.components_, pca_b.components_.T) ** 2)
+  subspace_distance = np.sqrt(max(0.0, 1.0 - overlap / float(n_components)))
+  mean_shift = np.linalg.norm(pca_a.mean_ - pca_b.mean_) / np.sqrt(np.sum(pca_a.explained_variance_))
+  return subspace_distance + mean_shift
+
 def fit_inter_class_pca(hidden_reps, labels, n_components=50, verbose=False, dump_path=None):
   '''
   Fits a PCA on mean vectors of classes denoted by self.labels
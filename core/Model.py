@@ -1,4 +1,5 @@
 import tensorflow as tf
+from tensorflow.contrib.layers.python import layers as tf_layers
 import math
 import numpy as np
 from pprint import pprint
@@ -144,7 +145,7 @@ class ValidationModel(Model):
 
 
 class FeedingValidationModel(Model):
-  def __init__(self, scope_name='feeding_model', reuse_scope=None):
+  def __init__(self, scope_name='feeding_model', reuse_scope=None, batch_size=1):
     print("Constructing FeedingModel")
     with tf.variable_scope(scope_name, reuse=None):
       Model.__init__(self)
@@ -153,13 +154,108 @@ class FeedingValidationModel(Model):
 
       with tf.variable_scope(reuse_scope, reuse=True):
         "5D array of batch with videos - shape(batch_size, num_frames, frame_width, frame_higth, num_channels)"
-        self.feed_batch = tf.placeholder(tf.float32, shape=(1, FLAGS.encoder_length, FLAGS.height, FLAGS.width, FLAGS.num_channels), name='feed_batch')
+        self.feed_batch = tf.placeholder(tf.float32, shape=(batch_size, FLAGS.encoder_length, FLAGS.height, FLAGS.width, FLAGS.num_channels), name='feed_batch')
 
         self.frames_pred, self.frames_reconst, self.hidden_repr = \
           tower_operations(self.feed_batch[:, FLAGS.image_range_start:, :, :, :], train=False, compute_loss=False)
 
 
 
+class DecoderModel(Model):
+  def __init__(self, hidden_repr_shape, scope_name='decoder_model', reuse_scope=None):
+    """
+    decoder-only graph that regenerates frames from latent vectors that are fed through the hidden_repr_batch placeholder
+    (e.g. hidden_reps stored in a memory), the decoder weights are shared with the (trained) model in reuse_scope
+    :param hidden_repr_shape: shape of a single hidden_repr as produced by the encoder (without batch dimension)
+    """
+    print("Constructing DecoderModel")
+    with tf.variable_scope(scope_name, reuse=None):
+      Model.__init__(self)
+
+      assert reuse_scope is not None
+
+      with tf.variable_scope(reuse_scope, reuse=True):
+        self.hidden_repr_shape = tuple(hidden_repr_shape)
+        self.hidden_repr_batch = tf.placeholder(tf.float32, shape=(None,) + self.hidden_repr_shape, name='hidden_repr_batch')
+
+        self.frames_pred, self.frames_reconst = decoder_operations(self.hidden_repr_batch)
+
+
+class LatentEncoder:
+  def __init__(self, sess, feeding_model):
+    """
+    encodes batches of clips into flattened latent vectors with the weights of a restored session, e.g. to re-embed
+    the episodes of a memory after retraining (see core.reembedding)
+    :param sess: tf session with the restored model variables (e.g. Initializer.sess)
+    :param feeding_model: FeedingValidationModel of the graph of sess, larger batch sizes amortize the session calls
+    """
+    self.sess = sess
+    self.feeding_model = feeding_model
+    self.batch_size = feeding_model.feed_batch.get_shape().as_list()[0]
+
+  def encode(self, clips):
+    """
+    :param clips: uint8 array of shape (n_clips, n_frames, frame_height, frame_width, num_channels) (or list of clips)
+                  in the channel order of the training data, the first encoder_length frames are encoded
+    :return: float32 array of shape (n_clips, hidden_repr_size)
+    """
+    clips = np.stack([np.asarray(clip[:FLAGS.encoder_length], dtype=np.float32) for clip in clips])
+    assert clips.shape[1:] == (FLAGS.encoder_length, FLAGS.height, FLAGS.width, FLAGS.num_channels), \
+      "clips must have shape (n_clips, encoder_length, height, width, num_channels)"
+    hidden_reps = []
+    for start in range(0, clips.shape[0], self.batch_size):
+      batch = clips[start:start + self.batch_size]
+      n_clips = batch.shape[0]
+      if n_clips < self.batch_size: # the placeholder has a fixed batch size
+        batch = np.concatenate([batch, np.zeros((self.batch_size - n_clips,) + batch.shape[1:], dtype=np.float32)])
+      feed_dict = {self.feeding_model.learning_rate: 0.0, self.feeding_model.feed_batch: batch}
+      hidden_repr = self.sess.run(self.feeding_model.hidden_repr, feed_dict)
+      hidden_reps.append(np.reshape(hidden_repr, (self.batch_size, -1))[:n_clips])
+    return np.concatenate(hidden_reps).astype(np.float32)
+
+
+class LatentDecoder:
+  def __init__(self, sess, decoder_model):
+    """
+    decodes batches of (flattened) latent vectors into clips with the weights of a restored session
+    :param sess: tf session with the restored model variables (e.g. Initializer.sess)
+    :param decoder_model: DecoderModel of the graph of sess
+    """
+    self.sess = sess
+    self.decoder_model = decoder_model
+    self.outputs = {'reconst': decoder_model.frames_reconst, 'future': decoder_model.frames_pred}
+
+  def decode(self, hidden_reps, kind='reconst'):
+    """
+    :param hidden_reps: array of shape (batch_size, hidden_repr_size) or (batch_size,) + hidden_repr_shape
+    :param kind: 'reconst' for the reconstruction of the encoded frames, 'future' for the predicted frames
+    :return: uint8 array of shape (batch_size, num_frames, frame_height, frame_width, num_channels), in the channel
+             order of the training videos, like the frames read from the episode videos or a FrameStore (the clips
+             written by io_handler keep the channel order of the model output as well)
+    """
+    assert kind in self.outputs, 'kind must be one of ' + str(list(self.outputs))
+    hidden_reps = np.reshape(hidden_reps, (-1,) + self.decoder_model.hidden_repr_shape)
+    frames = self.sess.run(self.outputs[kind], feed_dict={self.decoder_model.hidden_repr_batch: hidden_reps})
+    return np.clip(np.stack(frames, axis=1), 0, 255).astype(np.uint8)
+
+
+def decoder_operations(hidden_repr_batch):
+  """
+  Build the decoder part of the computation graph on a batch of latent representations
+  :param hidden_repr_batch: Tensor of latent space representations, e.g. a placeholder
+  :return frames_pred, frames_reconst: lists of generated frames (Tensors) of shape (batch_size, h, w, num_channels)
+  """
+  initializer = tf_layers.xavier_initializer(uniform=FLAGS.uniform_init)
+  decoder_kwargs = {'num_channels': FLAGS.num_channels, 'fc_conv_layer': FLAGS.fc_layer}
+  if 'keep_prob_dropout' in model.decoder_model.__code__.co_varnames:
+    decoder_kwargs['keep_prob_dropout'] = 1.0
+  frames_pred = model.decoder_model(hidden_repr_batch, FLAGS.decoder_future_length, initializer,
+                                    scope='decoder_pred', **decoder_kwargs)
+  frames_reconst = model.decoder_model(hidden_repr_batch, FLAGS.decoder_reconst_length, initializer,
+                                       scope='decoder_reconst', **decoder_kwargs)
+  return frames_pred, frames_reconst
+
+
 def tower_operations(video_batch, train=True, compute_loss=True, use_vae_mu=True):
   """
   Build the computation graph from input frame sequences till loss of batch
@@ -262,7 +358,7 @@ def average_losses(tower_losses):
   return loss
 
 
-def create_model(mode=None, train_model_scope=None):
+def create_model(mode=None, train_model_scope=None, hidden_repr_shape=None, feed_batch_size=1):
   model = None
 
   if mode is "train":
@@ -272,7 +368,11 @@ def create_model(mode=None, train_model_scope=None):
     model = ValidationModel('valid', reuse_scope=train_model_scope)
   elif mode is 'feeding':
     assert train_model_scope is not None, "train_model_scope is None, valid mode requires a train scope"
-    model = FeedingValidationModel(reuse_scope=train_model_scope)
+    model = FeedingValidationModel(reuse_scope=train_model_scope, batch_size=feed_batch_size)
+  elif mode is 'decoding':
+    assert train_model_scope is not None, "train_model_scope is None, decoding mode requires a train scope"
+    assert hidden_repr_shape is not None, "decoding mode requires the shape of the hidden_repr"
+    model = DecoderModel(hidden_repr_shape, reuse_scope=train_model_scope)
 
   assert model is not None
 
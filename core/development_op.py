@@ -9,6 +9,7 @@ import data_postp.similarity_computations as similarity_computations
 import utils.helpers as helpers
 from core.Model import *
 from data_prep.TFRW2Images import createGif
+from core.frame_store import FrameStore
 from utils.io_handler import create_subfolder, store_output_frames_as_gif, store_latent_vectors_as_df, \
   store_encoder_latent_vector, file_paths_from_directory, write_file_with_append, bgr_to_rgb
 
@@ -130,6 +131,12 @@ def validate(output_dir, initializer, val_model):
     if 'memory_prep' in FLAGS.valid_mode:
       # evaluate multiple batches to cover all available validation samples
       video_file_path = []
+      # with 'frame_store' the original frames are appended to one frame store (keyed by episode id) instead of a gif
+      # per episode, see Memory.attach_frame_store
+      frame_store = FrameStore(os.path.join(output_dir, 'frame_store')) if 'frame_store' in FLAGS.valid_mode else None
+      if frame_store is not None:
+        # the first batch was evaluated before the loop
+        frame_store.append([l.decode('utf-8') for l in labels], np.asarray(orig_frames)[:, :, :, :, :3].astype(np.uint8))
 
       for i in range(num_val_batches_required):
         hidden_representations_new, labels_new, metadata_new, orig_frames = initializer.sess.run(
@@ -139,9 +146,16 @@ def validate(output_dir, initializer, val_model):
         hidden_representations = np.concatenate((hidden_representations, hidden_representations_new))
         labels = np.concatenate((labels, labels_new))
         metadata = np.concatenate((metadata, metadata_new))
-        createGif(np.asarray(orig_frames)[:,:,:, :, :3], labels, output_dir)
-
-      store_latent_vectors_as_df(output_dir, hidden_representations, labels, metadata, video_file_paths=np.asarray(video_file_path))
+        if frame_store is not None:
+          frame_store.append([l.decode('utf-8') for l in labels_new], np.asarray(orig_frames)[:, :, :, :, :3].astype(np.uint8))
+        elif 'latent_only' not in FLAGS.valid_mode:
+          createGif(np.asarray(orig_frames)[:,:,:, :, :3], labels, output_dir)
+
+      # latent-only memories keep no video per episode, frames are regenerated by the decoder (see Memory.recall_frames)
+      video_file_paths = None if 'latent_only' in FLAGS.valid_mode or frame_store is not None else np.asarray(video_file_path)
+      model_fingerprint = helpers.checkpoint_fingerprint(FLAGS.pretrained_model) if FLAGS.pretrained_model else None
+      store_latent_vectors_as_df(output_dir, hidden_representations, labels, metadata, video_file_paths=video_file_paths,
+                                 model_fingerprint=model_fingerprint)
 
     if 'data_frame' in FLAGS.valid_mode:
       print(np.shape(hidden_representations))
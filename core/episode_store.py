@@ -0,0 +1,367 @@
+import os, json, shutil, threading
+import numpy as np
+import pandas as pd
+
+
+class GrowableArray:
+
+  def __init__(self, array):
+    ''' append-only array with amortized O(n_new) appends: the buffer doubles its capacity when full.
+    array returns a view on the filled part, views handed out before an append stay valid
+    :param array: initial content, a numpy array (e.g. a memmap, it is only copied on the first append)
+    '''
+    self._buffer = array
+    self.size = array.shape[0]
+
+  @property
+  def array(self):
+    return self._buffer[:self.size]
+
+  def append(self, rows):
+    rows = np.asarray(rows, dtype=self._buffer.dtype)
+    if self.size + rows.shape[0] > self._buffer.shape[0]:
+      capacity = max(2 * self._buffer.shape[0], self.size + rows.shape[0], 16)
+      buffer = np.empty((capacity,) + self._buffer.shape[1:], dtype=self._buffer.dtype)
+      buffer[:self.size] = self._buffer[:self.size]
+      self._buffer = buffer
+    self._buffer[self.size:self.size + rows.shape[0]] = rows
+    self.size += rows.shape[0]
+
+  def write(self, start, rows):
+    ''' overwrites rows starting at index start, a read-only buffer (e.g. memmap) is copied first '''
+    if not self._buffer.flags.writeable:
+      self._buffer = np.array(self._buffer)
+    self._buffer[start:start + len(rows)] = rows
+
+
+class EpisodeStore:
+
+  def __init__(self, store_dir, segment_size=65536):
+    ''' Local append-only episode store. New episodes go to the tail segment: their embeddings are appended to a raw
+    float32 file, their ids, video paths and metadata to a write-ahead log (one json line per insert, fsynced). Once
+    the tail holds segment_size episodes it is sealed into an immutable segment (embeddings.npy + columnar metadata
+    pickle). Sealed segments are listed in store.json, which is replaced atomically, and can be merged by compact().
+    Every appended episode gets a sequence number. Deleted (e.g. evicted) episodes are recorded in a tombstone log with
+    the sequence number at the time of the delete, a tombstone only covers the episodes with that id that were appended
+    before it (an evicted id may be stored again). Covered episodes are dropped by read_all and compact. The aliases of
+    consolidated near duplicates are recorded in an alias log, see write_aliases
+    :param store_dir: directory of the store, created if it does not exist
+    :param segment_size: number of episodes after which the tail gets sealed
+    '''
+    self.store_dir = store_dir
+    self.segment_size = segment_size
+    self.lock = threading.RLock()
+    self._compaction_thread = None
+    self._stop_compaction = threading.Event()
+
+    if not os.path.isdir(store_dir):
+      os.makedirs(store_dir)
+    if os.path.isfile(self._path('store.json')):
+      with open(self._path('store.json'), 'r') as f:
+        self.manifest = json.load(f)
+    else:
+      self.manifest = {'dim': None, 'segments': [], 'next_segment_id': 0, 'next_seq': 0}
+      self._write_manifest()
+    self._recover_tail()
+    self._load_tombstones()
+    self._load_aliases()
+
+  def _path(self, *names):
+    return os.path.join(self.store_dir, *names)
+
+  def _write_manifest(self):
+    tmp_path = self._path('store.json.tmp')
+    with open(tmp_path, 'w') as f:
+      json.dump(self.manifest, f)
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(tmp_path, self._path('store.json'))
+
+  def _recover_tail(self):
+    '''
+    replays the write-ahead log, embeddings of inserts without a complete log record are discarded. Records that are
+    older than the next_seq of the manifest were sealed by a seal that was interrupted before it reset the log
+    '''
+    records = []
+    if os.path.isfile(self._path('wal.log')):
+      with open(self._path('wal.log'), 'r') as f:
+        for line in f:
+          try:
+            records.append(json.loads(line))
+          except ValueError: # incomplete record of an interrupted insert
+            break
+    # seal covers the whole log and resets it before the next append, so sealed records are never followed by others
+    # and their tail rows are dropped by the truncation below
+    self.tail_records = [record for record in records if record['seq'] >= self.manifest['next_seq']]
+    assert not self.tail_records or len(self.tail_records) == len(records), 'corrupt write-ahead log in ' + self.store_dir
+    with open(self._path('wal.log'), 'w') as f:
+      f.writelines(json.dumps(record) + '\n' for record in self.tail_records)
+
+    self.tail_size = sum(len(record['ids']) for record in self.tail_records)
+    self.next_seq = self.manifest['next_seq'] + self.tail_size
+    with open(self._path('tail.f32'), 'ab') as f:
+      f.truncate(self.tail_size * (self.manifest['dim'] or 0) * 4)
+
+  def _load_tombstones(self):
+    self.deleted_ids = {} # id -> sequence number of its latest delete
+    if os.path.isfile(self._path('tombstones.log')):
+      with open(self._path('tombstones.log'), 'r') as f:
+        for line in f:
+          try:
+            record = json.loads(line)
+          except ValueError: # incomplete record of an interrupted delete
+            break
+          self.deleted_ids.update((id, record['seq']) for id in record['ids'])
+
+  def _load_aliases(self):
+    self.aliases = {} # representative id -> ids of its consolidated near duplicates
+    if os.path.isfile(self._path('aliases.log')):
+      with open(self._path('aliases.log'), 'r') as f:
+        for line in f:
+          try:
+            record = json.loads(line)
+          except ValueError: # incomplete record of an interrupted write
+            break
+          self.aliases.update(record)
+    self.aliases = dict((id, alias_ids) for id, alias_ids in self.aliases.items() if alias_ids)
+
+  def write_aliases(self, aliases):
+    '''
+    durably records the aliases (ids of consolidated near duplicates) of representative episodes, they replace the
+    aliases recorded for these representatives before. Aliases of representatives that are not stored are ignored by
+    the memory when the store is loaded
+    :param aliases: dict mapping representative ids to lists of alias ids, an empty list removes the aliases
+    '''
+    aliases = dict((str(id), [str(alias_id) for alias_id in alias_ids]) for id, alias_ids in aliases.items())
+    with self.lock:
+      with open(self._path('aliases.log'), 'a') as f:
+        f.write(json.dumps(aliases) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+      # new dict, readers outside of the lock keep using the old one
+      merged = dict(self.aliases)
+      merged.update(aliases)
+      self.aliases = dict((id, alias_ids) for id, alias_ids in merged.items() if alias_ids)
+
+  def delete(self, ids):
+    '''
+    durably marks the episodes stored so far with these ids as deleted, they are skipped by read_all and removed from
+    merged segments by compact. Episodes appended later with the same ids are not affected
+    :param ids: episode ids
+    '''
+    ids = [str(i) for i in ids]
+    with self.lock:
+      with open(self._path('tombstones.log'), 'a') as f:
+        f.write(json.dumps({'ids': ids, 'seq': self.next_seq}) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+      # new dict, readers outside of the lock keep using the old one
+      deleted_ids = dict(self.deleted_ids)
+      deleted_ids.update((id, self.next_seq) for id in ids)
+      self.deleted_ids = deleted_ids
+
+  def _drop_deleted(self, embeddings, metadata_df, seqs):
+    ''' drops the episodes that were appended before a delete of their id '''
+    deleted_ids = self.deleted_ids
+    if not deleted_ids or metadata_df.shape[0] == 0:
+      return embeddings, metadata_df, seqs
+    deleted_seqs = metadata_df['id'].astype(str).map(deleted_ids).fillna(-1).values
+    keep = deleted_seqs <= seqs
+    return embeddings[keep], metadata_df[keep].reset_index(drop=True), seqs[keep]
+
+  @property
+  def n_sealed(self):
+    return sum(segment['n_episodes'] for segment in self.manifest['segments'])
+
+  def __len__(self):
+    return self.n_sealed + self.tail_size
+
+  def append(self, ids, embeddings, metadata_dicts, video_file_paths):
+    '''
+    durably appends episodes to the tail segment, seals the tail if it is full
+    :param ids: episode ids
+    :param embeddings: hidden representations, shape (n_new, n_dim_repr)
+    :param metadata_dicts: one (json serializable) metadata dict per episode
+    :param video_file_paths: one video path per episode, None for latent-only episodes
+    '''
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    assert embeddings.ndim == 2 and len(ids) == embeddings.shape[0] == len(metadata_dicts) == len(video_file_paths)
+    with self.lock:
+      if self.manifest['dim'] is None:
+        self.manifest['dim'] = embeddings.shape[1]
+        self._write_manifest()
+      assert embeddings.shape[1] == self.manifest['dim']
+
+      # embeddings first, the log record commits the insert
+      with open(self._path('tail.f32'), 'ab') as f:
+        f.write(embeddings.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+      record = {'ids': [str(i) for i in ids], 'video_file_paths': [None if p is None else str(p) for p in video_file_paths],
+                'metadata': list(metadata_dicts), 'seq': self.next_seq}
+      with open(self._path('wal.log'), 'a') as f:
+        f.write(json.dumps(record) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+      self.tail_records.append(record)
+      self.tail_size += len(ids)
+      self.next_seq += len(ids)
+
+      if self.tail_size >= self.segment_size:
+        self.seal()
+
+  def tail_embeddings(self):
+    if self.tail_size == 0:
+      return np.empty((0, self.manifest['dim'] or 0), dtype=np.float32)
+    return np.memmap(self._path('tail.f32'), dtype=np.float32, mode='r', shape=(self.tail_size, self.manifest['dim']))
+
+  def tail_seqs(self):
+    if not self.tail_records:
+      return np.empty(0, dtype=np.int64)
+    return np.concatenate([record['seq'] + np.arange(len(record['ids']), dtype=np.int64) for record in self.tail_records])
+
+  def tail_metadata(self):
+    rows = []
+    for record in self.tail_records:
+      for id, video_file_path, metadata in zip(record['ids'], record['video_file_paths'], record['metadata']):
+        row = dict(metadata)
+        row.update({'id': id, 'video_file_path': video_file_path})
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+  def seal(self):
+    ''' writes the tail as immutable segment and resets the tail and the write-ahead log '''
+    with self.lock:
+      if self.tail_size == 0:
+        return
+      segment_name = 'seg_%06i' % self.manifest['next_segment_id']
+      self._write_segment(segment_name, self.tail_embeddings(), self.tail_metadata(), self.tail_seqs())
+      self.manifest['segments'].append({'name': segment_name, 'n_episodes': self.tail_size})
+      self.manifest['next_segment_id'] += 1
+      self.manifest['next_seq'] = self.next_seq
+      self._write_manifest()
+
+      open(self._path('wal.log'), 'w').close()
+      open(self._path('tail.f32'), 'w').close()
+      self.tail_records, self.tail_size = [], 0
+
+  def _write_segment(self, segment_name, embeddings, metadata_df, seqs):
+    segment_dir = self._path('segments', segment_name)
+    if not os.path.isdir(segment_dir):
+      os.makedirs(segment_dir)
+    np.save(os.path.join(segment_dir, 'embeddings.npy'), np.asarray(embeddings, dtype=np.float32))
+    np.save(os.path.join(segment_dir, 'seqs.npy'), np.asarray(seqs, dtype=np.int64))
+    metadata_df.to_pickle(os.path.join(segment_dir, 'metadata.pickle'))
+
+  def _read_segment(self, segment_name, mmap_mode='r'):
+    return (np.load(self._path('segments', segment_name, 'embeddings.npy'), mmap_mode=mmap_mode),
+            pd.read_pickle(self._path('segments', segment_name, 'metadata.pickle')),
+            np.load(self._path('segments', segment_name, 'seqs.npy')))
+
+  def segments(self, mmap_mode='r'):
+    '''
+    :return: list of (embeddings, metadata_df, seqs) tuples of all sealed segments, the embeddings are memory mapped
+    '''
+    with self.lock:
+      segment_names = [segment['name'] for segment in self.manifest['segments']]
+    return [self._read_segment(name, mmap_mode) for name in segment_names]
+
+  def read_all(self):
+    '''
+    :return: embeddings of all episodes (sealed segments followed by the tail), shape (n_episodes, n_dim_repr) and
+    a dataframe with their ids, video paths and metadata (with the id and video_file_path columns if the store is empty)
+    '''
+    with self.lock:
+      # the tail rows are copied while appends and seal (which truncates the tail file) are blocked
+      parts = self.segments() + [(np.array(self.tail_embeddings()), self.tail_metadata(), self.tail_seqs())]
+    parts = [self._drop_deleted(e, m, seqs) for e, m, seqs in parts]
+    parts = [(e, m) for e, m, _ in parts if e.shape[0] > 0]
+    if not parts:
+      return np.empty((0, self.manifest['dim'] or 0), dtype=np.float32), pd.DataFrame(columns=['id', 'video_file_path'])
+    return np.concatenate([e for e, _ in parts]), pd.concat([m for _, m in parts], ignore_index=True)
+
+  def compact(self, max_segment_size=None):
+    '''
+    merges runs of consecutive sealed segments into segments of up to max_segment_size episodes. The merged segment
+    is written outside of the lock, only the manifest swap blocks appends
+    :param max_segment_size: (optional) upper bound for merged segments, defaults to 16 * segment_size
+    :return: True if segments were merged
+    '''
+    max_segment_size = max_segment_size or 16 * self.segment_size
+    with self.lock:
+      segments = list(self.manifest['segments'])
+    run = []
+    for segment in segments:
+      if sum(s['n_episodes'] for s in run) + segment['n_episodes'] > max_segment_size:
+        if len(run) > 1:
+          break
+        run = []
+      run.append(segment)
+    if len(run) < 2:
+      return False
+
+    parts = [self._drop_deleted(*self._read_segment(s['name'])) for s in run]
+    with self.lock:
+      segment_name = 'seg_%06i' % self.manifest['next_segment_id']
+      self.manifest['next_segment_id'] += 1
+    self._write_segment(segment_name, np.concatenate([e for e, _, _ in parts]),
+                        pd.concat([m for _, m, _ in parts], ignore_index=True), np.concatenate([q for _, _, q in parts]))
+
+    with self.lock:
+      merged_names = [s['name'] for s in run]
+      if not all(name in [s['name'] for s in self.manifest['segments']] for name in merged_names): # rewritten meanwhile
+        shutil.rmtree(self._path('segments', segment_name), ignore_errors=True)
+        return False
+      position = [s['name'] for s in self.manifest['segments']].index(merged_names[0])
+      self.manifest['segments'] = [s for s in self.manifest['segments'] if s['name'] not in merged_names]
+      self.manifest['segments'].insert(position, {'name': segment_name, 'n_episodes': sum(e.shape[0] for e, _, _ in parts)})
+      self._write_manifest()
+    for name in merged_names:
+      shutil.rmtree(self._path('segments', name), ignore_errors=True)
+    return True
+
+  def rewrite(self, embeddings, metadata_df):
+    '''
+    replaces all episodes of the store by one new segment, e.g. after the memory was re-embedded with another model.
+    The manifest swap commits the rewrite, the old segments and tombstones are removed afterwards
+    :param embeddings: hidden representations of all episodes, shape (n_episodes, n_dim_repr) (the dimension may change)
+    :param metadata_df: dataframe with the ids, video paths and metadata of the episodes
+    '''
+    with self.lock:
+      self.seal()
+      segment_name = 'seg_%06i' % self.manifest['next_segment_id']
+      self._write_segment(segment_name, embeddings, metadata_df,
+                          self.next_seq + np.arange(embeddings.shape[0], dtype=np.int64))
+      self.next_seq += embeddings.shape[0]
+      old_names = [segment['name'] for segment in self.manifest['segments']]
+      self.manifest.update({'dim': int(embeddings.shape[1]), 'next_segment_id': self.manifest['next_segment_id'] + 1,
+                            'segments': [{'name': segment_name, 'n_episodes': int(embeddings.shape[0])}],
+                            'next_seq': self.next_seq})
+      self._write_manifest()
+      open(self._path('tombstones.log'), 'w').close()
+      self.deleted_ids = {}
+    for name in old_names:
+      shutil.rmtree(self._path('segments', name), ignore_errors=True)
+
+  def start_background_compaction(self, interval=60.0, on_compacted=None):
+    '''
+    starts a daemon thread that compacts the store every interval seconds
+    :param interval: seconds between compaction runs
+    :param on_compacted: (optional) callback that is called after segments were merged, e.g. to rebuild indexes
+    '''
+    def compaction_loop():
+      while not self._stop_compaction.wait(interval):
+        if self.compact() and on_compacted is not None:
+          on_compacted()
+
+    assert self._compaction_thread is None, 'compaction is already running'
+    self._stop_compaction.clear()
+    self._compaction_thread = threading.Thread(target=compaction_loop, name='episode_store_compaction')
+    self._compaction_thread.daemon = True
+    self._compaction_thread.start()
+
+  def stop_background_compaction(self):
+    if self._compaction_thread is not None:
+      self._stop_compaction.set()
+      self._compaction_thread.join()
+      self._compaction_thread = None
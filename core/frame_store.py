@@ -0,0 +1,313 @@
+import os, json, zlib, threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+COMPRESSIONS = (None, 'zlib')
+
+
+class FrameStore:
+
+  def __init__(self, store_dir, compression=None, chunk_frames=8, compression_level=1):
+    ''' Append-only store of the frames of episodes. The uint8 frames of all episodes are appended to one file
+    (frames_<generation>.u8) that is memory mapped for reading, an index log (index.log, one json line per insert or
+    delete, fsynced) maps every episode id to the offset, shape and chunk sizes of its frames. Uncompressed episodes
+    are returned as zero-copy views on the memory map. With compression='zlib' the frames of an episode are compressed in chunks of
+    chunk_frames frames, a slice of the frames only inflates the chunks it overlaps
+    :param store_dir: directory of the store, created if it does not exist
+    :param compression: None or 'zlib', applies to the episodes that are appended from now on
+    :param chunk_frames: number of frames per compressed chunk
+    :param compression_level: zlib compression level (1: fastest, 9: smallest)
+    '''
+    assert compression in COMPRESSIONS, 'compression must be one of ' + str(COMPRESSIONS)
+    self.store_dir = store_dir
+    self.compression = compression
+    self.chunk_frames = chunk_frames
+    self.compression_level = compression_level
+    self.lock = threading.RLock()
+    self._mmap = None
+    self._generation = 0 # odd while compact swaps the entries and the frames file
+
+    if not os.path.isdir(store_dir):
+      os.makedirs(store_dir)
+    self._recover()
+
+  def _path(self, *names):
+    return os.path.join(self.store_dir, *names)
+
+  def _recover(self):
+    ''' replays the index log, frames of inserts without a complete log record are discarded '''
+    self.entries = {} # id -> {'offset', 'shape', 'chunks'}, chunks is None for uncompressed episodes
+    self.frames_file = 'frames_000000.u8'
+    records = []
+    if os.path.isfile(self._path('index.log')):
+      with open(self._path('index.log'), 'r') as f:
+        for line in f:
+          try:
+            records.append(json.loads(line))
+          except ValueError: # incomplete record of an interrupted insert
+            break
+    with open(self._path('index.log'), 'w') as f:
+      f.writelines(json.dumps(record) + '\n' for record in records)
+
+    self.size = 0
+    for record in records:
+      if 'frames_file' in record: # written by compact
+        self.frames_file = record['frames_file']
+        continue
+      if 'deleted' in record:
+        for id in record['deleted']:
+          self.entries.pop(id, None)
+        continue
+      for id, entry in zip(record['ids'], record['entries']):
+        self.entries[id] = entry
+        self.size = max(self.size, entry['offset'] + _entry_nbytes(entry))
+    with open(self._path(self.frames_file), 'ab') as f:
+      f.truncate(self.size)
+
+  def __len__(self):
+    return len(self.entries)
+
+  def __contains__(self, id):
+    return str(id) in self.entries
+
+  @property
+  def ids(self):
+    return list(self.entries)
+
+  def shape(self, id):
+    ''' :return: shape (n_frames, height, width, n_channels) of the frames of an episode '''
+    return tuple(self.entries[str(id)]['shape'])
+
+  def append(self, ids, clips):
+    '''
+    durably appends the frames of episodes, an id that is already in the store is replaced
+    :param ids: episode ids
+    :param clips: one uint8 array of shape (n_frames, height, width, n_channels) per episode (or a 5D array)
+    '''
+    assert len(ids) == len(clips)
+    with self.lock:
+      # frames first, the index record commits the insert
+      entries = []
+      with open(self._path(self.frames_file), 'ab') as f:
+        for clip in clips:
+          clip = np.ascontiguousarray(clip, dtype=np.uint8)
+          assert clip.ndim == 4, 'clips must have shape (n_frames, height, width, n_channels)'
+          entry = {'offset': self.size, 'shape': list(clip.shape), 'chunks': None}
+          if self.compression == 'zlib':
+            chunks = [zlib.compress(clip[start:start + self.chunk_frames].tobytes(), self.compression_level)
+                      for start in range(0, clip.shape[0], self.chunk_frames)]
+            entry.update({'chunks': [len(chunk) for chunk in chunks], 'chunk_frames': self.chunk_frames})
+            f.write(b''.join(chunks))
+          else:
+            f.write(clip.tobytes())
+          self.size += _entry_nbytes(entry)
+          entries.append(entry)
+        f.flush()
+        os.fsync(f.fileno())
+      record = {'ids': [str(id) for id in ids], 'entries': entries}
+      with open(self._path('index.log'), 'a') as f:
+        f.write(json.dumps(record) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+      self.entries.update(zip(record['ids'], entries))
+
+  def delete(self, ids):
+    '''
+    durably removes episodes from the index, their frames are reclaimed by compact
+    :param ids: episode ids
+    '''
+    ids = [str(id) for id in ids if str(id) in self.entries]
+    if not ids:
+      return
+    with self.lock:
+      with open(self._path('index.log'), 'a') as f:
+        f.write(json.dumps({'deleted': ids}) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+      for id in ids:
+        self.entries.pop(id, None)
+
+  def _frames_map(self, end):
+    ''' :return: read-only memory map of the frames file that covers the bytes up to end, remapped if the file grew.
+    Views on earlier maps stay valid '''
+    frames_map = self._mmap
+    if frames_map is None or frames_map.shape[0] < end:
+      with self.lock:
+        path = self._path(self.frames_file)
+        frames_map = self._mmap = np.memmap(path, dtype=np.uint8, mode='r', shape=(os.path.getsize(path),))
+    return frames_map
+
+  def _locate(self, id):
+    '''
+    :return: the index entry of an episode and a memory map of the frames file the entry refers to. Reads do not take
+             the lock, a lookup that overlapped the swap of the entries and the frames file by compact is retried
+    '''
+    while True:
+      generation = self._generation
+      if generation % 2 == 1:
+        with self.lock: # compact is swapping, wait until it is done
+          continue
+      entry = self.entries.get(str(id))
+      assert entry is not None, 'episode %s is not in the frame store' % str(id)
+      frames_map = self._frames_map(entry['offset'] + _entry_nbytes(entry))
+      if self._generation == generation:
+        return entry, frames_map
+
+  def get(self, id, frames=None):
+    '''
+    :param id: episode id
+    :param frames: (optional) slice of the frames to read, e.g. slice(0, 5)
+    :return: uint8 array of shape (n_frames, height, width, n_channels), a read-only view on the memory map if the
+             episode is stored uncompressed
+    '''
+    entry, frames_map = self._locate(id)
+    shape = tuple(entry['shape'])
+    frames = frames if frames is not None else slice(None)
+    if entry['chunks'] is None:
+      return frames_map[entry['offset']:entry['offset'] + _entry_nbytes(entry)].reshape(shape)[frames]
+
+    # only the chunks that overlap the requested (forward) slice are inflated
+    is_forward_slice = isinstance(frames, slice) and (frames.step is None or frames.step > 0)
+    start, stop, step = frames.indices(shape[0]) if is_forward_slice else (0, shape[0], 1)
+    chunk_frames = entry['chunk_frames']
+    first_chunk, last_chunk = start // chunk_frames, max(start, stop - 1) // chunk_frames
+    chunk_offsets = np.concatenate([[0], np.cumsum(entry['chunks'])]) + entry['offset']
+    data = b''.join(zlib.decompress(frames_map[chunk_offsets[i]:chunk_offsets[i + 1]].tobytes())
+                    for i in range(first_chunk, min(last_chunk + 1, len(entry['chunks']))))
+    clip = np.frombuffer(data, dtype=np.uint8).reshape((-1,) + shape[1:])
+    if is_forward_slice:
+      return clip[start - first_chunk * chunk_frames:stop - first_chunk * chunk_frames:step]
+    return clip[frames]
+
+  def get_batch(self, ids, frames=None, n_threads=1):
+    '''
+    :param ids: episode ids
+    :param frames: (optional) slice of the frames to read of every episode
+    :param n_threads: number of threads that inflate compressed episodes (zlib releases the GIL)
+    :return: uint8 array of shape (n_episodes, n_frames, height, width, n_channels) if all clips have the same shape,
+             else a list of clips
+    '''
+    if n_threads > 1 and len(ids) > 1:
+      with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        clips = list(executor.map(lambda id: self.get(id, frames), ids))
+    else:
+      clips = [self.get(id, frames) for id in ids]
+    if len(set(clip.shape for clip in clips)) == 1:
+      return np.stack(clips)
+    return clips
+
+  def iter_batches(self, batch_size=32, ids=None, frames=None, n_threads=4):
+    '''
+    iterates over the episodes in batches, e.g. for an evaluation. The next batch is read in a background thread
+    while the current one is processed
+    :param batch_size: number of episodes per batch
+    :param ids: (optional) ids of the episodes, defaults to all episodes in insertion order
+    :param frames: (optional) slice of the frames to read of every episode
+    :param n_threads: number of threads that inflate compressed episodes
+    :return: generator of (batch_ids, clips) tuples, see get_batch
+    '''
+    ids = self.ids if ids is None else [str(id) for id in ids]
+    batches = [ids[start:start + batch_size] for start in range(0, len(ids), batch_size)]
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+      future = prefetcher.submit(self.get_batch, batches[0], frames, n_threads) if batches else None
+      for i, batch_ids in enumerate(batches):
+        clips = future.result()
+        if i + 1 < len(batches):
+          future = prefetcher.submit(self.get_batch, batches[i + 1], frames, n_threads)
+        yield batch_ids, clips
+
+  def compact(self):
+    '''
+    rewrites the frames of all episodes in the index to a new file, reclaiming the space of deleted and replaced
+    episodes. Compressed episodes are copied without inflating them
+    :return: number of reclaimed bytes
+    '''
+    with self.lock:
+      frames_map = self._frames_map(self.size)
+      old_frames_file = self.frames_file
+      frames_file = 'frames_%06i.u8' % (int(old_frames_file[len('frames_'):-len('.u8')]) + 1)
+      entries, offset = {}, 0
+      with open(self._path(frames_file), 'wb') as f:
+        for id, entry in self.entries.items():
+          nbytes = _entry_nbytes(entry)
+          f.write(frames_map[entry['offset']:entry['offset'] + nbytes].tobytes())
+          entries[id] = dict(entry, offset=offset)
+          offset += nbytes
+        f.flush()
+        os.fsync(f.fileno())
+      # the new index names the new frames file, replacing it switches both atomically
+      with open(self._path('index.log.tmp'), 'w') as f:
+        f.write(json.dumps({'frames_file': frames_file}) + '\n')
+        f.write(json.dumps({'ids': list(entries), 'entries': list(entries.values())}) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+      os.replace(self._path('index.log.tmp'), self._path('index.log'))
+      self._generation += 1
+      reclaimed, self.size, self.entries, self._mmap = self.size - offset, offset, entries, None
+      self.frames_file = frames_file
+      self._generation += 1
+      os.remove(self._path(old_frames_file)) # views on the old memory map stay valid
+    print('Compacted frame store %s, reclaimed %i bytes' % (self.store_dir, reclaimed))
+    return reclaimed
+
+  def stats(self):
+    ''' :return: dict with the number of episodes and frames, the file size and the compression ratio '''
+    with self.lock:
+      raw_bytes = sum(int(np.prod(entry['shape'])) for entry in self.entries.values())
+      stored_bytes = sum(_entry_nbytes(entry) for entry in self.entries.values())
+      return {'episodes': len(self.entries), 'frames': sum(entry['shape'][0] for entry in self.entries.values()),
+              'file_bytes': self.size, 'stored_bytes': stored_bytes,
+              'compression_ratio': raw_bytes / float(stored_bytes) if stored_bytes else 1.0}
+
+
+def _entry_nbytes(entry):
+  if entry['chunks'] is None:
+    return int(np.prod(entry['shape']))
+  return int(sum(entry['chunks']))
+
+
+def convert_to_frame_store(video_paths, store_dir, ids=None, compression=None, batch_size=64, n_threads=4,
+                           image_type='.png'):
+  '''
+  converts videos (gif / video files or directories with one image per frame) into a frame store
+  :param video_paths: paths of the videos
+  :param store_dir: directory of the frame store, episodes are appended if it already exists
+  :param ids: (optional) episode ids, defaults to the file / directory names without extension
+  :param compression: None or 'zlib', see FrameStore
+  :param batch_size: number of videos that are decoded and appended together
+  :param n_threads: number of threads that decode videos
+  :param image_type: file extension of the frames in frame directories
+  :return: the FrameStore
+  '''
+  from utils import io_handler
+  video_paths = list(video_paths)
+  if ids is None:
+    ids = [os.path.splitext(os.path.basename(os.path.normpath(path)))[0] for path in video_paths]
+  assert len(ids) == len(video_paths)
+  frame_store = FrameStore(store_dir, compression=compression)
+  with ThreadPoolExecutor(max_workers=n_threads) as executor:
+    for start in range(0, len(video_paths), batch_size):
+      clips = list(executor.map(lambda path: io_handler.load_video_frames(path, image_type=image_type),
+                                video_paths[start:start + batch_size]))
+      frame_store.append(ids[start:start + batch_size], clips)
+      print('Converted %i of %i videos to frame store %s' % (min(start + batch_size, len(video_paths)), len(video_paths),
+                                                            store_dir))
+  return frame_store
+
+
+def convert_memory_videos(memory_pickle_path, base_dir, store_dir, video_path_col="video_file_path", compression=None,
+                          batch_size=64, n_threads=4):
+  '''
+  converts the videos of the episodes of a memory (e.g. the gifs written by validate in memory_prep mode) into a
+  frame store keyed by the episode ids, see Memory.attach_frame_store
+  :param memory_pickle_path: path of the pickled memory dataframe with 'id' and video path column
+  :param base_dir: directory the video paths are relative to
+  :param store_dir: directory of the frame store
+  :return: the FrameStore
+  '''
+  import pandas as pd
+  memory_df = pd.read_pickle(memory_pickle_path)
+  memory_df = memory_df[~pd.isnull(memory_df[video_path_col])]
+  return convert_to_frame_store([os.path.join(base_dir, path) for path in memory_df[video_path_col]], store_dir,
+                                ids=[str(id) for id in memory_df['id']], compression=compression,
+                                batch_size=batch_size, n_threads=n_threads)
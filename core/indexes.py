@@ -0,0 +1,838 @@
+import heapq, math
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+from core.episode_store import GrowableArray
+
+
+def normalize_rows(matrix, dtype=np.float32):
+  '''
+  scales every row of a matrix to unit length (rows with zero norm are left untouched)
+  :param matrix: 2D array
+  :param dtype: dtype of the returned matrix
+  :return: C-contiguous matrix of the given dtype with unit length rows
+  '''
+  matrix = np.array(matrix, dtype=dtype, order='C')
+  norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+  norms[norms == 0] = 1
+  matrix /= norms
+  return matrix
+
+def top_k_indices(scores, k):
+  '''
+  selects the k highest scores of every row by partitioning, only these k entries get sorted
+  :param scores: 2D array of shape (n_rows, n_cols)
+  :param k: number of indices per row, must not exceed n_cols
+  :return: array of shape (n_rows, k) with column indices, highest score is leftmost
+  '''
+  if k < scores.shape[1]:
+    candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+  else:
+    candidates = np.tile(np.arange(scores.shape[1]), (scores.shape[0], 1))
+  rows = np.arange(scores.shape[0])[:, None]
+  order = np.argsort(-scores[rows, candidates], axis=1)
+  return candidates[rows, order]
+
+
+class IVFIndex:
+  name = 'ivf'
+
+  def __init__(self, n_clusters=256, nprobe=8, max_train_samples=100000, seed=None):
+    ''' Inverted file index: a k-means coarse quantizer partitions the memory into n_clusters lists, a query only
+    scores the episodes in the nprobe lists with the closest centroids.
+    The index only keeps row indices, the (unit length) vectors are passed in by the owner of the memory
+    :param n_clusters: number of inverted lists (k-means centroids)
+    :param nprobe: number of lists scored per query - the recall vs. latency knob
+    :param max_train_samples: upper bound for the number of vectors the k-means is fitted on
+    :param seed: random seed for sampling and k-means
+    '''
+    self.n_clusters = n_clusters
+    self.nprobe = nprobe
+    self.max_train_samples = max_train_samples
+    self.seed = seed
+    self.centroids = None
+    self.lists = None
+
+  def train(self, vectors):
+    '''
+    fits the coarse quantizer (k-means on a sample of the vectors)
+    :param vectors: unit length vectors, shape (n_episodes, n_dim_repr)
+    '''
+    n_clusters = min(self.n_clusters, vectors.shape[0])
+    if vectors.shape[0] > self.max_train_samples:
+      sample = np.random.RandomState(self.seed).choice(vectors.shape[0], self.max_train_samples, replace=False)
+      vectors = vectors[sample]
+    kmeans = MiniBatchKMeans(n_clusters=n_clusters, random_state=self.seed).fit(vectors)
+    self.centroids = normalize_rows(kmeans.cluster_centers_)
+    self.lists = [np.empty(0, dtype=np.int64) for _ in range(n_clusters)]
+
+  @property
+  def is_trained(self):
+    return self.centroids is not None
+
+  @property
+  def ntotal(self):
+    return sum(len(l) for l in self.lists) if self.is_trained else 0
+
+  def add(self, vectors, rows):
+    '''
+    assigns episodes to the list of their closest centroid, can be called incrementally for new episodes
+    :param vectors: unit length memory vectors the row indices refer to
+    :param rows: memory row indices of the episodes to add, shape (n_new,)
+    '''
+    assert self.is_trained, 'IVF index must be trained before adding episodes'
+    rows = np.asarray(rows, dtype=np.int64)
+    assignments = np.argmax(np.dot(vectors[rows], self.centroids.T), axis=1)
+    self.lists = list(self.lists) # copies of the index (see Memory snapshots) keep their lists
+    for list_id in np.unique(assignments):
+      self.lists[list_id] = np.concatenate((self.lists[list_id], rows[assignments == list_id]))
+
+  def compact(self, vectors, keep):
+    '''
+    removes episodes from the index and renumbers the remaining rows to their positions in the compacted memory
+    :param vectors: unit length memory vectors before the removal
+    :param keep: boolean array over the memory rows before the removal, False for removed episodes
+    '''
+    self.lists = [compact_rows(l, keep)[1] for l in self.lists]
+
+  def search(self, vectors, queries, k, nprobe=None, mask=None):
+    '''
+    approximate top-k cosine search
+    :param vectors: unit length memory vectors the row indices of the index refer to
+    :param queries: unit length query vectors, shape (n_queries, n_dim_repr)
+    :param k: number of matches per query
+    :param nprobe: (optional) overrides the nprobe of the index for this call
+    :param mask: (optional) boolean array over the memory rows, only rows where it is True are returned
+    :return: two arrays of shape (n_queries, k): the memory row indices and cos similarities of the matches
+    '''
+    assert self.is_trained, 'IVF index must be trained before searching'
+    nprobe = nprobe or self.nprobe
+    lists = self.lists if mask is None else [l[mask[l]] for l in self.lists]
+    list_sizes = np.array([len(l) for l in lists])
+    k = min(k, int(list_sizes.sum()))
+    probe_order = np.argsort(-np.dot(queries, self.centroids.T), axis=1)
+
+    indices = np.empty((queries.shape[0], k), dtype=np.int64)
+    similarities = np.empty((queries.shape[0], k), dtype=np.float32)
+    for i, query in enumerate(queries):
+      # probe at least nprobe lists, and more if these do not hold k episodes
+      n_probed = max(nprobe, np.searchsorted(np.cumsum(list_sizes[probe_order[i]]), k) + 1)
+      candidates = np.concatenate([lists[list_id] for list_id in probe_order[i, :n_probed]])
+      candidate_similarities = np.dot(vectors[candidates], query)
+      closest = top_k_indices(candidate_similarities[None], k)[0]
+      indices[i], similarities[i] = candidates[closest], candidate_similarities[closest]
+    return indices, similarities
+
+
+
+class ClassRoutingIndex(IVFIndex):
+  name = 'class_routing'
+  requires_labels = True
+
+  def __init__(self, n_route=3):
+    ''' Hierarchical routing over the labels of the memory: queries are scored against the class centroids first and only
+    the episodes of the n_route best classes are scored by cosine similarity. Works like an IVF index whose lists are
+    the row indices of the classes
+    :param n_route: number of classes scored per query - the recall vs. latency knob
+    '''
+    IVFIndex.__init__(self, n_clusters=0, nprobe=n_route)
+    self.classes = []
+    self.class_ids = {}
+    self.class_sums = None
+    self.centroids = np.empty((0, 0), dtype=np.float32)
+    self.lists = []
+
+  @property
+  def n_route(self):
+    return self.nprobe
+
+  def train(self, vectors):
+    pass
+
+  def add(self, vectors, rows, labels):
+    '''
+    appends episodes to the row lists of their classes and updates the class centroids, new classes are created on the fly
+    :param vectors: unit length memory vectors the row indices refer to
+    :param rows: memory row indices of the episodes to add, shape (n_new,)
+    :param labels: class labels of the episodes to add, shape (n_new,)
+    '''
+    rows = np.asarray(rows, dtype=np.int64)
+    labels = np.asarray(labels)
+    # copies of the index (see Memory snapshots) keep their containers
+    self.classes, self.class_ids, self.lists = list(self.classes), dict(self.class_ids), list(self.lists)
+    for label in np.unique(labels):
+      if label not in self.class_ids:
+        self.class_ids[label] = len(self.classes)
+        self.classes.append(label)
+        self.lists.append(np.empty(0, dtype=np.int64))
+    if self.class_sums is None:
+      self.class_sums = np.zeros((0, vectors.shape[1]))
+    self.class_sums = np.concatenate((self.class_sums, np.zeros((len(self.classes) - self.class_sums.shape[0], vectors.shape[1]))))
+
+    class_ids = np.array([self.class_ids[label] for label in labels], dtype=np.int64)
+    np.add.at(self.class_sums, class_ids, vectors[rows])
+    for class_id in np.unique(class_ids):
+      self.lists[class_id] = np.concatenate((self.lists[class_id], rows[class_ids == class_id]))
+    self.centroids = normalize_rows(self.class_sums)
+    self.n_clusters = len(self.classes)
+
+  def compact(self, vectors, keep):
+    '''
+    removes episodes from the row lists and their vectors from the class centroids, see IVFIndex.compact
+    '''
+    removed_sums = np.stack([vectors[l[~keep[l]]].sum(axis=0) if len(l) else np.zeros(vectors.shape[1])
+                             for l in self.lists]) if self.lists else 0
+    self.class_sums = self.class_sums - removed_sums
+    self.centroids = normalize_rows(self.class_sums)
+    IVFIndex.compact(self, vectors, keep)
+
+
+class BlockBoundIndex(IVFIndex):
+  name = 'block_bounds'
+
+  def __init__(self, block_size=256, max_train_samples=100000, seed=None):
+    ''' Exact search with pruning: k-means partitions the memory into blocks of about block_size episodes, every block
+    keeps its unit length centroid and the angular radius of its episodes around the centroid. The cosine similarity of
+    a query to any episode of a block is at most cos(max(0, angle(query, centroid) - radius)), blocks whose bound is
+    below the threshold of a radius query (or the k-th best similarity found so far) are never scored
+    :param block_size: average number of episodes per block
+    :param max_train_samples: upper bound for the number of vectors the k-means is fitted on
+    :param seed: random seed for sampling and k-means
+    '''
+    IVFIndex.__init__(self, n_clusters=0, nprobe=0, max_train_samples=max_train_samples, seed=seed)
+    self.block_size = block_size
+    self.radii = None
+
+  def train(self, vectors):
+    self.n_clusters = max(1, vectors.shape[0] // self.block_size)
+    IVFIndex.train(self, vectors)
+    self.radii = np.zeros(len(self.lists))
+
+  def add(self, vectors, rows):
+    '''
+    assigns episodes to the block of their closest centroid and widens the radius of the block if necessary, the
+    centroids stay fixed so the bounds remain valid for incremental adds (and removals)
+    :param vectors: unit length memory vectors the row indices refer to
+    :param rows: memory row indices of the episodes to add, shape (n_new,)
+    '''
+    assert self.is_trained, 'block bound index must be trained before adding episodes'
+    rows = np.asarray(rows, dtype=np.int64)
+    similarities = np.dot(vectors[rows], self.centroids.T)
+    assignments = np.argmax(similarities, axis=1)
+    radii = self.radii.copy()
+    np.maximum.at(radii, assignments, np.arccos(np.clip(similarities[np.arange(len(rows)), assignments], -1, 1)))
+    self.radii = radii
+    self.lists = list(self.lists)
+    for list_id in np.unique(assignments):
+      self.lists[list_id] = np.concatenate((self.lists[list_id], rows[assignments == list_id]))
+
+  def bounds(self, query):
+    '''
+    :param query: unit length query vector
+    :return: upper bound of the cosine similarity of the query to the episodes of every block, shape (n_blocks,)
+    '''
+    angles = np.arccos(np.clip(np.dot(self.centroids, query), -1, 1))
+    return np.cos(np.maximum(angles - self.radii, 0)) + 1e-6 # margin for rounding errors
+
+  def radius_search(self, vectors, query, min_similarity, mask=None, first_only=False):
+    '''
+    finds the episodes with a cosine similarity of at least min_similarity to the query
+    :param vectors: unit length memory vectors the row indices of the index refer to
+    :param query: unit length query vector, shape (n_dim_repr,)
+    :param min_similarity: similarity threshold (1 - cosine distance radius)
+    :param mask: (optional) boolean array over the memory rows, only rows where it is True are returned
+    :param first_only: if True, the search stops at the first block that contains a match
+    :return: memory row indices and cos similarities of the matches (unsorted)
+    '''
+    bounds = self.bounds(query)
+    blocks = np.flatnonzero(bounds >= min_similarity)
+    rows, similarities = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.float32)]
+    for block in blocks[np.argsort(-bounds[blocks])]:
+      block_rows = self.lists[block] if mask is None else self.lists[block][mask[self.lists[block]]]
+      block_similarities = np.dot(vectors[block_rows], query)
+      matches = block_similarities >= min_similarity
+      if matches.any():
+        rows.append(block_rows[matches])
+        similarities.append(block_similarities[matches])
+        if first_only:
+          break
+    return np.concatenate(rows), np.concatenate(similarities)
+
+  def search(self, vectors, queries, k, mask=None):
+    '''
+    exact top-k cosine search, blocks are scored in the order of their bounds until no block can improve the k-th match
+    :param vectors: unit length memory vectors the row indices of the index refer to
+    :param queries: unit length query vectors, shape (n_queries, n_dim_repr)
+    :param k: number of matches per query
+    :param mask: (optional) boolean array over the memory rows, only rows where it is True are returned
+    :return: two arrays of shape (n_queries, k): the memory row indices and cos similarities of the matches
+    '''
+    lists = self.lists if mask is None else [l[mask[l]] for l in self.lists]
+    k = min(k, sum(len(l) for l in lists))
+    indices = np.empty((queries.shape[0], k), dtype=np.int64)
+    similarities = np.empty((queries.shape[0], k), dtype=np.float32)
+    for i, query in enumerate(queries):
+      bounds = self.bounds(query)
+      best_rows, best_similarities = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+      for block in np.argsort(-bounds):
+        if len(best_rows) >= k and bounds[block] < best_similarities[k - 1]:
+          break
+        if len(lists[block]) == 0:
+          continue
+        best_rows = np.concatenate((best_rows, lists[block]))
+        best_similarities = np.concatenate((best_similarities, np.dot(vectors[lists[block]], query)))
+        closest = top_k_indices(best_similarities[None], min(k, len(best_rows)))[0]
+        best_rows, best_similarities = best_rows[closest], best_similarities[closest]
+      indices[i], similarities[i] = best_rows, best_similarities
+    return indices, similarities
+
+
+class HNSWIndex:
+  name = 'hnsw'
+
+  def __init__(self, M=16, ef_construction=100, ef_search=50, max_deleted_fraction=0.1, seed=None):
+    ''' Hierarchical navigable small world graph over the cosine similarity of unit length vectors. Nodes are numbered
+    in insertion order and mapped to memory row indices by node_rows, the vectors are passed in by the owner of the
+    memory (so only the graph gets serialized). Removed episodes stay in the graph as deleted nodes that searches pass
+    through but never return, they are purged once they exceed max_deleted_fraction of the nodes
+    :param M: number of neighbours per node on the upper layers (2 * M on the bottom layer)
+    :param ef_construction: size of the candidate list while inserting
+    :param ef_search: size of the candidate list while searching - the recall vs. latency knob
+    :param max_deleted_fraction: fraction of deleted nodes above which compact relinks their neighbours and drops them
+    :param seed: random seed for drawing the node levels
+    '''
+    self.M = M
+    self.ef_construction = ef_construction
+    self.ef_search = ef_search
+    self.max_deleted_fraction = max_deleted_fraction
+    self.level_mult = 1 / math.log(M)
+    self.random_state = np.random.RandomState(seed)
+    self.layers = [] # one dict per layer mapping node -> list of neighbour nodes
+    self.entry_point = None
+    self.node_rows = GrowableArray(np.empty(0, dtype=np.int64)) # node -> memory row, -1 for deleted nodes
+    self.n_nodes = 0
+    self.deleted = frozenset()
+    self.n_purged = 0
+
+  @property
+  def ntotal(self):
+    return self.n_nodes - len(self.deleted) - self.n_purged
+
+  def _vectors(self, vectors, nodes):
+    return vectors[self.node_rows.array[nodes]]
+
+  def add(self, vectors, rows):
+    '''
+    inserts episodes into the graph, can be called incrementally for new episodes
+    :param vectors: unit length memory vectors the row indices refer to
+    :param rows: memory row indices of the episodes to add, shape (n_new,)
+    '''
+    rows = np.asarray(rows, dtype=np.int64)
+    self.node_rows.append(rows)
+    # copies of the index that older memory versions use share the layers, inserting rewires the links of existing
+    # nodes: the layer dicts are copied once per call and every neighbour list is copied before it is changed
+    self.layers = [dict(graph) for graph in self.layers]
+    for _ in range(rows.shape[0]):
+      self._insert(vectors, self.n_nodes)
+      self.n_nodes += 1
+
+  def compact(self, vectors, keep):
+    '''
+    removes episodes from the index, see IVFIndex.compact. Deleting nodes would leave holes in the graph, so the nodes
+    of the removed episodes are only marked as deleted and the rows of the other nodes renumbered, which is O(n_nodes)
+    in numpy. Once the deleted nodes exceed max_deleted_fraction, the nodes linking to them are relinked (see
+    _purge_deleted), the graph is never rebuilt
+    '''
+    node_rows = self.node_rows.array[:self.n_nodes].copy()
+    live = np.flatnonzero(node_rows >= 0)
+    kept = keep[node_rows[live]]
+    node_rows[live] = np.where(kept, np.cumsum(keep)[node_rows[live]] - 1, -1)
+    # new objects, copies of the index that older memory versions use keep the old ones
+    self.node_rows = GrowableArray(node_rows)
+    self.deleted = self.deleted | frozenset(live[~kept].tolist())
+    if len(self.deleted) > self.max_deleted_fraction * self.n_nodes:
+      self._purge_deleted(vectors[keep])
+    elif self.entry_point in self.deleted:
+      self._replace_entry_point()
+
+  def _purge_deleted(self, vectors):
+    '''
+    relinks every node that links to deleted nodes to the most similar of the live nodes reachable through them and
+    drops the deleted nodes. Only the lists of these nodes are rebuilt, the layers are replaced by new dicts
+    '''
+    layers, n_purged = [], len(self.deleted)
+    for layer, graph in enumerate(self.layers):
+      max_neighbours = self.M if layer > 0 else 2 * self.M
+      new_graph = {}
+      for node, links in graph.items():
+        if node in self.deleted:
+          continue
+        if not any(link in self.deleted for link in links):
+          new_graph[node] = links
+          continue
+        # the live links are kept, the free slots are filled with the most similar live nodes behind the deleted ones
+        live_links = [link for link in links if link not in self.deleted]
+        candidates = self._live_links(graph, [link for link in links if link in self.deleted], set(live_links) | {node})
+        n_free = max_neighbours - len(live_links)
+        if candidates and n_free > 0:
+          similarities = np.dot(self._vectors(vectors, candidates), self._vectors(vectors, node))
+          live_links += [candidates[i] for i in np.argsort(-similarities)[:n_free]]
+        new_graph[node] = live_links
+      layers.append(new_graph)
+    while layers and not layers[-1]:
+      layers.pop()
+    self.layers, self.deleted = layers, frozenset()
+    self.n_purged += n_purged
+    if self.entry_point is not None and (not layers or self.entry_point not in layers[0]):
+      self._replace_entry_point()
+
+  def _replace_entry_point(self):
+    ''' the entry point was deleted, a live node of the highest layer that has one becomes the new entry point '''
+    self.entry_point = None
+    for graph in reversed(self.layers):
+      live = [node for node in graph if node not in self.deleted]
+      if live:
+        self.entry_point = live[0]
+        return
+
+  def _live_links(self, graph, links, visited):
+    '''
+    :param links: neighbour list of a node
+    :return: the nodes of links that are not in visited (which is updated), deleted nodes are passed through: their
+             live neighbours are returned instead (one hop, chains of deleted nodes are not followed)
+    '''
+    neighbours = []
+    for link in links:
+      if link in visited:
+        continue
+      visited.add(link)
+      if link not in self.deleted:
+        neighbours.append(link)
+        continue
+      for neighbour in graph.get(link, ()):
+        if neighbour not in visited and neighbour not in self.deleted:
+          visited.add(neighbour)
+          neighbours.append(neighbour)
+    return neighbours
+
+  def _insert(self, vectors, node):
+    level = int(-math.log(1.0 - self.random_state.random_sample()) * self.level_mult)
+    while len(self.layers) <= level:
+      self.layers.append({})
+    if self.entry_point is None:
+      for layer in range(level + 1):
+        self.layers[layer][node] = []
+      self.entry_point = node
+      return
+
+    query = self._vectors(vectors, node)
+    entry_points = [self.entry_point]
+    top_level = self._level_of(self.entry_point)
+    # greedy descent through the layers above the level of the new node
+    for layer in range(top_level, level, -1):
+      entry_points = [self._search_layer(vectors, query, entry_points, 1, layer)[0][1]]
+
+    for layer in range(min(level, top_level), -1, -1):
+      candidates = self._search_layer(vectors, query, entry_points, self.ef_construction, layer)
+      max_neighbours = self.M if layer > 0 else 2 * self.M
+      neighbours = self._select_neighbours(vectors, candidates, self.M)
+      self.layers[layer][node] = neighbours
+      for neighbour in neighbours:
+        links = self.layers[layer][neighbour] + [node]
+        self.layers[layer][neighbour] = links
+        if len(links) > max_neighbours:
+          links = [link for link in links if link not in self.deleted]
+          similarities = np.dot(self._vectors(vectors, links), self._vectors(vectors, neighbour))
+          self.layers[layer][neighbour] = self._select_neighbours(vectors, sorted(zip(similarities, links), reverse=True),
+                                                                  max_neighbours)
+      entry_points = [c for _, c in candidates]
+
+    for layer in range(top_level + 1, level + 1):
+      self.layers[layer][node] = []
+    if level > top_level:
+      self.entry_point = node
+
+  def _level_of(self, node):
+    level = 0
+    while level + 1 < len(self.layers) and node in self.layers[level + 1]:
+      level += 1
+    return level
+
+  def _select_neighbours(self, vectors, candidates, n):
+    '''
+    neighbour selection heuristic: a candidate is only linked if it is closer to the node than to every neighbour
+    selected so far, which keeps links in diverse directions
+    :param candidates: list of (similarity, node) tuples, sorted by descending similarity
+    '''
+    nodes = [c for _, c in candidates]
+    candidate_vectors = self._vectors(vectors, nodes)
+    pairwise = np.dot(candidate_vectors, candidate_vectors.T)
+    selected = []
+    for i, (similarity, _) in enumerate(candidates):
+      if all(pairwise[i, j] < similarity for j in selected):
+        selected.append(i)
+        if len(selected) == n:
+          break
+    return [nodes[i] for i in selected]
+
+  def _search_layer(self, vectors, query, entry_points, ef, layer, mask=None):
+    '''
+    best-first beam search on one layer
+    :param mask: (optional) boolean array over the memory rows, the search traverses all nodes but only returns the
+                 ones whose row is True
+    :return: list of up to ef (similarity, node) tuples, sorted by descending similarity
+    '''
+    graph = self.layers[layer]
+    visited = set(entry_points)
+    similarities = np.dot(self._vectors(vectors, entry_points), query)
+    candidates = [(-s, e) for s, e in zip(similarities, entry_points)] # max-heap on similarity
+    results = [(s, e) for s, e in zip(similarities, entry_points)
+               if mask is None or mask[self.node_rows.array[e]]] # min-heap, holds the ef best nodes
+    heapq.heapify(candidates)
+    heapq.heapify(results)
+    while candidates:
+      negative_similarity, node = heapq.heappop(candidates)
+      if len(results) >= ef and -negative_similarity < results[0][0]:
+        break
+      neighbours = self._live_links(graph, graph.get(node, ()), visited)
+      if not neighbours:
+        continue
+      rows = self.node_rows.array[neighbours]
+      for similarity, neighbour, row in zip(np.dot(vectors[rows], query), neighbours, rows):
+        if len(results) < ef or similarity > results[0][0]:
+          heapq.heappush(candidates, (-similarity, neighbour))
+          if mask is None or mask[row]:
+            heapq.heappush(results, (similarity, neighbour))
+            if len(results) > ef:
+              heapq.heappop(results)
+    return sorted(results, reverse=True)
+
+  def search(self, vectors, queries, k, ef_search=None, mask=None):
+    '''
+    approximate top-k cosine search
+    :param vectors: unit length memory vectors the row indices of the index refer to
+    :param queries: unit length query vectors, shape (n_queries, n_dim_repr)
+    :param k: number of matches per query
+    :param ef_search: (optional) overrides the ef_search of the index for this call
+    :param mask: (optional) boolean array over the memory rows, only rows where it is True are returned
+    :return: two arrays of shape (n_queries, k): the memory row indices and cos similarities of the matches
+    '''
+    assert self.entry_point is not None, 'HNSW index is empty'
+    ef = max(ef_search or self.ef_search, k)
+    k = min(k, min(self.ntotal, vectors.shape[0]) if mask is None else int(np.count_nonzero(mask)))
+    indices = np.full((queries.shape[0], k), -1, dtype=np.int64)
+    similarities = np.full((queries.shape[0], k), -np.inf, dtype=np.float32)
+    for i, query in enumerate(queries):
+      entry_points = [self.entry_point]
+      for layer in range(self._level_of(self.entry_point), 0, -1):
+        entry_points = [self._search_layer(vectors, query, entry_points, 1, layer)[0][1]]
+      # nodes of the filtered set that are not reachable from the entry point are reported as row -1
+      closest = self._search_layer(vectors, query, entry_points, ef, 0, mask)[:k]
+      if closest:
+        similarities[i, :len(closest)], nodes = zip(*closest)
+        indices[i, :len(closest)] = self.node_rows.array[list(nodes)]
+    return indices, similarities
+
+
+class QuantizedIndex:
+
+  def __init__(self, codec, n_rerank=100):
+    ''' Compressed scan: all episodes are scored on their quantized codes, the n_rerank best candidates per query are
+    then rescored exactly on the float32 memory vectors
+    :param codec: codec object from core.quantization (Float16Codec, ScalarQuantizer, ProductQuantizer)
+    :param n_rerank: number of candidates per query that are rescored exactly
+    '''
+    self.codec = codec
+    self.name = codec.name
+    self.n_rerank = n_rerank
+    self.codes = None
+    self.rows = np.empty(0, dtype=np.int64)
+
+  @property
+  def ntotal(self):
+    return len(self.rows)
+
+  @property
+  def nbytes(self):
+    return self.codes.nbytes if self.codes is not None else 0
+
+  def train(self, vectors):
+    self.codec.train(vectors)
+
+  def add(self, vectors, rows):
+    '''
+    encodes episodes and appends their codes, can be called incrementally for new episodes
+    :param vectors: unit length memory vectors the row indices refer to
+    :param rows: memory row indices of the episodes to add, shape (n_new,)
+    '''
+    rows = np.asarray(rows, dtype=np.int64)
+    codes = self.codec.encode(vectors[rows])
+    self.codes = codes if self.codes is None else np.concatenate((self.codes, codes))
+    self.rows = np.concatenate((self.rows, rows))
+
+  def compact(self, vectors, keep):
+    ''' removes episodes and their codes from the index, see IVFIndex.compact '''
+    entries, self.rows = compact_rows(self.rows, keep)
+    self.codes = self.codes[entries]
+
+  def search(self, vectors, queries, k, n_rerank=None, mask=None):
+    '''
+    top-k cosine search on the codes followed by an exact rerank
+    :param vectors: unit length memory vectors the row indices of the index refer to
+    :param queries: unit length query vectors, shape (n_queries, n_dim_repr)
+    :param k: number of matches per query
+    :param n_rerank: (optional) overrides the n_rerank of the index for this call
+    :param mask: (optional) boolean array over the memory rows, only rows where it is True are returned
+    :return: two arrays of shape (n_queries, k): the memory row indices and cos similarities of the matches
+    '''
+    scores = self.codec.scores(self.codes, queries)
+    n_allowed = exclude_rows(scores, self.rows, mask)
+    k = min(k, n_allowed)
+    n_rerank = min(max(n_rerank or self.n_rerank, k), n_allowed)
+    candidates = self.rows[top_k_indices(scores, n_rerank)]
+
+    indices = np.empty((queries.shape[0], k), dtype=np.int64)
+    similarities = np.empty((queries.shape[0], k), dtype=np.float32)
+    for i, query in enumerate(queries):
+      candidate_similarities = np.dot(vectors[candidates[i]], query)
+      closest = top_k_indices(candidate_similarities[None], k)[0]
+      indices[i], similarities[i] = candidates[i, closest], candidate_similarities[closest]
+    return indices, similarities
+
+
+class CascadeIndex:
+  name = 'cascade'
+  requires_transformed = True
+
+  def __init__(self, pca, n_components=None, n_candidates=100):
+    ''' Two-stage retrieval: candidates are generated by a cosine scan in the space of the first n_components of a fitted
+    PCA, only the n_candidates best candidates per query are rescored on the full dimensional memory vectors.
+    The candidate space is computed from the PCA transformed raw vectors (e.g. hidden_reps_transformed of the memory),
+    the PCA was fitted on raw vectors, so its centering does not apply to unit length vectors
+    :param pca: fitted sklearn PCA object (e.g. the inter class PCA of the memory)
+    :param n_components: (optional) number of leading PCA components used for the candidate scan, defaults to all
+    :param n_candidates: number of candidates per query that are rescored on the full vectors
+    '''
+    self.pca = pca
+    self.n_components = n_components or pca.n_components_
+    assert self.n_components <= pca.n_components_
+    self.n_candidates = n_candidates
+    self.reduced = np.empty((0, self.n_components), dtype=np.float32)
+    self.rows = np.empty(0, dtype=np.int64)
+
+  @property
+  def ntotal(self):
+    return len(self.rows)
+
+  @property
+  def nbytes(self):
+    return self.reduced.nbytes
+
+  def project(self, transformed_vectors):
+    ''' :param transformed_vectors: PCA transformed raw vectors, shape (n_vectors, pca.n_components_) '''
+    return normalize_rows(np.asarray(transformed_vectors)[:, :self.n_components])
+
+  def add(self, vectors, rows, transformed_vectors):
+    '''
+    projects episodes into the candidate space, can be called incrementally for new episodes
+    :param vectors: unit length memory vectors the row indices refer to
+    :param rows: memory row indices of the episodes to add, shape (n_new,)
+    :param transformed_vectors: PCA transformed raw vectors of the new episodes, shape (n_new, pca.n_components_)
+    '''
+    rows = np.asarray(rows, dtype=np.int64)
+    self.reduced = np.concatenate((self.reduced, self.project(transformed_vectors)))
+    self.rows = np.concatenate((self.rows, rows))
+
+  def compact(self, vectors, keep):
+    ''' removes episodes from the index, see IVFIndex.compact '''
+    entries, self.rows = compact_rows(self.rows, keep)
+    self.reduced = self.reduced[entries]
+
+  def search(self, vectors, queries, k, n_candidates=None, mask=None, transformed_queries=None):
+    '''
+    candidate scan in the reduced PCA space followed by a rerank on the full vectors
+    :param vectors: unit length memory vectors the row indices of the index refer to
+    :param queries: unit length query vectors, shape (n_queries, n_dim_repr)
+    :param k: number of matches per query
+    :param n_candidates: (optional) overrides the n_candidates of the index for this call
+    :param mask: (optional) boolean array over the memory rows, only rows where it is True are returned
+    :param transformed_queries: PCA transformed raw query vectors, shape (n_queries, pca.n_components_)
+    :return: two arrays of shape (n_queries, k): the memory row indices and cos similarities of the matches
+    '''
+    assert transformed_queries is not None, 'the cascade index needs the PCA transformed queries'
+    scores = np.dot(self.project(transformed_queries), self.reduced.T)
+    n_allowed = exclude_rows(scores, self.rows, mask)
+    k = min(k, n_allowed)
+    n_candidates = min(max(n_candidates or self.n_candidates, k), n_allowed)
+    candidates = self.rows[top_k_indices(scores, n_candidates)]
+
+    # rerank: gather the candidate vectors of all queries, shape (n_queries, n_candidates, n_dim_repr)
+    candidate_similarities = np.einsum('ijk,ik->ij', vectors[candidates], queries)
+    closest = top_k_indices(candidate_similarities, k)
+    rows = np.arange(queries.shape[0])[:, None]
+    return candidates[rows, closest], candidate_similarities[rows, closest]
+
+
+class BinaryCodeIndex:
+  name = 'binary'
+
+  def __init__(self, n_bits=256, method='srp', n_candidates=200, n_iter=50, max_train_samples=20000, seed=None):
+    ''' Hamming prefilter: every episode is encoded as an n_bits binary code (packed into uint64 words), queries are
+    first compared by popcount of the xor of the codes, the n_candidates closest in Hamming distance are rescored by
+    their cosine similarity
+    :param n_bits: code length, a multiple of 64 - longer codes trade memory and scan time for recall
+    :param method: 'srp' (sign of random projections, approximates the angle) or 'itq' (iterative quantization,
+                   learns a rotation of the leading PCA directions, requires n_bits <= n_dim_repr)
+    :param n_candidates: number of candidates per query that are rescored by cosine similarity
+    :param n_iter: number of ITQ iterations
+    :param max_train_samples: upper bound for the number of vectors ITQ is fitted on
+    :param seed: random seed for the projections / rotation
+    '''
+    assert n_bits % 64 == 0, 'n_bits must be a multiple of 64'
+    assert method in ['srp', 'itq']
+    self.n_bits = n_bits
+    self.method = method
+    self.n_candidates = n_candidates
+    self.n_iter = n_iter
+    self.max_train_samples = max_train_samples
+    self.seed = seed
+    self.mean = None
+    self.projection = None
+    self.codes = np.empty((0, n_bits // 64), dtype=np.uint64)
+    self.rows = np.empty(0, dtype=np.int64)
+
+  @property
+  def ntotal(self):
+    return len(self.rows)
+
+  @property
+  def nbytes(self):
+    return self.codes.nbytes
+
+  def train(self, vectors):
+    random_state = np.random.RandomState(self.seed)
+    if self.method == 'srp':
+      self.mean = np.zeros(vectors.shape[1], dtype=np.float32)
+      self.projection = random_state.randn(vectors.shape[1], self.n_bits).astype(np.float32)
+      return
+
+    assert self.n_bits <= vectors.shape[1], 'itq requires n_bits <= n_dim_repr'
+    if vectors.shape[0] > self.max_train_samples:
+      vectors = vectors[random_state.choice(vectors.shape[0], self.max_train_samples, replace=False)]
+    self.mean = vectors.mean(axis=0)
+    _, _, components = np.linalg.svd(vectors - self.mean, full_matrices=False)
+    pca_projection = components[:self.n_bits].T
+    projected = np.dot(vectors - self.mean, pca_projection)
+    rotation, _ = np.linalg.qr(random_state.randn(self.n_bits, self.n_bits))
+    for _ in range(self.n_iter):
+      # fix the codes B = sign(VR), then the rotation minimizing ||B - VR|| follows from the svd of B^T V
+      codes = np.sign(np.dot(projected, rotation))
+      u, _, vt = np.linalg.svd(np.dot(codes.T, projected))
+      rotation = np.dot(u, vt).T
+    self.projection = np.dot(pca_projection, rotation).astype(np.float32)
+
+  def encode(self, vectors):
+    '''
+    :param vectors: shape (n, n_dim_repr)
+    :return: packed binary codes, shape (n, n_bits / 64), dtype uint64
+    '''
+    bits = np.dot(vectors - self.mean, self.projection) > 0
+    return np.packbits(bits, axis=1).view(np.uint64)
+
+  def add(self, vectors, rows):
+    '''
+    encodes episodes and appends their codes, can be called incrementally for new episodes
+    :param vectors: unit length memory vectors the row indices refer to
+    :param rows: memory row indices of the episodes to add, shape (n_new,)
+    '''
+    rows = np.asarray(rows, dtype=np.int64)
+    self.codes = np.concatenate((self.codes, self.encode(vectors[rows])))
+    self.rows = np.concatenate((self.rows, rows))
+
+  def compact(self, vectors, keep):
+    ''' removes episodes and their codes from the index, see IVFIndex.compact '''
+    entries, self.rows = compact_rows(self.rows, keep)
+    self.codes = self.codes[entries]
+
+  def hamming_distances(self, query_code):
+    '''
+    :param query_code: packed code of one query, shape (n_bits / 64,)
+    :return: Hamming distance of the query to all codes of the index, shape (n_episodes,)
+    '''
+    return popcount(np.bitwise_xor(self.codes, query_code)).sum(axis=1)
+
+  def buckets(self, n_prefix_bits=8):
+    '''
+    groups the episodes by the leading bits of their codes, e.g. to shard or bucket a memory
+    :param n_prefix_bits: number of leading code bits that make up the bucket id (at most 64)
+    :return: dict mapping bucket ids to arrays of memory row indices
+    '''
+    assert 0 < n_prefix_bits <= 64
+    # the packed bytes of each word are stored in big-endian bit order, byteswap to read them as one integer
+    bucket_ids = self.codes[:, 0].byteswap() >> np.uint64(64 - n_prefix_bits)
+    order = np.argsort(bucket_ids, kind='mergesort')
+    unique_ids, starts = np.unique(bucket_ids[order], return_index=True)
+    return dict(zip(unique_ids.tolist(), np.split(self.rows[order], starts[1:])))
+
+  def search(self, vectors, queries, k, n_candidates=None, mask=None):
+    '''
+    Hamming prefilter followed by a cosine rerank
+    :param vectors: unit length memory vectors the row indices of the index refer to
+    :param queries: unit length query vectors, shape (n_queries, n_dim_repr)
+    :param k: number of matches per query
+    :param n_candidates: (optional) overrides the n_candidates of the index for this call
+    :param mask: (optional) boolean array over the memory rows, only rows where it is True are returned
+    :return: two arrays of shape (n_queries, k): the memory row indices and cos similarities of the matches
+    '''
+    excluded = None if mask is None else ~mask[self.rows]
+    n_allowed = self.ntotal if mask is None else self.ntotal - int(np.count_nonzero(excluded))
+    k = min(k, n_allowed)
+    n_candidates = min(max(n_candidates or self.n_candidates, k), n_allowed)
+    query_codes = self.encode(queries)
+
+    indices = np.empty((queries.shape[0], k), dtype=np.int64)
+    similarities = np.empty((queries.shape[0], k), dtype=np.float32)
+    for i, query in enumerate(queries):
+      distances = self.hamming_distances(query_codes[i]).astype(np.float32)
+      if excluded is not None:
+        distances[excluded] = np.inf
+      candidates = self.rows[top_k_indices(-distances[None], n_candidates)[0]]
+      candidate_similarities = np.dot(vectors[candidates], query)
+      closest = top_k_indices(candidate_similarities[None], k)[0]
+      indices[i], similarities[i] = candidates[closest], candidate_similarities[closest]
+    return indices, similarities
+
+
+def exclude_rows(scores, rows, mask):
+  '''
+  sets the scores of the rows that are not selected by mask to -inf (in place)
+  :param scores: scores of the rows of an index, shape (n_queries, len(rows))
+  :param rows: memory row indices of the index entries
+  :param mask: boolean array over the memory rows or None
+  :return: number of selected index entries
+  '''
+  if mask is None:
+    return len(rows)
+  excluded = ~mask[rows]
+  scores[:, excluded] = -np.inf
+  return len(rows) - int(np.count_nonzero(excluded))
+
+def compact_rows(rows, keep):
+  '''
+  :param rows: memory row indices of index entries
+  :param keep: boolean array over the memory rows, False for removed episodes
+  :return: boolean array over the entries that are kept and their rows in the compacted memory
+  '''
+  entries = keep[rows]
+  return entries, (np.cumsum(keep) - 1)[rows[entries]]
+
+# number of set bits of every byte value
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def popcount(words):
+  '''
+  :param words: uint64 array of shape (n, n_words)
+  :return: number of set bits per word, shape (n, n_words)
+  '''
+  if hasattr(np, 'bitwise_count'):
+    return np.bitwise_count(words)
+  return POPCOUNT_TABLE[words.view(np.uint8)].reshape(words.shape + (8,)).sum(axis=2)
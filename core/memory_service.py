@@ -0,0 +1,325 @@
+import asyncio, base64, json, struct, time, itertools
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+HEADER = struct.Struct('!I') # length prefix of every message
+MAX_MESSAGE_SIZE = 256 * 1024 * 1024
+
+
+class ServiceError(Exception):
+  pass
+
+
+def encode_message(message):
+  ''' json message with numpy arrays encoded as base64 raw bytes, prefixed with its length '''
+  def encode_value(value):
+    if isinstance(value, np.ndarray):
+      return {'__ndarray__': base64.b64encode(np.ascontiguousarray(value).tobytes()).decode('ascii'),
+              'dtype': str(value.dtype), 'shape': list(value.shape)}
+    if isinstance(value, np.generic):
+      return value.item()
+    raise TypeError('not serializable: ' + str(type(value)))
+  data = json.dumps(message, default=encode_value).encode('utf-8')
+  return HEADER.pack(len(data)) + data
+
+
+def decode_message(data):
+  def decode_value(value):
+    if '__ndarray__' in value:
+      return np.frombuffer(base64.b64decode(value['__ndarray__']), dtype=value['dtype']).reshape(value['shape'])
+    return value
+  return json.loads(data.decode('utf-8'), object_hook=decode_value)
+
+
+async def read_message(reader):
+  '''
+  :return: the next decoded message or None if the connection was closed
+  '''
+  try:
+    header = await reader.readexactly(HEADER.size)
+    (size,) = HEADER.unpack(header)
+    assert size <= MAX_MESSAGE_SIZE, 'message too large'
+    return decode_message(await reader.readexactly(size))
+  except asyncio.IncompleteReadError:
+    return None
+
+
+class MemoryServer:
+
+  def __init__(self, memory, coalesce_window=0.002, max_batch_size=256, max_pending=1024):
+    ''' asyncio server that owns a Memory and answers match, store and get_episode requests over a unix or tcp socket.
+    Messages are length prefixed json, arrays are sent as base64 encoded raw bytes. Match requests that arrive within
+    coalesce_window seconds of each other are scored together with one Memory.match_batch call. Stores run on a writer
+    thread and matches / lookups on a reader thread: readers search the published version of the memory, so they are
+    not blocked by bulk inserts, and the event loop keeps accepting requests while a batch is scored
+    :param memory: Memory object
+    :param coalesce_window: seconds a match request waits for further requests to be batched with
+    :param max_batch_size: a batch is scored right away once it has max_batch_size queries
+    :param max_pending: maximum number of requests in flight over all connections, connections are not read any
+                        further while the server is at capacity (backpressure through the socket buffers)
+    '''
+    self.memory = memory
+    self.coalesce_window = coalesce_window
+    self.max_batch_size = max_batch_size
+    self.max_pending = max_pending
+    self.executor = ThreadPoolExecutor(max_workers=1)
+    self.write_executor = ThreadPoolExecutor(max_workers=1)
+    self.server = None
+    self.stats = {'requests': 0, 'batches': 0, 'batched_queries': 0, 'deadline_exceeded': 0, 'errors': 0}
+
+  async def start(self, path=None, host='127.0.0.1', port=0):
+    '''
+    starts listening on the unix socket path or, if no path is provided, on host:port
+    :return: the address the server listens on (path or (host, port))
+    '''
+    self._capacity = asyncio.Semaphore(self.max_pending)
+    self._pending_matches = []
+    self._flush_handle = None
+    if path is not None:
+      self.server = await asyncio.start_unix_server(self._handle_connection, path=path)
+      return path
+    self.server = await asyncio.start_server(self._handle_connection, host=host, port=port)
+    return self.server.sockets[0].getsockname()[:2]
+
+  async def serve_forever(self):
+    async with self.server:
+      await self.server.serve_forever()
+
+  async def close(self):
+    self.server.close()
+    await self.server.wait_closed()
+    self.executor.shutdown()
+    self.write_executor.shutdown()
+
+  async def _handle_connection(self, reader, writer):
+    write_lock = asyncio.Lock()
+    tasks = set()
+    try:
+      while True:
+        await self._capacity.acquire()
+        request = None
+        try:
+          request = await read_message(reader)
+          assert request is None or isinstance(request, dict), 'request is not a json object'
+        except (ConnectionError, AssertionError, ValueError) as e:
+          # reset connection, oversized or malformed message: the requests read so far are answered, then the
+          # connection is closed
+          self.stats['errors'] += 1
+          print('Closing connection after %s: %s' % (type(e).__name__, e))
+          request = None
+        finally:
+          if request is None:
+            self._capacity.release()
+        if request is None:
+          break
+        task = asyncio.ensure_future(self._handle_request(request, writer, write_lock))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+      if tasks:
+        await asyncio.wait(tasks)
+    finally:
+      writer.close()
+
+  async def _handle_request(self, request, writer, write_lock):
+    self.stats['requests'] += 1
+    response = {'id': request.get('id')}
+    try:
+      # the deadline is relative to the arrival of the request, in seconds
+      deadline = time.monotonic() + request['deadline'] if request.get('deadline') is not None else None
+      result = self._dispatch(request, deadline)
+      # a store that started is always awaited, its deadline is checked by the writer thread before it starts (see
+      # _store), so 'deadline exceeded' always means that nothing was stored
+      if deadline is not None and request.get('op') != 'store':
+        result = asyncio.wait_for(result, max(0.0, deadline - time.monotonic()))
+      response['result'] = await result
+      data = encode_message(response)
+    except asyncio.TimeoutError:
+      self.stats['deadline_exceeded'] += 1
+      data = encode_message({'id': response['id'], 'error': 'deadline exceeded'})
+    except Exception as e:
+      self.stats['errors'] += 1
+      data = encode_message({'id': response['id'], 'error': '%s: %s' % (type(e).__name__, e)})
+    try:
+      async with write_lock:
+        writer.write(data)
+        await writer.drain()
+    except ConnectionError:
+      pass
+    finally:
+      self._capacity.release()
+
+  def _dispatch(self, request, deadline):
+    op = request.get('op')
+    if op == 'match':
+      return self._match(np.asarray(request['query']), request.get('n_closest_matches', 5),
+                         request.get('use_transform', False), request.get('backend'), request.get('filters'), deadline)
+    if op == 'store':
+      return self._run_write(self._store, request['ids'], np.asarray(request['hidden_reps']), request['metadata'],
+                             request.get('video_file_paths'), deadline)
+    if op == 'get_episode':
+      return self._run(self._get_episode, request['episode_id'])
+    if op == 'stats':
+      return self._run(self._stats)
+    raise ServiceError('unknown op: ' + str(op))
+
+  def _run(self, fn, *args):
+    return asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+  def _run_write(self, fn, *args):
+    return asyncio.get_running_loop().run_in_executor(self.write_executor, fn, *args)
+
+  def _store(self, ids, hidden_reps, metadata, video_file_paths, deadline=None):
+    if deadline is not None and time.monotonic() > deadline:
+      raise asyncio.TimeoutError() # the store waited for the writer thread past its deadline and is not applied
+    rows = self.memory.store_episodes(ids, hidden_reps, metadata, video_file_paths)
+    return {'rows': np.asarray(rows)}
+
+  def _get_episode(self, episode_id):
+    episode = self.memory.get_episode(episode_id)
+    return {'id': episode.id, 'hidden_repr': np.asarray(episode.hidden_repr), 'metadata': episode.metadata,
+            'video_path': episode.video_episode.video_path}
+
+  def _stats(self):
+    stats = {'service': dict(self.stats), 'memory': self.memory.memory_stats()}
+    if self.memory.query_cache is not None:
+      stats['query_cache'] = self.memory.query_cache.stats()
+    return stats
+
+  def _match_batch(self, queries, k, use_transform, backend, filters):
+    # the ids are resolved on the version that was searched, evictions renumber the rows of later versions
+    version = self.memory.version
+    indices, cos_distances, paths = self.memory.match_batch(queries, k, use_transform, 1024, backend, filters, version)
+    return indices, cos_distances, paths, self.memory.episode_ids(indices, version)
+
+  def _match(self, query, n_closest_matches, use_transform, backend, filters, deadline):
+    ''' queues a match request, returns a future that is resolved when its batch was scored '''
+    future = asyncio.get_running_loop().create_future()
+    self._pending_matches.append((np.ravel(query), n_closest_matches, use_transform, backend, deadline, future,
+                                  filters))
+    if len(self._pending_matches) >= self.max_batch_size:
+      self._flush_matches()
+    elif self._flush_handle is None:
+      self._flush_handle = asyncio.get_running_loop().call_later(self.coalesce_window, self._flush_matches)
+    return future
+
+  def _flush_matches(self):
+    if self._flush_handle is not None:
+      self._flush_handle.cancel()
+      self._flush_handle = None
+    pending, self._pending_matches = self._pending_matches, []
+    now = time.monotonic()
+    # requests whose deadline passed while they were waiting are not scored (their wait_for already timed out)
+    pending = [p for p in pending if not p[5].done() and (p[4] is None or p[4] > now)]
+    key = lambda p: (p[2], str(p[3]), json.dumps(p[6], sort_keys=True))
+    for _, group in itertools.groupby(sorted(pending, key=key), key=key):
+      group = list(group)
+      asyncio.ensure_future(self._score_batch(group))
+
+  async def _score_batch(self, group):
+    ''' scores a batch of match requests with the same vector space, backend and filters, k is the maximum of the batch '''
+    use_transform, backend, filters = group[0][2], group[0][3], group[0][6]
+    k = max(p[1] for p in group)
+    self.stats['batches'] += 1
+    self.stats['batched_queries'] += len(group)
+    try:
+      indices, cos_distances, paths, episode_ids = await self._run(self._match_batch, np.stack([p[0] for p in group]), k,
+                                                                   use_transform, backend, filters)
+    except Exception as e:
+      for p in group:
+        if not p[5].done():
+          p[5].set_exception(e)
+      return
+    for i, p in enumerate(group):
+      n = p[1]
+      if not p[5].done():
+        p[5].set_result({'indices': indices[i, :n], 'ids': [str(id) for id in episode_ids[i][:n]],
+                         'cos_distances': cos_distances[i, :n], 'paths': list(paths[i][:n])})
+
+
+class MemoryClient:
+
+  def __init__(self):
+    ''' asyncio client of a MemoryServer, requests are pipelined over one connection '''
+    self.reader = None
+    self.writer = None
+    self._futures = {}
+    self._ids = itertools.count()
+
+  async def connect(self, path=None, host='127.0.0.1', port=None):
+    if path is not None:
+      self.reader, self.writer = await asyncio.open_unix_connection(path)
+    else:
+      self.reader, self.writer = await asyncio.open_connection(host, port)
+    self._receiver = asyncio.ensure_future(self._receive())
+    return self
+
+  async def _receive(self):
+    while True:
+      response = await read_message(self.reader)
+      if response is None:
+        break
+      future = self._futures.pop(response['id'], None)
+      if future is None or future.done():
+        continue
+      if 'error' in response:
+        future.set_exception(ServiceError(response['error']))
+      else:
+        future.set_result(response['result'])
+    for future in self._futures.values():
+      if not future.done():
+        future.set_exception(ServiceError('connection closed'))
+
+  async def request(self, op, deadline=None, **kwargs):
+    '''
+    sends a request and waits for its response
+    :param op: 'match', 'store', 'get_episode' or 'stats'
+    :param deadline: (optional) seconds after which the server answers with a 'deadline exceeded' error. Stores are
+                     only rejected if they did not start before the deadline, a started store is always completed and
+                     its result returned, so a store that failed with 'deadline exceeded' can be retried safely
+    :return: the result dict of the response, raises ServiceError if the server returned an error
+    '''
+    request_id = next(self._ids)
+    future = asyncio.get_running_loop().create_future()
+    self._futures[request_id] = future
+    kwargs.update({'id': request_id, 'op': op, 'deadline': deadline})
+    self.writer.write(encode_message(kwargs))
+    await self.writer.drain()
+    return await future
+
+  async def match(self, query, n_closest_matches=5, use_transform=False, backend=None, filters=None, deadline=None):
+    '''
+    :param filters: (optional) dict with value / list of values predicates on metadata columns, see Memory.filter_mask
+    '''
+    return await self.request('match', deadline=deadline, query=np.asarray(query, dtype=np.float32),
+                              n_closest_matches=n_closest_matches, use_transform=use_transform, backend=backend,
+                              filters=filters)
+
+  async def store_episodes(self, ids, hidden_reps, metadata_dicts, video_file_paths=None, deadline=None):
+    ''' :param video_file_paths: (optional) video paths relative to the base directory, None stores latent-only episodes '''
+    return await self.request('store', deadline=deadline, ids=list(ids), metadata=list(metadata_dicts),
+                              hidden_reps=np.asarray(hidden_reps, dtype=np.float32),
+                              video_file_paths=None if video_file_paths is None else list(video_file_paths))
+
+  async def get_episode(self, episode_id, deadline=None):
+    return await self.request('get_episode', deadline=deadline, episode_id=episode_id)
+
+  async def stats(self, deadline=None):
+    ''' :return: dict with the request counters of the server and the capacity / eviction / recall stats of the memory '''
+    return await self.request('stats', deadline=deadline)
+
+  async def close(self):
+    self.writer.close()
+    await self._receiver
+
+
+def run_memory_server(memory, path=None, host='127.0.0.1', port=0, **server_kwargs):
+  '''
+  serves the memory until the process is interrupted
+  :param path: (optional) unix socket path, if not provided the server listens on host:port
+  '''
+  async def serve():
+    server = MemoryServer(memory, **server_kwargs)
+    address = await server.start(path=path, host=host, port=port)
+    print('Memory service listening on', address)
+    await server.serve_forever()
+  asyncio.run(serve())
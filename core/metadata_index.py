@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+
+from core.episode_store import GrowableArray
+
+
+class MetadataIndex:
+
+  def __init__(self):
+    ''' Inverted indexes over metadata columns of the memory: for every indexed column, each distinct value maps to the
+    rows of the episodes with that value. Filters are evaluated on the distinct values only, the selected rows are then
+    gathered from the posting lists, so a filter costs O(n_distinct_values + n_selected) instead of a scan of the
+    dataframe. Columns are indexed on first use
+    '''
+    self.postings = {} # column -> {value: GrowableArray of rows}
+
+  def is_indexed(self, column):
+    return column in self.postings
+
+  def index_column(self, column, values, start=0):
+    '''
+    builds (or extends) the inverted index of a column
+    :param column: column name
+    :param values: values of the column for the rows start, start + 1, ...
+    :param start: memory row of the first value
+    '''
+    postings = self.postings.setdefault(column, {})
+    values = pd.Series(np.asarray(values, dtype=object))
+    values = values[~pd.isnull(values)]
+    for value, positions in values.groupby(values, sort=False).indices.items():
+      rows = np.asarray(positions, dtype=np.int64) + start
+      if value in postings:
+        postings[value].append(rows)
+      else:
+        postings[value] = GrowableArray(rows)
+
+  def add(self, metadata_df, start):
+    '''
+    adds new episodes to all indexed columns
+    :param metadata_df: metadata of the new episodes
+    :param start: memory row of the first new episode
+    '''
+    for column in self.postings:
+      if column in metadata_df.columns:
+        self.index_column(column, metadata_df[column].values, start=start)
+
+  def select(self, filters, n_rows):
+    '''
+    evaluates filter predicates, predicates on different columns are combined by AND
+    :param filters: dict mapping column names to a value (equality), a list / tuple / set of values (membership) or a
+                    callable that is applied to the distinct values of the column and returns a boolean
+    :param n_rows: number of rows of the memory, rows >= n_rows (stored after the version the caller reads) are ignored
+    :return: boolean mask of shape (n_rows,) with the selected rows
+    '''
+    mask = None
+    for column, predicate in filters.items():
+      assert column in self.postings, 'column %s is not indexed' % str(column)
+      postings = self.postings[column]
+      if callable(predicate):
+        values = [value for value in list(postings) if predicate(value)]
+      elif isinstance(predicate, (list, tuple, set, frozenset, np.ndarray)):
+        values = [value for value in predicate if value in postings]
+      else:
+        values = [predicate] if predicate in postings else []
+
+      column_mask = np.zeros(n_rows, dtype=bool)
+      for value in values:
+        rows = postings[value].array # ascending, rows are only appended
+        column_mask[rows[:np.searchsorted(rows, n_rows)]] = True
+      mask = column_mask if mask is None else mask & column_mask
+    return mask
@@ -0,0 +1,146 @@
+import numpy as np
+from core.indexes import normalize_rows
+
+
+class NearestClassMeanClassifier:
+
+  name = 'ncm'
+
+  def __init__(self, temperature=0.05):
+    ''' streaming nearest class mean classifier: keeps the sum and count of the (normalized) vectors of every class,
+    partial_fit and remove cost O(batch_size * n_dim). predict_proba is a softmax over the cosine similarities of a
+    query with the class means, scaled by 1 / temperature. Updates allocate new arrays instead of writing in place, so a
+    shallow copy taken before an update keeps answering with the old state (see Memory._append_episodes)
+    :param temperature: softmax temperature, smaller values give sharper class probabilities
+    '''
+    self.temperature = temperature
+    self.classes_ = np.empty(0, dtype=object)
+    self.class_sums = None
+    self.class_counts = np.empty(0, dtype=np.int64)
+
+  def _class_codes(self, labels):
+    ''' :return: index of every label in classes_, classes that were not seen yet are appended '''
+    labels = np.asarray(labels, dtype=object)
+    new_classes = [label for label in dict.fromkeys(labels) if label not in set(self.classes_)]
+    if new_classes:
+      self.classes_ = np.concatenate([self.classes_, np.asarray(new_classes, dtype=object)])
+      self.class_counts = np.concatenate([self.class_counts, np.zeros(len(new_classes), dtype=np.int64)])
+      if self.class_sums is not None:
+        self.class_sums = np.vstack([self.class_sums, np.zeros((len(new_classes), self.class_sums.shape[1]),
+                                                               dtype=self.class_sums.dtype)])
+    class_index = dict(zip(self.classes_, range(len(self.classes_))))
+    return np.array([class_index[label] for label in labels], dtype=np.int64)
+
+  def _update(self, hidden_reps, labels, sign):
+    hidden_reps = normalize_rows(np.asarray(hidden_reps, dtype=np.float32))
+    codes = self._class_codes(labels)
+    if self.class_sums is None:
+      self.class_sums = np.zeros((len(self.classes_), hidden_reps.shape[1]), dtype=np.float64)
+    sums = np.zeros_like(self.class_sums)
+    np.add.at(sums, codes, hidden_reps)
+    self.class_sums = self.class_sums + sign * sums
+    self.class_counts = self.class_counts + sign * np.bincount(codes, minlength=len(self.classes_))
+
+  def partial_fit(self, hidden_reps, labels):
+    '''
+    :param hidden_reps: vectors of new episodes, shape (n_episodes, n_dim)
+    :param labels: labels of the episodes
+    '''
+    self._update(hidden_reps, labels, 1)
+    return self
+
+  def remove(self, hidden_reps, labels):
+    ''' removes episodes (e.g. evicted ones) from the class means, classes without episodes get probability 0 '''
+    self._update(hidden_reps, labels, -1)
+    return self
+
+  def predict_proba(self, hidden_reps):
+    '''
+    :param hidden_reps: query vectors, shape (n_queries, n_dim)
+    :return: class probabilities, shape (n_queries, n_classes), columns in the order of classes_
+    '''
+    assert self.class_sums is not None, 'the classifier was not fitted yet'
+    scores = np.dot(normalize_rows(np.asarray(hidden_reps, dtype=np.float32)),
+                    normalize_rows(self.class_sums.astype(np.float32)).T) / self.temperature
+    scores[:, self.class_counts <= 0] = -np.inf
+    return softmax(scores)
+
+
+class SGDLogisticClassifier:
+
+  name = 'sgd'
+
+  def __init__(self, alpha=1e-4, eta0=0.5, power_t=0.25, n_iter=1, seed=None):
+    ''' multinomial logistic regression that is trained online with (minibatch) SGD on the normalized vectors, every
+    partial_fit call costs O(n_iter * batch_size * n_dim * n_classes). Classes that were not seen yet get new weight
+    rows, so new classes do not require a retrain. Updates allocate new arrays (see NearestClassMeanClassifier)
+    :param alpha: L2 regularization strength
+    :param eta0: initial learning rate, decayed as eta0 / (1 + n_updates) ** power_t
+    :param power_t: exponent of the learning rate decay
+    :param n_iter: number of gradient steps per partial_fit call
+    :param seed: random seed of the minibatch order
+    '''
+    self.alpha = alpha
+    self.eta0 = eta0
+    self.power_t = power_t
+    self.n_iter = n_iter
+    self.random_state = np.random.RandomState(seed)
+    self.classes_ = np.empty(0, dtype=object)
+    self.coef_ = None
+    self.intercept_ = np.empty(0, dtype=np.float32)
+    self.n_updates = 0
+
+  def _class_codes(self, labels):
+    labels = np.asarray(labels, dtype=object)
+    new_classes = [label for label in dict.fromkeys(labels) if label not in set(self.classes_)]
+    if new_classes:
+      self.classes_ = np.concatenate([self.classes_, np.asarray(new_classes, dtype=object)])
+      self.intercept_ = np.concatenate([self.intercept_, np.zeros(len(new_classes), dtype=np.float32)])
+      if self.coef_ is not None:
+        self.coef_ = np.vstack([self.coef_, np.zeros((len(new_classes), self.coef_.shape[1]), dtype=np.float32)])
+    class_index = dict(zip(self.classes_, range(len(self.classes_))))
+    return np.array([class_index[label] for label in labels], dtype=np.int64)
+
+  def partial_fit(self, hidden_reps, labels, batch_size=256):
+    '''
+    :param hidden_reps: vectors of new episodes, shape (n_episodes, n_dim)
+    :param labels: labels of the episodes
+    :param batch_size: number of episodes per gradient step
+    '''
+    hidden_reps = normalize_rows(np.asarray(hidden_reps, dtype=np.float32))
+    codes = self._class_codes(labels)
+    if self.coef_ is None:
+      self.coef_ = np.zeros((len(self.classes_), hidden_reps.shape[1]), dtype=np.float32)
+    for _ in range(self.n_iter):
+      order = self.random_state.permutation(len(codes))
+      for start in range(0, len(codes), batch_size):
+        batch = order[start:start + batch_size]
+        probs = softmax(np.dot(hidden_reps[batch], self.coef_.T) + self.intercept_)
+        probs[np.arange(len(batch)), codes[batch]] -= 1.0
+        eta = self.eta0 / (1.0 + self.n_updates) ** self.power_t
+        self.coef_ = (1.0 - eta * self.alpha) * self.coef_ - eta * np.dot(probs.T, hidden_reps[batch]) / len(batch)
+        self.intercept_ = self.intercept_ - eta * probs.mean(axis=0)
+        self.n_updates += 1
+    return self
+
+  def remove(self, hidden_reps, labels):
+    ''' the weights can not unlearn episodes, evicted episodes are forgotten as the classifier keeps training '''
+    return self
+
+  def predict_proba(self, hidden_reps):
+    '''
+    :param hidden_reps: query vectors, shape (n_queries, n_dim)
+    :return: class probabilities, shape (n_queries, n_classes), columns in the order of classes_
+    '''
+    assert self.coef_ is not None, 'the classifier was not fitted yet'
+    return softmax(np.dot(normalize_rows(np.asarray(hidden_reps, dtype=np.float32)), self.coef_.T) + self.intercept_)
+
+
+def softmax(scores):
+  scores = scores - scores.max(axis=1, keepdims=True)
+  np.exp(scores, out=scores)
+  scores /= scores.sum(axis=1, keepdims=True)
+  return scores
+
+
+ONLINE_CLASSIFIERS = {'ncm': NearestClassMeanClassifier, 'sgd': SGDLogisticClassifier}
@@ -0,0 +1,120 @@
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+
+# number of memory rows that are decompressed / scored at once
+SCAN_BLOCK_SIZE = 65536
+# product quantization: up to this many queries are scored with lookup tables instead of decoding the codes
+LOOKUP_MAX_QUERIES = 8
+
+
+class Float16Codec:
+  name = 'float16'
+
+  def train(self, vectors):
+    pass
+
+  def encode(self, vectors):
+    return np.ascontiguousarray(vectors, dtype=np.float16)
+
+  def decode(self, codes):
+    return codes.astype(np.float32)
+
+  def scores(self, codes, queries):
+    '''
+    :param codes: encoded memory vectors
+    :param queries: float32 query vectors, shape (n_queries, n_dim_repr)
+    :return: approximate dot products, shape (n_queries, n_episodes)
+    '''
+    return scan_blocks(codes, queries, self.decode)
+
+
+class ScalarQuantizer:
+  name = 'int8'
+
+  def __init__(self):
+    ''' per-dimension scalar quantization: every dimension is mapped linearly from its [min, max] range to 256 levels '''
+    self.offset = None
+    self.scale = None
+
+  def train(self, vectors):
+    v_min, v_max = vectors.min(axis=0), vectors.max(axis=0)
+    self.scale = np.maximum(v_max - v_min, 1e-12).astype(np.float32) / 255
+    self.offset = (v_min + 128 * self.scale).astype(np.float32)
+
+  def encode(self, vectors):
+    codes = np.round((vectors - self.offset) / self.scale)
+    return np.ascontiguousarray(np.clip(codes, -128, 127), dtype=np.int8)
+
+  def decode(self, codes):
+    return codes.astype(np.float32) * self.scale + self.offset
+
+  def scores(self, codes, queries):
+    # q . x = q . offset + (q * scale) . code, the codes only need a cast before the matrix product
+    return scan_blocks(codes, queries * self.scale, lambda c: c.astype(np.float32)) + \
+           np.dot(queries, self.offset)[:, None]
+
+
+class ProductQuantizer:
+  name = 'pq'
+
+  def __init__(self, n_subspaces=16, n_centroids=256, max_train_samples=50000, seed=None):
+    ''' product quantization: the vectors are split into n_subspaces sub-vectors, each is encoded by the id of its
+    closest k-means centroid (one byte per sub-vector). Queries are scored with per-subspace lookup tables
+    :param n_subspaces: number of sub-vectors (= bytes per encoded vector)
+    :param n_centroids: number of centroids per subspace, at most 256
+    :param max_train_samples: upper bound for the number of vectors the k-means are fitted on
+    :param seed: random seed for sampling and k-means
+    '''
+    assert n_centroids <= 256
+    self.n_subspaces = n_subspaces
+    self.n_centroids = n_centroids
+    self.max_train_samples = max_train_samples
+    self.seed = seed
+    self.subspaces = None
+    self.codebooks = None
+
+  def train(self, vectors):
+    if vectors.shape[0] > self.max_train_samples:
+      sample = np.random.RandomState(self.seed).choice(vectors.shape[0], self.max_train_samples, replace=False)
+      vectors = vectors[sample]
+    boundaries = np.linspace(0, vectors.shape[1], min(self.n_subspaces, vectors.shape[1]) + 1).astype(int)
+    self.subspaces = [slice(start, stop) for start, stop in zip(boundaries[:-1], boundaries[1:])]
+    n_centroids = min(self.n_centroids, vectors.shape[0])
+    self.codebooks = [MiniBatchKMeans(n_clusters=n_centroids, random_state=self.seed).fit(vectors[:, s])
+                        .cluster_centers_.astype(np.float32) for s in self.subspaces]
+
+  def encode(self, vectors):
+    codes = np.empty((vectors.shape[0], len(self.subspaces)), dtype=np.uint8)
+    for m, (s, codebook) in enumerate(zip(self.subspaces, self.codebooks)):
+      sub_vectors = vectors[:, s]
+      # argmin ||x - c||^2 = argmin ||c||^2 - 2 x.c
+      codes[:, m] = np.argmin(np.sum(codebook ** 2, axis=1) - 2 * np.dot(sub_vectors, codebook.T), axis=1)
+    return codes
+
+  def decode(self, codes):
+    return np.hstack([codebook[codes[:, m]] for m, codebook in enumerate(self.codebooks)])
+
+  def scores(self, codes, queries):
+    if queries.shape[0] > LOOKUP_MAX_QUERIES:
+      # for larger query batches decoding the codes block-wise and one matrix product per block is faster
+      return scan_blocks(codes, queries, self.decode)
+    scores = np.zeros((queries.shape[0], codes.shape[0]), dtype=np.float32)
+    for i, query in enumerate(queries):
+      for m, (s, codebook) in enumerate(zip(self.subspaces, self.codebooks)):
+        # lookup table with the partial dot products of the query and the centroids of subspace m
+        scores[i] += np.dot(codebook, query[s]).take(codes[:, m])
+    return scores
+
+
+def scan_blocks(codes, queries, decode_fn):
+  '''
+  scores queries against encoded vectors, decoding only SCAN_BLOCK_SIZE rows at once
+  :return: dot products, shape (n_queries, n_episodes)
+  '''
+  scores = np.empty((queries.shape[0], codes.shape[0]), dtype=np.float32)
+  for start in range(0, codes.shape[0], SCAN_BLOCK_SIZE):
+    scores[:, start:start + SCAN_BLOCK_SIZE] = np.dot(queries, decode_fn(codes[start:start + SCAN_BLOCK_SIZE]).T)
+  return scores
+
+
+CODECS = {'float16': Float16Codec, 'int8': ScalarQuantizer, 'pq': ProductQuantizer}
@@ -0,0 +1,73 @@
+import time, hashlib, threading, collections
+import numpy as np
+
+
+class QueryCache:
+
+  def __init__(self, max_size=1024, ttl=None, resolution=1e-3):
+    ''' LRU cache for matching results. Queries are keyed by a hash of the normalized query vector rounded to
+    multiples of resolution, so near-identical queries (e.g. repeated frames of one scene) share an entry
+    :param max_size: maximum number of cached queries, the least recently used entry is evicted first
+    :param ttl: (optional) seconds after which an entry expires
+    :param resolution: quantization step of the (unit length) query vectors
+    '''
+    self.max_size = max_size
+    self.ttl = ttl
+    self.resolution = resolution
+    self.lock = threading.Lock()
+    self._entries = collections.OrderedDict()
+    self.counters = collections.Counter(hits=0, misses=0, evictions=0, expirations=0, invalidations=0)
+
+  def key(self, query, *params):
+    '''
+    :param query: normalized query vector
+    :param params: further (hashable) parameters of the search, e.g. k, use_transform, backend and filter
+    :return: hash key of the quantized query and the parameters
+    '''
+    quantized = np.round(np.asarray(query, dtype=np.float64) / self.resolution).astype(np.int32)
+    return hashlib.blake2b(quantized.tobytes() + repr(params).encode('utf-8'), digest_size=16).digest()
+
+  def get(self, key):
+    '''
+    :return: the cached value or None
+    '''
+    with self.lock:
+      entry = self._entries.get(key)
+      if entry is not None and self.ttl is not None and time.monotonic() - entry[0] > self.ttl:
+        del self._entries[key]
+        self.counters['expirations'] += 1
+        entry = None
+      if entry is None:
+        self.counters['misses'] += 1
+        return None
+      self._entries.move_to_end(key)
+      self.counters['hits'] += 1
+      return entry[1]
+
+  def put(self, key, value):
+    with self.lock:
+      self._entries[key] = (time.monotonic(), value)
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.max_size:
+        self._entries.popitem(last=False)
+        self.counters['evictions'] += 1
+
+  def clear(self):
+    ''' invalidates all entries, e.g. after episodes were stored '''
+    with self.lock:
+      if self._entries:
+        self.counters['invalidations'] += 1
+      self._entries.clear()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def stats(self):
+    '''
+    :return: dict with the size of the cache and its hit, miss, eviction, expiration and invalidation counters
+    '''
+    with self.lock:
+      stats = dict(self.counters)
+    lookups = stats['hits'] + stats['misses']
+    stats.update({'size': len(self._entries), 'hit_rate': stats['hits'] / float(lookups) if lookups else 0.0})
+    return stats
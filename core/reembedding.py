@@ -0,0 +1,167 @@
+import os, time, threading, traceback
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+class ReembeddingJob:
+
+  def __init__(self, memory, encoder, model_fingerprint, frame_source=None, batch_size=256, n_threads=4,
+               report_interval=10.0, max_catch_up_rounds=3):
+    ''' Background job that re-encodes the episodes of a memory with another checkpoint (e.g. after retraining). The
+    stale episodes (see Memory.stale_ids) are read from the frame source in large batches, the next batch is read
+    while the current one is encoded. Queries and stores keep using the current version of the memory meanwhile.
+    Episodes that were stored while the job was running are encoded in up to max_catch_up_rounds further passes, the
+    last pass and the swap of the new embeddings (see Memory.swap_embeddings) block stores, so that the new version
+    is complete when it is published
+    :param memory: Memory object
+    :param encoder: object with an encode(clips) method that maps a batch of clips to hidden_reps
+    :param model_fingerprint: fingerprint of the checkpoint of the encoder
+    :param frame_source: (optional) FrameStore with the frames of the episodes, episodes that are not in it are read
+                         from their video files
+    :param batch_size: number of episodes that are encoded with one encoder call
+    :param n_threads: number of threads that read the frames of a batch
+    :param report_interval: seconds between progress reports
+    :param max_catch_up_rounds: number of passes over episodes stored during the job before stores are blocked
+    '''
+    self.memory = memory
+    self.encoder = encoder
+    self.model_fingerprint = model_fingerprint
+    self.frame_source = frame_source
+    self.batch_size = batch_size
+    self.n_threads = n_threads
+    self.report_interval = report_interval
+    self.max_catch_up_rounds = max_catch_up_rounds
+
+    self.status = 'created'
+    self.error = None
+    self.removed_ids = None
+    self._ids, self._hidden_reps = [], []
+    self._encoded_ids, self._failed_ids = set(), set()
+    self._n_total = 0
+    self._start_time = self._last_report = None
+    self._thread = None
+    self._cancel = threading.Event()
+
+  def start(self):
+    self._thread = threading.Thread(target=self.run, name='memory_reembedding')
+    self._thread.daemon = True
+    self._thread.start()
+    return self
+
+  def is_alive(self):
+    return self._thread is not None and self._thread.is_alive()
+
+  def join(self, timeout=None):
+    self._thread.join(timeout)
+
+  def cancel(self):
+    ''' stops the job after the current batch, the memory keeps its current embeddings '''
+    self._cancel.set()
+
+  def progress(self):
+    '''
+    :return: dict with the status ('created', 'running', 'swapping', 'done', 'cancelled' or 'failed'), the number of
+             total / encoded / failed (no frames) episodes, the throughput in episodes per second and the estimated
+             seconds until all episodes are encoded
+    '''
+    n_done = len(self._encoded_ids) + len(self._failed_ids)
+    elapsed = time.time() - self._start_time if self._start_time is not None else 0.0
+    throughput = n_done / elapsed if elapsed > 0 else 0.0
+    return {'status': self.status, 'total': self._n_total, 'encoded': len(self._encoded_ids),
+            'failed': len(self._failed_ids), 'elapsed': elapsed, 'episodes_per_sec': throughput,
+            'eta': (self._n_total - n_done) / throughput if throughput > 0 else None}
+
+  def _report(self, force=False):
+    if not force and time.time() - self._last_report < self.report_interval:
+      return
+    self._last_report = time.time()
+    progress = self.progress()
+    print('Re-embedding with %s: %i / %i episodes (%i without frames), %.1f episodes/s, eta %s' % (
+      self.model_fingerprint, progress['encoded'], progress['total'], progress['failed'], progress['episodes_per_sec'],
+      '%.0fs' % progress['eta'] if progress['eta'] is not None else '-'))
+
+  def run(self):
+    self.status = 'running'
+    self._start_time = self._last_report = time.time()
+    try:
+      ids = self._pending_ids()
+      for _ in range(self.max_catch_up_rounds + 1):
+        if not ids or self._cancel.is_set():
+          break
+        self._encode(ids)
+        ids = self._pending_ids()
+
+      if self._cancel.is_set():
+        self.status = 'cancelled'
+        print('Re-embedding with %s cancelled' % self.model_fingerprint)
+        return
+      # the episodes stored since the last pass are encoded while stores are blocked, the new version is published
+      # when the swap finished
+      with self.memory._writing():
+        self._encode(self._pending_ids())
+        if self._cancel.is_set():
+          self.status = 'cancelled'
+          return
+        if not self._ids:
+          assert not self._failed_ids, 'the frames of none of the stale episodes could be read'
+          self.status, self.removed_ids = 'done', []
+          return
+        self.status = 'swapping'
+        self.removed_ids = self.memory.swap_embeddings(self._ids, np.concatenate(self._hidden_reps),
+                                                       self.model_fingerprint)
+      self.status = 'done'
+      self._report(force=True)
+      print('Swapped in the embeddings of %s, removed %i episodes without frames' % (self.model_fingerprint,
+                                                                                    len(self.removed_ids)))
+    except Exception as e:
+      self.status, self.error = 'failed', e
+      traceback.print_exc()
+
+  def _pending_ids(self):
+    ''' stale episodes that were neither encoded nor failed yet '''
+    ids = [id for id in self.memory.stale_ids(self.model_fingerprint)
+           if id not in self._encoded_ids and id not in self._failed_ids]
+    self._n_total = len(self._encoded_ids) + len(self._failed_ids) + len(ids)
+    return ids
+
+  def _encode(self, ids):
+    # the video paths are looked up here, the readers must not wait for the write lock that the last pass holds
+    video_paths = self.memory.episode_video_paths(ids)
+    batches = [(ids[start:start + self.batch_size], video_paths[start:start + self.batch_size])
+               for start in range(0, len(ids), self.batch_size)]
+    with ThreadPoolExecutor(max_workers=self.n_threads) as readers, ThreadPoolExecutor(max_workers=1) as prefetcher:
+      future = prefetcher.submit(self._read_frames, batches[0][0], batches[0][1], readers) if batches else None
+      for i in range(len(batches)):
+        batch_ids, clips = future.result()
+        if i + 1 < len(batches):
+          future = prefetcher.submit(self._read_frames, batches[i + 1][0], batches[i + 1][1], readers)
+        if self._cancel.is_set():
+          return
+        if batch_ids:
+          self._hidden_reps.append(np.asarray(self.encoder.encode(clips), dtype=np.float32).reshape(len(batch_ids), -1))
+          self._ids.extend(batch_ids)
+          self._encoded_ids.update(batch_ids)
+        self._failed_ids.update(set(batches[i][0]) - set(batch_ids))
+        self._report()
+
+  def _read_frames(self, ids, video_paths, readers):
+    '''
+    :return: ids of the episodes whose frames could be read and their clips, from the frame source if it has the
+             episode, else from the video file
+    '''
+    in_source = [self.frame_source is not None and id in self.frame_source for id in ids]
+    video_paths = [video_path for video_path, stored in zip(video_paths, in_source) if not stored]
+
+    def load_video(video_path):
+      if video_path is None or not os.path.exists(video_path):
+        return None
+      from utils import io_handler # see Memory.LazyVideoEpisode.frames
+      try:
+        return io_handler.load_video_frames(video_path)
+      except Exception as e: # unreadable video, the episode counts as failed
+        print('Could not read %s: %s' % (video_path, e))
+        return None
+
+    videos = iter(list(readers.map(load_video, video_paths)))
+    clips = [self.frame_source.get(id) if stored else next(videos) for id, stored in zip(ids, in_source)]
+    return [id for id, clip in zip(ids, clips) if clip is not None], [clip for clip in clips if clip is not None]
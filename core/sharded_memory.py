@@ -0,0 +1,202 @@
+import os, zlib, shutil, tempfile, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from core.indexes import normalize_rows, top_k_indices
+
+PARTITIONS = ('hash', 'category', 'segment')
+
+# state of a shard worker process, set by _load_shard
+_shard = {}
+
+
+def _load_shard(shard_dir):
+  ''' initializer of a shard worker: memory maps the normalized matrices of its shard, the pages are shared with
+  all other processes that map the same files '''
+  _shard['rows'] = np.load(os.path.join(shard_dir, 'rows.npy'))
+  _shard[False] = np.load(os.path.join(shard_dir, 'hidden_reps_normed.npy'), mmap_mode='r')
+  _shard[True] = np.load(os.path.join(shard_dir, 'hidden_reps_transformed_normed.npy'), mmap_mode='r')
+
+
+def _search_shard(queries, k, use_transform, batch_size, mask=None):
+  '''
+  exact top-k of normalized queries within the shard of the worker process
+  :param mask: (optional) boolean array over all memory rows, only the selected rows of the shard are scored
+  :return: global memory rows and cos similarities of the local top-k, shape (n_queries, min(k, shard size)) each
+  '''
+  matrix, shard_rows = _shard[use_transform], _shard['rows']
+  if mask is not None:
+    selected = np.flatnonzero(mask[shard_rows])
+    matrix, shard_rows = matrix[selected], shard_rows[selected]
+  k = min(k, matrix.shape[0])
+  rows = np.empty((queries.shape[0], k), dtype=np.int64)
+  similarities = np.empty((queries.shape[0], k), dtype=np.float32)
+  for start in range(0, queries.shape[0], batch_size):
+    block = slice(start, start + batch_size)
+    scores = np.dot(queries[block], matrix.T)
+    local = top_k_indices(scores, k)
+    similarities[block] = scores[np.arange(scores.shape[0])[:, None], local]
+    rows[block] = shard_rows[local]
+  return rows, similarities
+
+
+def _ping():
+  return os.getpid()
+
+
+class ShardedMemory:
+
+  def __init__(self, memory, n_shards=None, partition='hash', shard_dir=None, blas_threads=1):
+    ''' Fans the exact matching of a Memory out to n_shards worker processes. The episodes are partitioned across the
+    shards, every worker memory maps the normalized matrices of its shard, scores the broadcast queries and returns its
+    local top-k, which are merged into the global top-k. The shards are a snapshot of the published memory version,
+    call refresh() after episodes were stored
+    :param memory: Memory object
+    :param n_shards: number of shards / worker processes, defaults to the number of cores
+    :param partition: 'hash' (crc32 of the episode id), 'category' (whole classes, balanced by episode count) or
+                      'segment' (contiguous row ranges)
+    :param shard_dir: (optional) directory for the shard files, defaults to a temporary directory that is removed by close()
+    :param blas_threads: number of BLAS threads per worker, 1 avoids oversubscribing the cores
+    '''
+    assert partition in PARTITIONS, 'partition must be one of ' + str(PARTITIONS)
+    self.memory = memory
+    self.n_shards = n_shards or multiprocessing.cpu_count()
+    self.partition = partition
+    self.blas_threads = blas_threads
+    self._owns_shard_dir = shard_dir is None
+    self.shard_dir = shard_dir or tempfile.mkdtemp(prefix='memory_shards_')
+    self.executors = []
+    self.refresh()
+
+  def _partition_rows(self):
+    '''
+    :return: list with the memory rows of every shard
+    '''
+    n_episodes = self.version.n_episodes
+    if self.partition == 'segment':
+      return np.array_split(np.arange(n_episodes), self.n_shards)
+    if self.partition == 'hash':
+      shard_ids = np.array([zlib.crc32(str(id).encode('utf-8')) % self.n_shards for id in self.version.columns['ids']])
+    else:
+      # greedy balancing: the largest classes first, each to the shard with the fewest episodes so far
+      labels, label_index, counts = np.unique(self.version.columns['labels'].astype(str), return_inverse=True,
+                                              return_counts=True)
+      shard_of_label = np.empty(len(labels), dtype=np.int64)
+      shard_sizes = np.zeros(self.n_shards, dtype=np.int64)
+      for label in np.argsort(-counts):
+        shard_of_label[label] = np.argmin(shard_sizes)
+        shard_sizes[shard_of_label[label]] += counts[label]
+      shard_ids = shard_of_label[label_index]
+    return [np.flatnonzero(shard_ids == shard) for shard in range(self.n_shards)]
+
+  def refresh(self):
+    ''' (re)partitions the current episodes of the memory and restarts the shard workers '''
+    self.close_workers()
+    self.memory.reproject()
+    self.version = self.memory.version
+    shard_dirs = []
+    for shard, rows in enumerate(self._partition_rows()):
+      if len(rows) == 0:
+        continue
+      shard_dirs.append(os.path.join(self.shard_dir, 'shard_%03i' % shard))
+      if not os.path.isdir(shard_dirs[-1]):
+        os.makedirs(shard_dirs[-1])
+      np.save(os.path.join(shard_dirs[-1], 'rows.npy'), rows)
+      np.save(os.path.join(shard_dirs[-1], 'hidden_reps_normed.npy'), self.version.matrices['hidden_reps_normed'][rows])
+      np.save(os.path.join(shard_dirs[-1], 'hidden_reps_transformed_normed.npy'),
+              self.version.matrices['hidden_reps_transformed_normed'][rows])
+
+    # the BLAS thread count is read when numpy is imported in the (spawned) workers, so it is set in the environment
+    # they inherit and all workers are started before it is restored
+    thread_vars = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+    previous = dict((var, os.environ.get(var)) for var in thread_vars)
+    os.environ.update(dict((var, str(self.blas_threads)) for var in thread_vars))
+    try:
+      context = multiprocessing.get_context('spawn')
+      self.executors = [ProcessPoolExecutor(max_workers=1, mp_context=context, initializer=_load_shard,
+                                            initargs=(shard_dir,)) for shard_dir in shard_dirs]
+      [future.result() for future in [executor.submit(_ping) for executor in self.executors]]
+    finally:
+      for var, value in previous.items():
+        if value is None:
+          os.environ.pop(var, None)
+        else:
+          os.environ[var] = value
+
+  def matching(self, query_hidden_repr, n_closest_matches=5, use_transform=False, backend=None, filters=None):
+    '''
+    finds the closest vector matches (cos_similarity) for a given query vector, see Memory.matching
+    :param backend: (optional) None / 'exact' for the exact scan of the shards or the name of an index built on the memory
+    :param filters: (optional) dict with predicates on metadata columns, see Memory.filter_mask
+    :return: four arrays, containing:
+          1. the n_clostest_matches by id
+          2. the n_closest_matches by computed pairwise cos distance
+          3. the n_closest_matches hidden representations
+          4. the n_closest_matches absolute paths to the memory episodes in the base directory of the memory
+    '''
+    if use_transform:
+      memory_hidden_reps = self.version.matrices['hidden_reps_transformed']
+    else:
+      memory_hidden_reps = self.version.matrices['hidden_reps']
+    indices_closest, cos_distances, absolute_paths = self.match_batch(np.expand_dims(np.ravel(query_hidden_repr), axis=0),
+                                                                      n_closest_matches=n_closest_matches,
+                                                                      use_transform=use_transform, backend=backend,
+                                                                      filters=filters)
+    return indices_closest[0], cos_distances[0], memory_hidden_reps[indices_closest[0]], absolute_paths[0]
+
+  def match_batch(self, query_hidden_reprs, n_closest_matches=5, use_transform=False, batch_size=1024, backend=None,
+                  filters=None):
+    '''
+    broadcasts a batch of queries to all shards and merges their local top-k, see Memory.match_batch
+    :param backend: (optional) None / 'exact' for the exact scan of the shards. Other backends are indexes of the memory
+                    process and are searched there, on the memory version of the shards
+    :param filters: (optional) dict with predicates on metadata columns, only matching episodes are returned, see
+                    Memory.filter_mask
+    :return: three objects, containing:
+          1. array of shape (n_queries, n_closest_matches) with the memory indices of the closest matches
+          2. array of shape (n_queries, n_closest_matches) with the corresponding cos distances
+          3. list with one list of absolute paths to the matched memory episodes per query
+    '''
+    if backend not in (None, 'exact'):
+      return self.memory.match_batch(query_hidden_reprs, n_closest_matches, use_transform=use_transform,
+                                     batch_size=batch_size, backend=backend, filters=filters, version=self.version)
+    query_hidden_reprs = np.asarray(query_hidden_reprs)
+    query_hidden_reprs = query_hidden_reprs.reshape(query_hidden_reprs.shape[0], -1)
+    if use_transform:
+      query_hidden_reprs = self.version.inter_class_pca.transform(query_hidden_reprs)
+    query_hidden_reprs = normalize_rows(query_hidden_reprs)
+    mask = self.memory.filter_mask(filters, version=self.version) if filters else None
+    n_selected = self.version.n_episodes if mask is None else int(np.count_nonzero(mask))
+    if min(n_closest_matches, n_selected) == 0:
+      return np.empty((query_hidden_reprs.shape[0], 0), dtype=np.int64), \
+             np.empty((query_hidden_reprs.shape[0], 0), dtype=np.float32), [[] for _ in query_hidden_reprs]
+
+    futures = [executor.submit(_search_shard, query_hidden_reprs, n_closest_matches, use_transform, batch_size, mask)
+               for executor in self.executors]
+    results = [future.result() for future in futures]
+    rows = np.hstack([r for r, _ in results])
+    similarities = np.hstack([s for _, s in results])
+
+    # merge: top-k of the n_shards * k local candidates per query
+    merged = top_k_indices(similarities, min(n_closest_matches, similarities.shape[1]))
+    query_index = np.arange(rows.shape[0])[:, None]
+    indices_closest, cos_similarities = rows[query_index, merged], similarities[query_index, merged]
+    return indices_closest, 1.0 - cos_similarities, \
+           [self.memory.absolute_video_paths(indices, self.version) for indices in indices_closest]
+
+  def close_workers(self):
+    for executor in self.executors:
+      executor.shutdown()
+    self.executors = []
+
+  def close(self):
+    ''' stops the shard workers and removes the shard files if the shard directory was created by this object '''
+    self.close_workers()
+    if self._owns_shard_dir:
+      shutil.rmtree(self.shard_dir, ignore_errors=True)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
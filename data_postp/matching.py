@@ -8,7 +8,9 @@ import sklearn, sklearn.ensemble
 import pandas as pd
 import utils.io_handler as io_handler
 
-from data_postp.similarity_computations import df_col_to_matrix, transform_vectors_with_inter_class_pca, compute_cosine_similarity, inter_class_pca, top_n_accuracy
+from data_postp.similarity_computations import df_col_to_matrix, transform_vectors_with_inter_class_pca, inter_class_pca, top_n_accuracy
+from core.Memory import composite_top_k, class_label_codes
+from core.indexes import normalize_rows
 
 
 
@@ -25,17 +27,21 @@ PICKLE_ARMAR_EXPERIENCES_QUERY = '/data/rothfuss/data/ArmarExperiences/hidden_re
 PICKLE_ARMAR_EXPERIENCES_HALF_ACTION = '/data/rothfuss/data/ArmarExperiences/hidden_reps/hidden_repr_query_half.pickle'
 
 def closest_vector_analysis_composite(df, df_query, base_dir, target_dir, n_pca_matching=20, n_pca_classifier=50,
-                                                 class_column='category', n_closest_matches=5, lambda_weight=0.5, augmented=False, output_type='gif'):
+                                                 class_column='category', n_closest_matches=5, lambda_weight=0.5, augmented=False, output_type='gif',
+                                                 classifier=None):
+  ''' classifier: (optional) fitted classifier of the raw hidden_reps (e.g. the online classifier of a memory, see
+  Memory.enable_online_classifier), skips the training of the logistic regression '''
 
   assert output_type in ['gif', 'png'], "output type must be either gif or png"
   #Preparation Part 1: prepare classifier and classifier_pca
-  #train logistic regression on pca components of hidden_reps in df --> returns classifier and pca object
-  classifier, pca_classifier, _, _ = train_and_dump_classifier(df, class_column=class_column, n_components=n_pca_classifier)
-
-  # generate pca transformed query df for classifiaction pca
   df_query_classification = df_query.copy()
-  transformed_vectors_as_matrix = pca_classifier.transform(df_col_to_matrix(df_query['hidden_repr']))
-  df_query_classification['hidden_repr'] = np.split(transformed_vectors_as_matrix, transformed_vectors_as_matrix.shape[0])
+  if classifier is None:
+    #train logistic regression on pca components of hidden_reps in df --> returns classifier and pca object
+    classifier, pca_classifier, _, _ = train_and_dump_classifier(df, class_column=class_column, n_components=n_pca_classifier)
+
+    # generate pca transformed query df for classifiaction pca
+    transformed_vectors_as_matrix = pca_classifier.transform(df_col_to_matrix(df_query['hidden_repr']))
+    df_query_classification['hidden_repr'] = np.split(transformed_vectors_as_matrix, transformed_vectors_as_matrix.shape[0])
 
   #Preparation Part 2: prepare pca transform for matching
   df_pca_matching, df_query_matching, pca_matching = transform_vectors_with_inter_class_pca(df, df_2=df_query, n_components=n_pca_matching, return_pca_object=True)
@@ -50,22 +56,21 @@ def closest_vector_analysis_composite(df, df_query, base_dir, target_dir, n_pca_
   print(target_dir)
   os.mkdir(target_dir)
   print("Created directory:", target_dir)
-  # Production: Iterate over queries in df_query
-  for hidden_repr_matching, hidden_repr_classification, label, category in zip(df_query_matching['hidden_repr'], df_query_classification['hidden_repr'],
-                                                                               df_query_matching['label'], df_query_matching[class_column]):
+  # Production: score all queries at once: one predict_proba call, composite scores as block-wise matrix products
+  query_class_probs = classifier.predict_proba(df_col_to_matrix(df_query_classification['hidden_repr']))
+  memory_labels, memory_video_ids = df_pca_matching[class_column].values, df_pca_matching['video_id'].values
+  closest_indices, closest_scores = composite_top_k(normalize_rows(df_col_to_matrix(df_pca_matching['hidden_repr'])),
+                                                    class_label_codes(memory_labels, classifier.classes_),
+                                                    query_class_probs,
+                                                    normalize_rows(df_col_to_matrix(df_query_matching['hidden_repr'])),
+                                                    n_closest_matches, lambda_weight=lambda_weight)
+
+  # Iterate over queries in df_query
+  for q, (label, category) in enumerate(zip(df_query_matching['label'], df_query_matching[class_column])):
     try:
-      class_prob_dict = dict(zip(classifier.classes_, classifier.predict_proba(hidden_repr_classification).flatten().tolist()))
-      pprint(sorted(class_prob_dict.items(), key=lambda tup: tup[1], reverse=True)[:5])
-      composite_scores= []
-      for v, l, v_id in zip(df_pca_matching['hidden_repr'], df_pca_matching[class_column], df_pca_matching['video_id']):
-        class_prob = class_prob_dict[l]
-        cos_sim = compute_cosine_similarity(v, hidden_repr_matching)
-        composite_score = (1-lambda_weight) * class_prob + lambda_weight * cos_sim
-        composite_scores.append((composite_score, l, int(v_id)))
-
-      sorted_scores = sorted(composite_scores, key=lambda tup: tup[0], reverse=True)
-
-      closest_vectors = sorted_scores[:n_closest_matches]
+      pprint(sorted(zip(classifier.classes_, query_class_probs[q]), key=lambda tup: tup[1], reverse=True)[:5])
+      closest_vectors = [(closest_scores[q, i], memory_labels[j], int(memory_video_ids[j]))
+                         for i, j in enumerate(closest_indices[q])]
 
       label = label.replace("_9", "")
       print(label, category, n_closest_matches)
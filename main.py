@@ -1,3 +1,4 @@
+import os
 import tensorflow as tf
 import pandas as pd
 import numpy as np
@@ -60,8 +61,12 @@ def main(argv):
     """ scenario 2: load the memory and query it with the hidden reps to get nearest neighbours  """
     # alternatively, run a validation with the 'memory_prep' VALID MODE (settings) and set memory path in settings
     assert FLAGS.memory_path
-    memory_df = pd.read_pickle(FLAGS.memory_path)
-    memory = Memory(memory_df, '/common/homes/students/rothfuss/Documents/example/base_dir')
+    if os.path.isdir(FLAGS.memory_path):
+      # memory bundle directory, see core.Memory.write_memory_bundle
+      memory = Memory.load(FLAGS.memory_path)
+    else:
+      memory_df = pd.read_pickle(FLAGS.memory_path)
+      memory = Memory(memory_df, '/common/homes/students/rothfuss/Documents/example/base_dir')
 
     # choose e.g. first hidden representation
     query = hidden_repr[0]
@@ -52,7 +52,7 @@ MEMORY_PATH = ""
 # --- INFORMAL LOCAL VARIABLES --- #
 LOSS_FUNCTIONS = ['mse', 'gdl', 'mse_gdl', 'vae']
 MODES = ["train_mode", "valid_mode", "feeding_mode"]
-VALID_MODES = ['count_trainable_weights', 'vector', 'gif', 'similarity', 'data_frame', 'psnr', 'memory_prep', 'measure_test_time']
+VALID_MODES = ['count_trainable_weights', 'vector', 'gif', 'similarity', 'data_frame', 'psnr', 'memory_prep', 'latent_only', 'frame_store', 'measure_test_time']
 
 
 
@@ -122,7 +122,9 @@ flags.DEFINE_string('valid_mode', VALID_MODE, 'Allowed modes: ' + str(
                  '"similarity": compute (cos) similarity matrix'
                  '"data_frame": the model output is retrieved as a df'
                  '"count_trainable_weights": number of tr. weights is emitted to the'
-                 'console')
+                 'console'
+                 '"latent_only": with "memory_prep", no gif is written per episode (frames are decoded on recall)'
+                 '"frame_store": with "memory_prep", the frames are appended to one frame store instead of a gif per episode')
 
 flags.DEFINE_string('pretrained_model', PRETRAINED_MODEL, 'filepath of a pretrained model to initialize from.')
 flags.DEFINE_string('exclude_from_restoring', EXCLUDE_FROM_RESTORING,
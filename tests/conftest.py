@@ -0,0 +1,13 @@
+import pytest
+from core.Memory import Memory
+from tests.synthetic import synthetic_memory_df
+
+
+@pytest.fixture
+def memory_df():
+  return synthetic_memory_df()
+
+
+@pytest.fixture
+def memory(memory_df, tmp_path):
+  return Memory(memory_df, str(tmp_path), check_sanity=False)
@@ -0,0 +1,18 @@
+import numpy as np
+import pandas as pd
+
+
+def synthetic_memory_df(n_episodes=3000, n_dim=64, n_classes=60, seed=0):
+  ''' memory dataframe with gaussian clusters around one random center per class (n_dim >= 50 for the inter class PCA),
+  the episodes have no video files '''
+  random_state = np.random.RandomState(seed)
+  centers = random_state.randn(n_classes, n_dim)
+  labels = random_state.randint(0, n_classes, n_episodes)
+  hidden_reps = centers[labels] + 0.8 * random_state.randn(n_episodes, n_dim)
+  return pd.DataFrame({'id': ['%05d' % i for i in range(n_episodes)], 'category': ['c%i' % l for l in labels],
+                       'hidden_repr': list(hidden_reps), 'video_file_path': [None] * n_episodes})
+
+
+def noisy_queries(memory_df, n_queries=200, noise=0.3, seed=1):
+  hidden_reps = np.stack(memory_df['hidden_repr'][:n_queries])
+  return hidden_reps + noise * np.random.RandomState(seed).randn(*hidden_reps.shape)
@@ -0,0 +1,38 @@
+import numpy as np
+from sklearn.linear_model import LogisticRegression
+from core.Memory import composite_top_k, class_label_codes
+from core.indexes import normalize_rows
+from tests.synthetic import noisy_queries
+
+
+def naive_composite_scores(memory_hidden_reps, labels, classes, class_probs, queries, lambda_weight):
+  scores = np.zeros((len(queries), len(memory_hidden_reps)))
+  for i, query in enumerate(queries):
+    for j, (hidden_rep, label) in enumerate(zip(memory_hidden_reps, labels)):
+      p = class_probs[i, list(classes).index(label)] if label in classes else 0.0
+      cos_similarity = np.dot(query, hidden_rep) / np.linalg.norm(query) / np.linalg.norm(hidden_rep)
+      scores[i, j] = (1 - lambda_weight) * p + lambda_weight * cos_similarity
+  return scores
+
+
+def test_composite_top_k_agrees_with_naive_loop():
+  random_state = np.random.RandomState(0)
+  memory_hidden_reps, queries = random_state.randn(300, 16), random_state.randn(20, 16)
+  labels = np.array(['c%i' % i for i in random_state.randint(0, 6, 300)]) # 'c5' is unknown to the classifier
+  classes = np.array(['c%i' % i for i in range(5)])
+  class_probs = random_state.dirichlet(np.ones(5), 20)
+  expected = naive_composite_scores(memory_hidden_reps, labels, classes, class_probs, queries, 0.3)
+  indices, scores = composite_top_k(normalize_rows(memory_hidden_reps), class_label_codes(labels, classes), class_probs,
+                                    normalize_rows(queries), 10, lambda_weight=0.3, batch_size=7)
+  np.testing.assert_array_equal(indices, np.argsort(-expected, axis=1, kind='mergesort')[:, :10])
+  np.testing.assert_allclose(scores, np.sort(expected, axis=1)[:, ::-1][:, :10], atol=1e-5)
+
+
+def test_composite_match_batch(memory, memory_df):
+  classifier = LogisticRegression(max_iter=200).fit(np.stack(memory_df['hidden_repr']), memory_df['category'])
+  queries = noisy_queries(memory_df, n_queries=10)
+  indices, scores, paths = memory.composite_match_batch(queries, classifier, lambda_weight=0.5, n_closest_matches=5)
+  expected = naive_composite_scores(memory.hidden_reps, memory_df['category'].values, classifier.classes_,
+                                    classifier.predict_proba(queries), queries, 0.5)
+  np.testing.assert_allclose(scores, np.sort(expected, axis=1)[:, ::-1][:, :5], atol=1e-5)
+  assert indices.shape == (10, 5) and len(paths) == 10
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+
+class FakeDecoder:
+  ''' clips filled with the (rounded) first component of the hidden_rep, future clips are negated '''
+
+  def __init__(self):
+    self.calls = []
+
+  def decode(self, hidden_reps, kind):
+    self.calls.append((len(hidden_reps), kind))
+    values = np.round(np.abs(hidden_reps[:, 0]) * 10).astype(np.uint8)
+    clips = np.ones((len(hidden_reps), 2, 4, 4, 3), dtype=np.uint8) * values[:, None, None, None, None]
+    return clips if kind == 'reconst' else 255 - clips
+
+
+def expected_clip(memory, id):
+  return np.full((2, 4, 4, 3), np.round(abs(memory.get_episode(id).hidden_repr[0]) * 10), dtype=np.uint8)
+
+
+def test_recall_frames_decodes_in_batches_and_caches(memory):
+  decoder = FakeDecoder()
+  memory.attach_decoder(decoder, batch_size=4, cache_size=16)
+  ids = list(memory.version.columns['ids'][:10])
+  clips = memory.recall_frames(ids + ids[:2])
+  assert decoder.calls == [(4, 'reconst'), (4, 'reconst'), (2, 'reconst')]
+  for id, clip in zip(ids + ids[:2], clips):
+    np.testing.assert_array_equal(clip, expected_clip(memory, id))
+
+  # cached clips are not decoded again, future clips are cached separately
+  memory.recall_frames(ids[5:])
+  future = memory.predict_future(ids[:1])
+  assert decoder.calls[3:] == [(1, 'future')]
+  np.testing.assert_array_equal(future[0], 255 - expected_clip(memory, ids[0]))
+  with pytest.raises(AssertionError):
+    memory.recall_frames(['unknown'])
+
+
+def test_latent_only_episodes_are_decoded(memory):
+  memory.store_episodes(['latent'], [np.full(64, 0.5)], [{'category': 'c0'}])
+  with pytest.raises(AssertionError): # no video and no decoder
+    memory.get_episode('latent').video_episode.frames
+  decoder = FakeDecoder()
+  memory.attach_decoder(decoder)
+  np.testing.assert_array_equal(memory.get_episode('latent').video_episode.frames, np.full((2, 4, 4, 3), 5))
+
+  # stored episodes with an evicted id get new clips
+  memory.remove_rows([memory.id_to_row['latent']])
+  memory.store_episodes(['latent'], [np.full(64, 0.9)], [{'category': 'c0'}])
+  np.testing.assert_array_equal(memory.recall_frames(['latent'])[0], np.full((2, 4, 4, 3), 9))
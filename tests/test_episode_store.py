@@ -0,0 +1,100 @@
+import os, shutil, threading
+import numpy as np
+from core.episode_store import EpisodeStore
+
+
+def append_episodes(store, ids, value):
+  store.append(ids, np.full((len(ids), 4), value, dtype=np.float32), [{'category': 'c%i' % value}] * len(ids),
+               [None] * len(ids))
+
+
+def stored(store):
+  embeddings, metadata_df = store.read_all()
+  return dict(zip(metadata_df['id'], embeddings[:, 0]))
+
+
+def test_round_trip_and_reopen(tmp_path):
+  store = EpisodeStore(str(tmp_path), segment_size=4)
+  embeddings, metadata_df = store.read_all()
+  assert embeddings.shape[0] == 0 and list(metadata_df.columns) == ['id', 'video_file_path']
+
+  append_episodes(store, ['a', 'b', 'c'], 1)
+  append_episodes(store, ['d', 'e', 'f'], 2) # seals the tail
+  assert store.n_sealed == 6 and len(store) == 6
+  append_episodes(store, ['g'], 3)
+  embeddings, metadata_df = store.read_all()
+  assert list(metadata_df['id']) == ['a', 'b', 'c', 'd', 'e', 'f', 'g']
+  assert list(metadata_df['category']) == ['c1'] * 3 + ['c2'] * 3 + ['c3']
+  np.testing.assert_array_equal(embeddings[:, 0], [1, 1, 1, 2, 2, 2, 3])
+  assert stored(EpisodeStore(str(tmp_path), segment_size=4)) == stored(store)
+
+
+def test_delete_then_restore(tmp_path):
+  store = EpisodeStore(str(tmp_path), segment_size=2)
+  append_episodes(store, ['a', 'b', 'c'], 1)
+  store.delete(['b'])
+  assert stored(store) == {'a': 1, 'c': 1}
+
+  # an evicted id that is stored again is kept, the tombstone only covers the episode stored before it
+  append_episodes(store, ['b'], 7)
+  assert stored(store) == {'a': 1, 'c': 1, 'b': 7}
+  reopened = EpisodeStore(str(tmp_path), segment_size=2)
+  assert stored(reopened) == {'a': 1, 'c': 1, 'b': 7}
+
+  append_episodes(reopened, ['d', 'e'], 2)
+  reopened.delete(['a', 'd'])
+  append_episodes(reopened, ['a'], 9)
+  reopened.seal()
+  reopened.compact()
+  expected = {'a': 9, 'b': 7, 'c': 1, 'e': 2}
+  assert stored(reopened) == expected
+  assert stored(EpisodeStore(str(tmp_path))) == expected
+
+
+def test_recovery_after_crash_during_seal(tmp_path):
+  store = EpisodeStore(str(tmp_path), segment_size=100)
+  append_episodes(store, ['a', 'b'], 1)
+  append_episodes(store, ['c'], 2)
+  # crash after the segment and the manifest were written, before the write-ahead log and the tail were reset
+  for name in ['wal.log', 'tail.f32']:
+    shutil.copy(os.path.join(str(tmp_path), name), os.path.join(str(tmp_path), name + '.bak'))
+  store.seal()
+  for name in ['wal.log', 'tail.f32']:
+    os.replace(os.path.join(str(tmp_path), name + '.bak'), os.path.join(str(tmp_path), name))
+
+  recovered = EpisodeStore(str(tmp_path), segment_size=100)
+  _, metadata_df = recovered.read_all()
+  assert list(metadata_df['id']) == ['a', 'b', 'c'] and len(recovered) == 3
+  append_episodes(recovered, ['d'], 3)
+  assert stored(EpisodeStore(str(tmp_path))) == {'a': 1, 'b': 1, 'c': 2, 'd': 3}
+
+
+def test_read_all_during_appends_and_seals(tmp_path):
+  store = EpisodeStore(str(tmp_path), segment_size=16)
+  stop, errors = threading.Event(), []
+
+  def reader():
+    while not stop.is_set():
+      try:
+        embeddings, metadata_df = store.read_all()
+        assert embeddings.shape[0] == metadata_df.shape[0]
+        # every episode is read with the embedding it was appended with
+        if embeddings.shape[0] > 0:
+          np.testing.assert_array_equal(embeddings[:, 0], [int(id) for id in metadata_df['id']])
+      except Exception as e:
+        errors.append(e)
+        return
+
+  threads = [threading.Thread(target=reader) for _ in range(2)]
+  for thread in threads:
+    thread.start()
+  try:
+    for i in range(0, 400, 5):
+      ids = [str(j) for j in range(i, i + 5)]
+      store.append(ids, np.repeat(np.arange(i, i + 5, dtype=np.float32)[:, None], 4, axis=1), [{}] * 5, [None] * 5)
+  finally:
+    stop.set()
+    for thread in threads:
+      thread.join()
+  assert not errors, errors[0]
+  assert len(store) == 400
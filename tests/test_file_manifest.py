@@ -0,0 +1,41 @@
+import os
+from utils.file_manifest import FileManifest
+from core.Memory import Memory
+from tests.synthetic import synthetic_memory_df
+
+
+def write_files(base_dir, paths):
+  for path in paths:
+    if not os.path.isdir(os.path.join(base_dir, os.path.dirname(path))):
+      os.makedirs(os.path.join(base_dir, os.path.dirname(path)))
+    with open(os.path.join(base_dir, path), 'w') as f:
+      f.write('clip')
+
+
+def test_validate_uses_the_cache(tmp_path, monkeypatch):
+  base_dir, cache_path = str(tmp_path / 'videos'), str(tmp_path / 'manifest.json')
+  paths = ['a/%i.gif' % i for i in range(10)] + ['b/%i.gif' % i for i in range(10)]
+  write_files(base_dir, paths[:-1])
+  missed = []
+  assert FileManifest(base_dir, cache_path=cache_path).validate(paths, on_missing=missed.extend) == {'b/9.gif'}
+  assert missed == ['b/9.gif'] and os.path.isfile(cache_path)
+
+  # unchanged directories are not listed again, changed ones are
+  listed = []
+  listdir = os.listdir
+  monkeypatch.setattr(os, 'listdir', lambda path: listed.append(path) or listdir(path))
+  assert FileManifest(base_dir, cache_path=cache_path).validate(paths) == {'b/9.gif'}
+  assert listed == []
+  os.remove(os.path.join(base_dir, 'a', '3.gif'))
+  os.utime(os.path.join(base_dir, 'a'), (0, 0))
+  assert FileManifest(base_dir, cache_path=cache_path).validate(paths) == {'a/3.gif', 'b/9.gif'}
+  assert listed == [os.path.join(base_dir, 'a')]
+
+
+def test_check_memory_sanity(tmp_path):
+  memory_df = synthetic_memory_df(n_episodes=300)
+  memory_df['video_file_path'] = ['clips/%s.gif' % id for id in memory_df['id']]
+  write_files(str(tmp_path), memory_df['video_file_path'][:-2])
+  memory = Memory(memory_df, str(tmp_path), check_sanity=False)
+  assert memory.check_memory_sanity(block=True, manifest_cache_path=str(tmp_path / 'manifest.json')) == 298
+  assert sorted(memory.missing_episode_ids) == list(memory_df['id'][-2:])
@@ -0,0 +1,60 @@
+import threading
+import numpy as np
+import pytest
+from core.frame_store import FrameStore
+
+
+def clip(value, n_frames=4):
+  return np.full((n_frames, 8, 8, 3), value % 251, dtype=np.uint8)
+
+
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+def test_round_trip_delete_restore_and_reopen(tmp_path, compression):
+  store = FrameStore(str(tmp_path), compression=compression, chunk_frames=2)
+  store.append(['a', 'b', 'c'], [clip(1), clip(2, n_frames=5), clip(3)])
+  assert len(store) == 3 and store.shape('b') == (5, 8, 8, 3)
+  np.testing.assert_array_equal(store.get('b'), clip(2, n_frames=5))
+  np.testing.assert_array_equal(store.get('b', slice(1, 3)), clip(2, n_frames=2))
+
+  store.delete(['b'])
+  assert 'b' not in store
+  store.append(['b'], [clip(7)])
+  np.testing.assert_array_equal(store.get('b'), clip(7))
+
+  reopened = FrameStore(str(tmp_path), compression=compression)
+  assert sorted(reopened.ids) == ['a', 'b', 'c']
+  np.testing.assert_array_equal(reopened.get('b'), clip(7))
+  reopened.delete(['a'])
+  assert reopened.compact() > 0
+  for store in [reopened, FrameStore(str(tmp_path))]:
+    assert sorted(store.ids) == ['b', 'c']
+    np.testing.assert_array_equal(store.get('b'), clip(7))
+    np.testing.assert_array_equal(store.get('c'), clip(3))
+
+
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+def test_get_during_compact(tmp_path, compression):
+  store = FrameStore(str(tmp_path), compression=compression)
+  store.append([str(i) for i in range(200)], [clip(i) for i in range(200)])
+  stop, bad_reads = threading.Event(), []
+
+  def reader(seed):
+    random_state = np.random.RandomState(seed)
+    while not stop.is_set():
+      i = random_state.randint(100, 200)
+      if not (store.get(str(i)) == i % 251).all():
+        bad_reads.append(i)
+
+  threads = [threading.Thread(target=reader, args=(seed,)) for seed in range(3)]
+  for thread in threads:
+    thread.start()
+  try:
+    for i in range(50):
+      store.delete([str(i)])
+      store.compact()
+  finally:
+    stop.set()
+    for thread in threads:
+      thread.join()
+  assert not bad_reads
+  assert len(store) == 150
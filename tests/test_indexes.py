@@ -0,0 +1,46 @@
+import copy
+import numpy as np
+from core.indexes import HNSWIndex, IVFIndex, normalize_rows, top_k_indices
+
+
+def clustered_vectors(n_vectors=2000, n_dim=32, n_clusters=40, seed=0):
+  random_state = np.random.RandomState(seed)
+  centers = random_state.randn(n_clusters, n_dim)
+  return normalize_rows(centers[random_state.randint(0, n_clusters, n_vectors)] + 0.8 * random_state.randn(n_vectors, n_dim))
+
+
+def recall(index, vectors, queries, k=10):
+  indices, _ = index.search(vectors, queries, k)
+  expected = top_k_indices(np.dot(queries, vectors.T), k)
+  return np.mean([len(np.intersect1d(a, e)) / float(k) for a, e in zip(indices, expected)])
+
+
+def test_top_k_indices_matches_argsort():
+  scores = np.random.RandomState(0).randn(50, 300)
+  for k in [1, 10, 300]:
+    np.testing.assert_array_equal(top_k_indices(scores, k), np.argsort(-scores, axis=1)[:, :k])
+
+
+def test_ivf_index_recall():
+  vectors = clustered_vectors()
+  index = IVFIndex(n_clusters=64, nprobe=8, seed=0)
+  index.train(vectors)
+  index.add(vectors, np.arange(len(vectors)))
+  assert recall(index, vectors, normalize_rows(vectors[:200] + 0.05)) >= 0.9
+
+
+def test_hnsw_index_add_keeps_old_copies():
+  vectors = clustered_vectors()
+  index = HNSWIndex(seed=0)
+  index.add(vectors, np.arange(1500))
+  queries = normalize_rows(vectors[:200] + 0.05)
+  old_indices, old_similarities = index.search(vectors[:1500], queries, 10)
+  assert recall(index, vectors[:1500], queries) >= 0.9
+
+  # a copy taken before the insert (as held by an older memory version) keeps returning the same results
+  new_index = copy.copy(index)
+  new_index.add(vectors, np.arange(1500, 2000))
+  indices, similarities = index.search(vectors[:1500], queries, 10)
+  np.testing.assert_array_equal(indices, old_indices)
+  np.testing.assert_array_equal(similarities, old_similarities)
+  assert new_index.ntotal == 2000 and recall(new_index, vectors, queries) >= 0.9
@@ -0,0 +1,232 @@
+import os, threading
+import numpy as np
+import pytest
+from core.Memory import Memory, LazyVideoEpisode
+from core.indexes import normalize_rows
+from tests.synthetic import noisy_queries
+
+
+def exact_top_k(memory_hidden_reps, queries, k):
+  similarities = np.dot(normalize_rows(queries), normalize_rows(memory_hidden_reps).T)
+  return np.argsort(-similarities, axis=1, kind='mergesort')[:, :k], similarities
+
+
+def test_match_batch_agrees_with_matching(memory, memory_df):
+  queries = noisy_queries(memory_df, n_queries=50)
+  indices, cos_distances, paths = memory.match_batch(queries, 10, batch_size=16, backend='exact')
+  expected, similarities = exact_top_k(np.stack(memory_df['hidden_repr']), queries, 10)
+  np.testing.assert_array_equal(indices, expected)
+  np.testing.assert_allclose(cos_distances, 1.0 - similarities[np.arange(50)[:, None], expected], atol=1e-5)
+  assert len(paths) == 50 and all(len(p) == 10 for p in paths)
+  for query, row_indices, row_distances in zip(queries, indices, cos_distances):
+    single_indices, single_distances, single_hidden_reps, _ = memory.matching(query, 10, backend='exact')
+    np.testing.assert_array_equal(single_indices, row_indices)
+    np.testing.assert_allclose(single_distances, row_distances, atol=1e-6)
+    np.testing.assert_array_equal(single_hidden_reps, memory.hidden_reps[row_indices])
+
+
+def test_match_batch_with_transform_agrees_with_exact_scan(memory, memory_df):
+  queries = noisy_queries(memory_df, n_queries=50)
+  indices, _, _ = memory.match_batch(queries, 10, use_transform=True, backend='exact')
+  expected, _ = exact_top_k(memory.hidden_reps_transformed, memory.inter_class_pca.transform(queries), 10)
+  np.testing.assert_array_equal(indices, expected)
+
+
+def assert_backend_recall(memory, memory_df, backend, min_recall=0.9):
+  queries = noisy_queries(memory_df)
+  assert memory.recall_at_k(queries, 10, backend=backend) >= min_recall
+
+  # episodes stored after the build are added to the index
+  new_hidden_reps = queries[:20] + 0.05
+  rows = memory.store_episodes(['new%i' % i for i in range(20)], new_hidden_reps,
+                               [{'category': c} for c in memory_df['category'][:20]])
+  indices, _, _ = memory.match_batch(new_hidden_reps, 1, backend=backend)
+  assert np.mean(indices[:, 0] == rows) >= 0.9
+
+
+def test_ivf_recall(memory, memory_df):
+  memory.build_ivf_index(nprobe=8, seed=0)
+  assert_backend_recall(memory, memory_df, 'ivf')
+  memory.build_ivf_index(use_transform=True, seed=0)
+  assert memory.recall_at_k(noisy_queries(memory_df), 10, use_transform=True, backend='ivf') >= 0.9
+
+
+def test_hnsw_recall(memory, memory_df):
+  memory.build_hnsw_index(seed=0)
+  assert_backend_recall(memory, memory_df, 'hnsw')
+
+
+def test_quantized_recall(memory, memory_df):
+  for codec, codec_kwargs in [('float16', {}), ('int8', {}), ('pq', {'n_subspaces': 16, 'seed': 0})]:
+    memory.build_quantized_index(codec, n_rerank=50, **codec_kwargs)
+    assert memory.recall_at_k(noisy_queries(memory_df), 10, backend=codec) >= 0.9
+  assert set(memory.memory_footprint()) >= {'float16_codes', 'int8_codes', 'pq_codes'}
+  assert_backend_recall(memory, memory_df, 'pq')
+
+
+def test_cascade_recall(memory, memory_df):
+  memory.build_cascade_index(n_candidates=100, n_components=20)
+  assert_backend_recall(memory, memory_df, 'cascade')
+
+
+def test_cascade_recall_on_uncentered_vectors(memory_df, tmp_path):
+  # the candidates are generated on the PCA transform of the raw vectors, not of the normalized ones
+  memory_df['hidden_repr'] = [hidden_repr + 30 for hidden_repr in memory_df['hidden_repr']]
+  memory = Memory(memory_df, str(tmp_path), check_sanity=False)
+  memory.build_cascade_index(n_candidates=100, n_components=20)
+  assert memory.recall_at_k(noisy_queries(memory_df, noise=1.0), 10, backend='cascade') >= 0.9
+
+
+def test_binary_recall(memory, memory_df):
+  memory.build_binary_index(n_bits=64, method='itq', seed=0)
+  assert memory.recall_at_k(noisy_queries(memory_df), 10, backend='binary') >= 0.9
+  memory.build_binary_index(n_bits=256, method='srp', seed=0)
+  assert_backend_recall(memory, memory_df, 'binary')
+
+
+def test_class_routing_recall(memory, memory_df):
+  memory.build_class_routing_index(n_route=3)
+  assert_backend_recall(memory, memory_df, 'class_routing')
+
+
+def test_get_episode_by_id(memory_df, tmp_path):
+  memory_df['video_file_path'] = ['clips/%s.gif' % id for id in memory_df['id']]
+  memory = Memory(memory_df, str(tmp_path), check_sanity=False)
+  episode = memory.get_episode('00042')
+  assert episode.id == '00042' and episode.metadata['category'] == memory_df['category'][42]
+  assert 'hidden_repr' not in episode.metadata
+  np.testing.assert_array_equal(episode.hidden_repr, memory_df['hidden_repr'][42])
+  # the video file is only read when the frames are accessed
+  assert episode.video_episode.video_path == os.path.join(str(tmp_path), 'clips', '00042.gif')
+  assert episode.video_episode._frames is None
+  with pytest.raises(AssertionError):
+    memory.get_episode('unknown')
+
+
+def test_lazy_video_episode_loads_once():
+  calls = []
+  video_episode = LazyVideoEpisode(None, load=lambda: calls.append(1) or np.zeros((2, 4, 4, 3), dtype=np.uint8))
+  assert not calls
+  assert video_episode.frames.shape == (2, 4, 4, 3) and video_episode.frames.shape == (2, 4, 4, 3)
+  assert len(calls) == 1
+  with pytest.raises(AssertionError): # latent-only episode without a decoder
+    LazyVideoEpisode(None).frames
+
+
+def test_filters_restrict_matches(memory, memory_df):
+  queries = noisy_queries(memory_df, n_queries=20)
+  indices, _, _ = memory.match_batch(queries, 5, filters={'category': ['c1', 'c2']})
+  assert set(memory.memory_df['category'].values[np.ravel(indices)]) == {'c1', 'c2'}
+  assert memory.match_batch(queries, 5, filters={'category': 'unknown'})[0].shape == (20, 0)
+
+
+def test_filtered_hnsw_search_falls_back_to_exact_scan(memory, memory_df, monkeypatch):
+  queries = noisy_queries(memory_df, n_queries=50)
+  filters = {'category': ['c1', 'c2']}
+  expected, expected_distances, _ = memory.match_batch(queries, 10, backend='exact', filters=filters)
+  memory.build_hnsw_index(seed=0)
+  memory.filter_exact_fraction = 0.0 # the sparse filter is answered by the index
+  indices, _, _ = memory.match_batch(queries, 10, backend='hnsw', filters=filters)
+  assert np.mean([len(np.intersect1d(a, e)) / 10.0 for a, e in zip(indices, expected)]) >= 0.9
+
+  # rows of the filter the graph search did not reach are padded with -1, these queries are scanned exactly
+  index = memory.version.indexes[('hnsw', False)]
+  search = index.search
+  def unreachable_search(*args, **kwargs):
+    indices, similarities = search(*args, **kwargs)
+    indices[::2, -3:], similarities[::2, -3:] = -1, -np.inf
+    return indices, similarities
+  monkeypatch.setattr(index, 'search', unreachable_search)
+  memory.query_cache.clear()
+  indices, cos_distances, paths = memory.match_batch(queries, 10, backend='hnsw', filters=filters)
+  assert (indices >= 0).all() and np.isfinite(cos_distances).all()
+  np.testing.assert_array_equal(indices[::2], expected[::2])
+  np.testing.assert_allclose(cos_distances[::2], expected_distances[::2], atol=1e-5)
+
+
+def test_concurrent_reads_during_stores_and_evictions(memory, memory_df):
+  memory.build_hnsw_index(seed=0)
+  memory.set_capacity(max_episodes=3000, policy='lru')
+  queries = noisy_queries(memory_df, n_queries=64)
+  stop, errors = threading.Event(), []
+
+  def reader(seed):
+    random_state = np.random.RandomState(seed)
+    while not stop.is_set():
+      try:
+        version = memory.version
+        batch = queries[random_state.randint(0, len(queries), 8)]
+        filters = {'category': ['c%i' % i for i in range(30)]} if seed % 2 else None
+        indices, cos_distances, _ = memory.match_batch(batch, 5, filters=filters, version=version)
+        ids = memory.episode_ids(indices, version)
+        # the results must be consistent with the pinned version, whatever was stored or evicted meanwhile
+        assert indices.max() < version.n_episodes
+        hidden_reps = normalize_rows(version.matrices['hidden_reps'][np.ravel(indices)]).reshape(indices.shape + (-1,))
+        np.testing.assert_allclose(1.0 - np.einsum('qd,qkd->qk', normalize_rows(batch), hidden_reps), cos_distances,
+                                   atol=1e-4)
+        assert len(ids) == len(indices)
+      except Exception as e:
+        errors.append(e)
+        return
+
+  threads = [threading.Thread(target=reader, args=(seed,)) for seed in range(4)]
+  for thread in threads:
+    thread.start()
+  try:
+    random_state = np.random.RandomState(2)
+    for i in range(10):
+      hidden_reps = np.stack(memory_df['hidden_repr'][random_state.randint(0, 3000, 50)]) + 0.1
+      memory.store_episodes(['s%i_%i' % (i, j) for j in range(50)], hidden_reps,
+                            [{'category': 'c%i' % random_state.randint(60)} for _ in range(50)])
+  finally:
+    stop.set()
+    for thread in threads:
+      thread.join()
+  assert not errors, errors[0]
+  assert memory.version.n_episodes <= 3000 and len(memory.id_to_row) == memory.version.n_episodes
+
+
+def test_backend_recall_after_evictions(memory, memory_df):
+  memory.build_hnsw_index(seed=0)
+  memory.build_ivf_index(nprobe=8, seed=0, set_default=False)
+  evicted = memory.set_capacity(max_episodes=2500, policy='lru', slack=0.0)
+  assert len(evicted) == 500 and memory.version.n_episodes == 2500
+  assert not any(id in memory.id_to_row for id in evicted)
+
+  queries = noisy_queries(memory_df)
+  expected, _ = exact_top_k(memory.hidden_reps, queries, 10)
+  for backend in ['hnsw', 'ivf']:
+    indices, _, _ = memory.match_batch(queries, 10, backend=backend)
+    assert indices.max() < 2500
+    assert np.mean([len(np.intersect1d(a, e)) / 10.0 for a, e in zip(indices, expected)]) >= 0.9
+
+
+def test_lru_evicts_episodes_that_were_not_recalled(memory, memory_df):
+  recalled, _, _ = memory.match_batch(noisy_queries(memory_df, n_queries=100), 5, backend='exact')
+  recalled_ids = set(memory.episode_ids(np.ravel(recalled)))
+  evicted = memory.set_capacity(max_episodes=1000, policy='lru', slack=0.0)
+  assert len(evicted) == 2000 and not recalled_ids & set(evicted)
+
+
+def test_reservoir_keeps_every_class(memory, memory_df):
+  memory.set_capacity(max_episodes=600, policy='reservoir', slack=0.0, seed=0)
+  counts = memory.memory_df['category'].value_counts()
+  assert memory.version.n_episodes == 600 and len(counts) == 60 and counts.max() - counts.min() <= 1
+
+
+def test_redundancy_evicts_near_duplicates_without_publishing(memory, memory_df, monkeypatch):
+  memory.set_capacity(max_episodes=3000, policy='redundancy', slack=0.0)
+  duplicated = np.arange(0, 3000, 30)
+  version_number = memory.version.number
+  searched_versions = []
+  search = memory._search
+  monkeypatch.setattr(memory, '_search', lambda *args, **kwargs: searched_versions.append(memory.version.number) or
+                                                                 search(*args, **kwargs))
+  memory.store_episodes(['dup%i' % i for i in duplicated], memory.hidden_reps[duplicated] + 1e-4,
+                        [{'category': c} for c in memory_df['category'].values[duplicated]])
+  # the redundancy scores are searched on the unpublished state of the store, readers only see its final version
+  assert searched_versions and set(searched_versions) == {version_number}
+  assert memory.version.number == version_number + 1 and memory.version.n_episodes == 3000
+  # one episode of every duplicate pair was evicted
+  for i in duplicated:
+    assert (memory_df['id'][i] in memory.id_to_row) != ('dup%i' % i in memory.id_to_row)
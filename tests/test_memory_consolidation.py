@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+from core.Memory import Memory
+from tests.synthetic import synthetic_memory_df
+
+
+def store_duplicates(memory, memory_df, rows, prefix='dup', noise=1e-4):
+  ids = ['%s%i' % (prefix, row) for row in rows]
+  stored_rows = memory.store_episodes(ids, np.stack(memory_df['hidden_repr'][rows]) + noise,
+                                      [{'category': c} for c in memory_df['category'].values[rows]])
+  return ids, stored_rows
+
+
+def test_near_duplicates_become_aliases(memory, memory_df):
+  memory.consolidation_threshold = 0.99
+  rows = np.arange(0, 300, 3)
+  ids, stored_rows = store_duplicates(memory, memory_df, rows)
+  assert memory.version.n_episodes == 3000
+  np.testing.assert_array_equal(stored_rows, rows)
+  assert all(memory.alias_of[id] == memory_df['id'][row] for id, row in zip(ids, rows))
+  assert memory.get_episode(ids[0]).id == memory_df['id'][0]
+  np.testing.assert_array_equal(memory.duplicate_counts(rows[:2]), [2, 2])
+
+  # duplicates within one store keep the first episode as representative
+  new_df = synthetic_memory_df(n_episodes=10, seed=5)
+  hidden_reps = np.vstack([np.stack(new_df['hidden_repr']), np.stack(new_df['hidden_repr']) + 1e-4])
+  stored_rows = memory.store_episodes(['a%i' % i for i in range(10)] + ['b%i' % i for i in range(10)], hidden_reps,
+                                      [{'category': c} for c in list(new_df['category']) * 2])
+  np.testing.assert_array_equal(stored_rows[10:], stored_rows[:10])
+  assert memory.version.n_episodes == 3010 and memory.alias_of['b3'] == 'a3'
+
+
+def test_consolidating_stores_enforce_the_capacity(memory, memory_df):
+  memory.consolidation_threshold = 0.99
+  memory.set_capacity(max_episodes=3000, policy='lru', slack=0.0)
+  # the store consolidates one episode and adds another one that exceeds the capacity
+  new_df = synthetic_memory_df(n_episodes=1, seed=5)
+  memory.store_episodes(['dup0', 'new'], [memory_df['hidden_repr'][0] + 1e-4, new_df['hidden_repr'][0]],
+                        [{'category': memory_df['category'][0]}, {'category': new_df['category'][0]}])
+  assert memory.version.n_episodes == 3000 and 'new' in memory.id_to_row
+
+
+def test_bulk_consolidate(memory_df, tmp_path):
+  memory_df = memory_df[:500]
+  duplicates_df = memory_df[:100].copy()
+  duplicates_df['id'] = ['dup%i' % i for i in range(100)]
+  duplicates_df['hidden_repr'] = [hidden_repr + 1e-4 for hidden_repr in duplicates_df['hidden_repr']]
+  memory = Memory(pd.concat([memory_df, duplicates_df], ignore_index=True), str(tmp_path), check_sanity=False)
+  assert memory.consolidate(threshold=0.99) == 100
+  assert memory.version.n_episodes == 500 and memory.alias_of['dup7'] == memory_df['id'][7]
+
+
+def test_aliases_survive_reload(memory_df, tmp_path):
+  store_dir = str(tmp_path / 'episodes')
+  memory = Memory.from_store(store_dir, str(tmp_path), check_sanity=False, memory_df=memory_df[:1000])
+  memory.consolidation_threshold = 0.99
+  rows = np.arange(0, 100, 2)
+  ids, _ = store_duplicates(memory, memory_df, rows)
+  reloaded = Memory.from_store(store_dir, str(tmp_path), check_sanity=False)
+  assert reloaded.alias_of == memory.alias_of and len(reloaded.alias_of) == 50
+  assert reloaded.get_episode(ids[1]).id == memory_df['id'][2]
+
+  # the aliases of an evicted representative are dropped, also if its id is stored again
+  memory.remove_rows([0])
+  memory.store_episodes([memory_df['id'][0]], [np.ones(64)], [{'category': 'c0'}])
+  reloaded = Memory.from_store(store_dir, str(tmp_path), check_sanity=False)
+  assert reloaded.alias_of == memory.alias_of and 'dup0' not in reloaded.alias_of and len(reloaded.alias_of) == 49
@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+from core.Memory import Memory, write_memory_bundle
+from core.episode_store import EpisodeStore
+from core.frame_store import FrameStore
+from tests.synthetic import noisy_queries, synthetic_memory_df
+
+
+def test_bundle_round_trip(memory, memory_df, tmp_path):
+  memory.build_hnsw_index(seed=0)
+  bundle_dir = str(tmp_path / 'bundle')
+  memory.dump_bundle(bundle_dir)
+  loaded = Memory.load(bundle_dir)
+  assert loaded.default_backend == 'hnsw' and loaded.base_dir == memory.base_dir
+  assert list(loaded.memory_df['id']) == list(memory_df['id'])
+  for name in ['hidden_reps', 'hidden_reps_normed', 'hidden_reps_transformed', 'hidden_reps_transformed_normed']:
+    np.testing.assert_array_equal(getattr(loaded, name), getattr(memory, name).astype(np.float32))
+
+  queries = noisy_queries(memory_df, n_queries=20)
+  for backend in ['exact', 'hnsw']:
+    np.testing.assert_array_equal(loaded.match_batch(queries, 5, backend=backend)[0],
+                                  memory.match_batch(queries, 5, backend=backend)[0])
+
+  # the memory mapped matrices are read-only, stored episodes are appended to copies
+  rows = loaded.store_episodes(['new'], queries[:1], [{'category': 'c0'}])
+  assert loaded.matching(queries[0], 1)[0][0] == rows[0]
+
+
+def test_write_memory_bundle(memory_df, tmp_path):
+  memory_df.to_pickle(str(tmp_path / 'memory.pickle'))
+  memory = write_memory_bundle(str(tmp_path / 'memory.pickle'), str(tmp_path / 'bundle'), base_dir=str(tmp_path))
+  loaded = Memory.load(str(tmp_path / 'bundle'), mmap_mode=None)
+  assert loaded.default_backend == 'exact'
+  queries = noisy_queries(memory_df, n_queries=20)
+  np.testing.assert_array_equal(loaded.match_batch(queries, 5)[0], memory.match_batch(queries, 5)[0])
+
+
+def test_store_round_trip(memory_df, tmp_path):
+  store_dir = str(tmp_path / 'episodes')
+  memory = Memory.from_store(store_dir, str(tmp_path), check_sanity=False, memory_df=memory_df[:1000])
+  queries = noisy_queries(memory_df, n_queries=50)
+  rows = memory.store_episodes(['new%i' % i for i in range(50)], queries, [{'category': 'c0', 'source': 'test'}] * 50)
+  memory.episode_store.seal()
+  memory.store_episodes(['last'], [np.ones(64)], [{'category': 'c1'}])
+
+  reloaded = Memory.from_store(store_dir, str(tmp_path), check_sanity=False)
+  assert list(reloaded.memory_df['id']) == list(memory.memory_df['id'])
+  np.testing.assert_allclose(reloaded.hidden_reps, memory.hidden_reps, rtol=1e-6)
+  assert reloaded.get_episode('new3').metadata['source'] == 'test'
+  np.testing.assert_array_equal(reloaded.match_batch(queries, 5)[0], memory.match_batch(queries, 5)[0])
+  assert list(reloaded.match_batch(queries, 1)[0][:, 0]) == list(rows)
+
+
+def test_attach_store_persists_existing_episodes(memory, tmp_path):
+  store_dir = str(tmp_path / 'episodes')
+  memory.attach_store(EpisodeStore(store_dir))
+  memory.store_episodes(['new'], [np.ones(64)], [{'category': 'c0'}])
+  reloaded = Memory.from_store(store_dir, str(tmp_path), check_sanity=False)
+  assert reloaded.version.n_episodes == memory.version.n_episodes == 3001
+  np.testing.assert_allclose(reloaded.hidden_reps, memory.hidden_reps, rtol=1e-6)
+
+  with pytest.raises(AssertionError):
+    memory.attach_store(EpisodeStore(store_dir))
+  with pytest.raises(AssertionError):
+    Memory.from_store(str(tmp_path / 'empty'), str(tmp_path), check_sanity=False)
+
+
+def test_store_evict_reload_round_trip(memory_df, tmp_path):
+  store_dir, frames_dir = str(tmp_path / 'episodes'), str(tmp_path / 'frames')
+  initial_df = memory_df[:1000]
+  memory = Memory.from_store(store_dir, str(tmp_path), check_sanity=False, memory_df=initial_df)
+  frame_store = FrameStore(frames_dir)
+  frame_store.append(list(initial_df['id']), np.zeros((1000, 2, 4, 4, 3), dtype=np.uint8))
+  memory.attach_frame_store(frame_store)
+
+  new_df = synthetic_memory_df(n_episodes=500, seed=3)
+  new_df['id'] = ['new%i' % i for i in range(500)]
+  memory.store_episodes(list(new_df['id']), list(new_df['hidden_repr']), [{'category': c} for c in new_df['category']])
+  frame_store.append(list(new_df['id']), np.ones((500, 2, 4, 4, 3), dtype=np.uint8))
+  evicted = memory.set_capacity(max_episodes=1200, policy='lru', slack=0.0)
+  assert len(evicted) == 300 and memory.version.n_episodes == 1200
+  assert not any(id in frame_store for id in evicted)
+
+  # an evicted episode that is stored again must survive the reload
+  restored_id = evicted[0]
+  restored_hidden_repr = np.full(64, 0.5)
+  memory.store_episodes([restored_id], [restored_hidden_repr], [{'category': 'c0'}])
+  frame_store.append([restored_id], np.full((1, 2, 4, 4, 3), 7, dtype=np.uint8))
+  memory.episode_store.seal()
+  memory.episode_store.compact()
+
+  reloaded = Memory.from_store(store_dir, str(tmp_path), check_sanity=False)
+  reloaded_frames = FrameStore(frames_dir)
+  reloaded.attach_frame_store(reloaded_frames)
+  assert sorted(reloaded.id_to_row) == sorted(memory.id_to_row)
+  assert sorted(reloaded_frames.ids) == sorted(memory.id_to_row)
+  for id in list(memory.id_to_row)[::50] + [restored_id]:
+    np.testing.assert_allclose(reloaded.get_episode(id).hidden_repr, memory.get_episode(id).hidden_repr, rtol=1e-6)
+  np.testing.assert_allclose(reloaded.get_episode(restored_id).hidden_repr, restored_hidden_repr, rtol=1e-6)
+  assert (reloaded.stored_frames([restored_id])[0] == 7).all()
+
@@ -0,0 +1,101 @@
+import asyncio, time
+import numpy as np
+from core.memory_service import MemoryServer, MemoryClient, ServiceError, encode_message, decode_message, HEADER, \
+  MAX_MESSAGE_SIZE
+from tests.synthetic import noisy_queries
+
+
+def test_encode_decode_round_trip():
+  message = {'id': 3, 'op': 'store', 'ids': ['a'], 'hidden_reps': np.arange(6, dtype=np.float32).reshape(2, 3),
+             'metadata': [{'category': 'c0'}], 'deadline': None}
+  decoded = decode_message(encode_message(message)[4:])
+  np.testing.assert_array_equal(decoded.pop('hidden_reps'), message.pop('hidden_reps'))
+  assert decoded == message
+
+
+def run_with_server(memory, client_fn):
+  async def main():
+    server = MemoryServer(memory)
+    host, port = (await server.start(port=0))[:2]
+    client = await MemoryClient().connect(host=host, port=port)
+    try:
+      return await client_fn(client)
+    finally:
+      await client.close()
+      await server.close()
+  return asyncio.run(main())
+
+
+def test_match_and_store_round_trip(memory, memory_df):
+  queries = noisy_queries(memory_df, n_queries=20)
+  expected, _, _ = memory.match_batch(queries, 5, backend='exact')
+
+  async def client_fn(client):
+    # concurrent matches are coalesced into batches on the server
+    results = await asyncio.gather(*[client.match(query, 5, deadline=5.0) for query in queries])
+    stored = await client.store_episodes(['new'], queries[:1], [{'category': 'c0'}], deadline=5.0)
+    episode = await client.get_episode('new')
+    stats = await client.stats()
+    return results, stored, episode, stats
+
+  results, stored, episode, stats = run_with_server(memory, client_fn)
+  for result, expected_indices in zip(results, expected):
+    assert list(result['ids']) == list(memory.episode_ids(expected_indices))
+  assert list(stored['rows']) == [memory.id_to_row['new']]
+  np.testing.assert_allclose(episode['hidden_repr'], queries[0], rtol=1e-6)
+  assert stats['memory']['n_episodes'] == 3001 and stats['service']['deadline_exceeded'] == 0
+
+
+def test_deadlines(memory, memory_df, monkeypatch):
+  store_episodes = memory.store_episodes
+
+  def slow_store_episodes(*args, **kwargs):
+    time.sleep(0.3)
+    return store_episodes(*args, **kwargs)
+  monkeypatch.setattr(memory, 'store_episodes', slow_store_episodes)
+  hidden_reps = noisy_queries(memory_df, n_queries=2)
+
+  async def client_fn(client):
+    # the first store starts right away and is completed although it takes longer than its deadline, the second one
+    # waits for the writer thread past its deadline and is rejected without being applied
+    first = asyncio.ensure_future(client.store_episodes(['a'], hidden_reps[:1], [{'category': 'c0'}], deadline=0.1))
+    second = asyncio.ensure_future(client.store_episodes(['b'], hidden_reps[1:], [{'category': 'c0'}], deadline=0.1))
+    results = []
+    for future in [first, second]:
+      try:
+        results.append(await future)
+      except ServiceError as e:
+        results.append(e)
+    results.append(await client.match(hidden_reps[0], 1, deadline=5.0))
+    return results
+
+  first, second, match = run_with_server(memory, client_fn)
+  assert list(first['rows']) == [memory.id_to_row['a']]
+  assert isinstance(second, ServiceError) and 'deadline exceeded' in str(second)
+  assert 'b' not in memory.id_to_row
+  assert list(match['ids']) == ['a']
+
+
+def test_bad_messages_do_not_leak_capacity(memory, memory_df):
+  query = noisy_queries(memory_df, n_queries=1)[0]
+
+  async def main():
+    server = MemoryServer(memory, max_pending=2)
+    host, port = await server.start(port=0)
+    try:
+      # more bad connections than max_pending, each one is closed by the server and returns its permit
+      for data in [HEADER.pack(8) + b'not json', HEADER.pack(2) + b'[]', HEADER.pack(MAX_MESSAGE_SIZE + 1)] * 2:
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write(data)
+        assert await asyncio.wait_for(reader.read(), 5.0) == b''
+        writer.close()
+      client = await MemoryClient().connect(host=host, port=port)
+      result = await client.match(query, 1, deadline=5.0)
+      await client.close()
+      return result, server.stats['errors']
+    finally:
+      await server.close()
+
+  result, n_errors = asyncio.run(main())
+  assert list(result['ids']) == list(memory.episode_ids(memory.match_batch([query], 1, backend='exact')[0][0]))
+  assert n_errors == 6
@@ -0,0 +1,44 @@
+import numpy as np
+from core.indexes import IVFIndex
+from tests.synthetic import noisy_queries
+
+
+def new_class_episodes(n_episodes=500, n_dim=64, seed=5):
+  random_state = np.random.RandomState(seed)
+  return random_state.randn(n_dim) * 3 + 0.8 * random_state.randn(n_episodes, n_dim)
+
+
+def test_inter_class_pca_is_fixed_by_default(memory):
+  inter_class_pca = memory.inter_class_pca
+  memory.store_episodes(['n%i' % i for i in range(500)], new_class_episodes(), [{'category': 'new'}] * 500)
+  memory.reproject()
+  assert memory.inter_class_pca is inter_class_pca
+  np.testing.assert_allclose(memory.hidden_reps_transformed, inter_class_pca.transform(memory.hidden_reps), atol=1e-6)
+
+
+def test_incremental_inter_class_pca(memory, memory_df):
+  memory.pca_update_threshold = 0.0
+  memory.reproject_batch_size = 1000
+  memory.build_quantized_index('int8', use_transform=True, set_default=False)
+  # an index on the transformed vectors without a builder can not follow the new PCA
+  index = IVFIndex(n_clusters=16, seed=0)
+  index.train(memory.hidden_reps_transformed_normed)
+  index.add(memory.hidden_reps_transformed_normed, np.arange(3000))
+  memory.add_index(index, use_transform=True, set_default=False)
+  inter_class_pca = memory.inter_class_pca
+
+  hidden_reps = new_class_episodes()
+  memory.store_episodes(['n%i' % i for i in range(500)], hidden_reps, [{'category': 'new'}] * 500)
+  # the class statistics are kept in O(n_new) per store
+  labels = np.concatenate([memory_df['category'], ['new'] * 500])
+  for label in ['c3', 'new']:
+    np.testing.assert_allclose(memory.class_sums[label], memory.hidden_reps[labels == label].sum(axis=0), rtol=1e-6)
+    assert memory.class_counts[label] == np.count_nonzero(labels == label)
+
+  memory.reproject()
+  assert memory.inter_class_pca is not inter_class_pca
+  np.testing.assert_allclose(memory.hidden_reps_transformed, memory.inter_class_pca.transform(memory.hidden_reps),
+                             atol=1e-5)
+  assert ('ivf', True) not in memory.indexes
+  queries = np.vstack([noisy_queries(memory_df, n_queries=50), hidden_reps[:50] + 0.1])
+  assert memory.recall_at_k(queries, 10, use_transform=True, backend='int8') >= 0.9
@@ -0,0 +1,65 @@
+import copy
+import numpy as np
+import pytest
+from core.Memory import Memory
+from core.online_classifier import NearestClassMeanClassifier, SGDLogisticClassifier
+from tests.synthetic import noisy_queries
+
+
+def accuracy(classifier, hidden_reps, labels):
+  return np.mean(classifier.classes_[np.argmax(classifier.predict_proba(hidden_reps), axis=1)] == labels)
+
+
+def test_ncm_updates_match_a_batch_fit(memory_df):
+  hidden_reps, labels = np.stack(memory_df['hidden_repr']), memory_df['category'].values
+  batch = NearestClassMeanClassifier().partial_fit(hidden_reps[:2000], labels[:2000])
+  online = NearestClassMeanClassifier()
+  for start in range(0, 3000, 700):
+    online.partial_fit(hidden_reps[start:start + 700], labels[start:start + 700])
+  old = copy.copy(online)
+  online.remove(hidden_reps[2000:], labels[2000:])
+  batch_probs = batch.predict_proba(hidden_reps[:50])
+  online_probs = online.predict_proba(hidden_reps[:50])[:, [list(online.classes_).index(c) for c in batch.classes_]]
+  np.testing.assert_allclose(online_probs, batch_probs, atol=1e-5)
+  # a copy taken before the update keeps the old state
+  assert old.class_counts.sum() == 3000 and online.class_counts.sum() == 2000
+  assert accuracy(online, noisy_queries(memory_df), labels[:200]) >= 0.9
+
+
+def test_sgd_learns_new_classes_without_retrain(memory_df):
+  hidden_reps, labels = np.stack(memory_df['hidden_repr']), memory_df['category'].values
+  old_classes = np.isin(labels, ['c%i' % i for i in range(30)])
+  classifier = SGDLogisticClassifier(n_iter=20, seed=0).partial_fit(hidden_reps[old_classes], labels[old_classes])
+  assert len(classifier.classes_) == 30
+  for _ in range(20):
+    classifier.partial_fit(hidden_reps[~old_classes], labels[~old_classes])
+  assert len(classifier.classes_) == 60 and classifier.coef_.shape == (60, 64)
+  assert accuracy(classifier, hidden_reps[~old_classes], labels[~old_classes]) >= 0.8
+
+
+def test_memory_keeps_the_classifier_up_to_date(memory, memory_df, tmp_path):
+  classifier = memory.enable_online_classifier('ncm')
+  queries = noisy_queries(memory_df, n_queries=20)
+  indices, _, _ = memory.composite_match_batch(queries, n_closest_matches=5)
+  np.testing.assert_array_equal(indices, memory.composite_match_batch(queries, classifier, n_closest_matches=5)[0])
+
+  # stores add new classes, the published versions keep their classifier
+  old_version = memory.version
+  memory.store_episodes(['new%i' % i for i in range(5)], queries[:5] * -1, [{'category': 'new_class'}] * 5)
+  assert 'new_class' in memory.version.classifier.classes_ and 'new_class' not in old_version.classifier.classes_
+  probs = memory.version.classifier.predict_proba(-queries[:5])
+  assert (memory.version.classifier.classes_[np.argmax(probs, axis=1)] == 'new_class').all()
+
+  # evictions remove the episodes from the class means
+  memory.remove_rows([memory.id_to_row['new%i' % i] for i in range(5)])
+  new_class = list(memory.version.classifier.classes_).index('new_class')
+  assert memory.version.classifier.class_counts[new_class] == 0
+  assert memory.version.classifier.predict_proba(-queries[:1])[0, new_class] == 0
+
+  memory.dump_bundle(str(tmp_path / 'bundle'))
+  loaded = Memory.load(str(tmp_path / 'bundle'))
+  np.testing.assert_allclose(loaded.version.classifier.predict_proba(queries),
+                             memory.version.classifier.predict_proba(queries), atol=1e-6)
+  memory.disable_online_classifier()
+  with pytest.raises(AssertionError):
+    memory.composite_match_batch(queries)
@@ -0,0 +1,40 @@
+import time
+import numpy as np
+from core.query_cache import QueryCache
+from core.indexes import normalize_rows
+from tests.synthetic import noisy_queries
+
+
+def test_lru_eviction_and_expiry():
+  cache = QueryCache(max_size=2, ttl=0.05)
+  queries = normalize_rows(np.random.RandomState(0).randn(3, 8))
+  keys = [cache.key(query, 5, False) for query in queries]
+  assert cache.key(queries[0] + 1e-5, 5, False) == keys[0] # near-identical queries share an entry
+  assert cache.key(queries[0], 10, False) != keys[0]
+  cache.put(keys[0], 'a')
+  cache.put(keys[1], 'b')
+  assert cache.get(keys[0]) == 'a' # keys[1] is now the least recently used entry
+  cache.put(keys[2], 'c')
+  assert cache.get(keys[1]) is None and cache.get(keys[2]) == 'c'
+  time.sleep(0.1)
+  assert cache.get(keys[0]) is None
+  stats = cache.stats()
+  assert (stats['hits'], stats['misses'], stats['evictions'], stats['expirations']) == (2, 2, 1, 1)
+
+
+def test_memory_caches_match_results(memory, memory_df):
+  queries = noisy_queries(memory_df, n_queries=20)
+  expected = memory.match_batch(queries, 5, backend='exact')
+  assert memory.query_cache.stats()['misses'] == 20
+  # a batch with cached and new queries, the results agree with the uncached search
+  indices, cos_distances, _ = memory.match_batch(np.vstack([queries[10:], queries[:10] + 1e-5, queries[:5] + 0.3]), 5,
+                                                 backend='exact')
+  assert memory.query_cache.stats()['hits'] == 20
+  np.testing.assert_array_equal(indices[:20], np.vstack([expected[0][10:], expected[0][:10]]))
+  np.testing.assert_allclose(cos_distances[:10], expected[1][10:])
+
+  # stored episodes invalidate the cache
+  memory.store_episodes(['new'], queries[:1], [{'category': memory_df['category'][0]}])
+  assert len(memory.query_cache) == 0
+  indices, _, _ = memory.match_batch(queries[:1], 1, backend='exact')
+  assert indices[0, 0] == memory.id_to_row['new']
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+from core.indexes import normalize_rows
+from tests.synthetic import noisy_queries
+
+
+def expected_within(memory, query, radius, mask=None):
+  distances = 1.0 - np.dot(memory.hidden_reps_normed, normalize_rows(query[None])[0])
+  within = distances <= radius if mask is None else (distances <= radius) & mask
+  return set(np.flatnonzero(within))
+
+
+@pytest.mark.parametrize('block_bound_index', [False, True])
+def test_radius_search_agrees_with_exact_scan(memory, memory_df, block_bound_index):
+  if block_bound_index:
+    memory.build_block_bound_index(block_size=64, seed=0)
+  categories = memory_df['category'].values
+  for query in noisy_queries(memory_df, n_queries=20):
+    for radius in [0.05, 0.3]:
+      rows, distances = memory.radius_search(query, radius)
+      assert set(rows) == expected_within(memory, query, radius)
+      assert (np.diff(distances) >= 0).all() and (distances <= radius + 1e-6).all()
+      assert memory.any_within(query, radius) == (len(rows) > 0)
+    rows, _ = memory.radius_search(query, 0.3, filters={'category': ['c1', 'c2']})
+    assert set(rows) == expected_within(memory, query, 0.3, np.isin(categories, ['c1', 'c2']))
+  assert not memory.any_within(-memory.hidden_reps[0], 0.01)
+
+
+def test_block_bound_index_gives_exact_top_k(memory, memory_df):
+  memory.build_block_bound_index(block_size=64, seed=0)
+  queries = noisy_queries(memory_df, n_queries=50)
+  indices, cos_distances, _ = memory.match_batch(queries, 10, backend='block_bounds')
+  expected, expected_distances, _ = memory.match_batch(queries, 10, backend='exact')
+  np.testing.assert_array_equal(indices, expected)
+  np.testing.assert_allclose(cos_distances, expected_distances, atol=1e-5)
@@ -0,0 +1,64 @@
+import threading
+import numpy as np
+from core.frame_store import FrameStore
+
+
+def id_clip(i):
+  ''' clip that encodes the number of its episode '''
+  clip = np.zeros((1, 4, 4, 3), dtype=np.uint8)
+  clip[0, 0, 0, :2] = divmod(i, 256)
+  return clip
+
+
+class TableEncoder:
+  ''' maps the clip of episode i to new_hidden_reps[i], optionally waits for an event before the first batch '''
+
+  def __init__(self, new_hidden_reps, wait_for=None):
+    self.new_hidden_reps = new_hidden_reps
+    self.wait_for = wait_for
+    self.n_encoded = 0
+
+  def encode(self, clips):
+    if self.wait_for is not None:
+      self.wait_for.wait(10.0)
+    self.n_encoded += len(clips)
+    return self.new_hidden_reps[[256 * int(clip[0, 0, 0, 0]) + int(clip[0, 0, 0, 1]) for clip in clips]]
+
+
+def test_reembedding_swaps_in_new_embeddings(memory, tmp_path):
+  frame_store = FrameStore(str(tmp_path / 'frames'))
+  # the episodes 0-9 have no frames and are removed by the swap
+  frame_store.append(list(memory.version.columns['ids'][10:]), [id_clip(i) for i in range(10, 3000)])
+  memory.attach_frame_store(frame_store)
+  new_hidden_reps = np.random.RandomState(3).randn(3000, 32).astype(np.float32)
+  old_version = memory.version
+
+  job = memory.start_reembedding(TableEncoder(new_hidden_reps), 'v2', batch_size=100, block=True)
+  assert job.progress()['status'] == 'done' and job.progress()['failed'] == 10
+  assert sorted(job.removed_ids) == sorted(old_version.columns['ids'][:10])
+  assert memory.version.n_episodes == 2990 and memory.model_fingerprint == 'v2' and memory.stale_ids() == []
+  np.testing.assert_allclose(memory.hidden_reps, new_hidden_reps[10:], rtol=1e-6)
+  indices, _, _ = memory.match_batch(new_hidden_reps[10:20], 1, backend='exact')
+  np.testing.assert_array_equal(indices[:, 0], np.arange(10))
+  # the old version is unchanged
+  assert old_version.n_episodes == 3000 and old_version.matrices['hidden_reps'].shape[1] == 64
+
+
+def test_episodes_stored_during_reembedding_are_reembedded(memory, tmp_path):
+  frame_store = FrameStore(str(tmp_path / 'frames'))
+  frame_store.append(list(memory.version.columns['ids']), [id_clip(i) for i in range(3000)])
+  memory.attach_frame_store(frame_store)
+  new_hidden_reps = np.random.RandomState(3).randn(3100, 32).astype(np.float32)
+  started = threading.Event()
+  job = memory.start_reembedding(TableEncoder(new_hidden_reps, wait_for=started), 'v2', batch_size=500)
+
+  # stores and queries keep using the old vector space while the job runs
+  ids = ['new%i' % i for i in range(100)]
+  rows = memory.store_episodes(ids, np.random.RandomState(4).randn(100, 64), [{'category': 'c0'}] * 100)
+  frame_store.append(ids, [id_clip(i) for i in range(3000, 3100)])
+  assert memory.matching(memory.hidden_reps[rows[0]], 1, backend='exact')[0][0] == rows[0]
+  started.set()
+  job.join()
+  assert job.progress()['status'] == 'done' and job.progress()['encoded'] == 3100
+  assert memory.version.n_episodes == 3100 and memory.stale_ids() == []
+  np.testing.assert_allclose(memory.get_episode('new7').hidden_repr, new_hidden_reps[3007], rtol=1e-6)
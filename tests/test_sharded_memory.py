@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+from core.sharded_memory import ShardedMemory, PARTITIONS
+from tests.synthetic import noisy_queries
+
+
+@pytest.mark.parametrize('partition', PARTITIONS)
+def test_sharded_match_batch_agrees_with_memory(memory, memory_df, partition):
+  queries = noisy_queries(memory_df, n_queries=50)
+  categories = list(memory_df['category'].unique()[:3])
+  memory.build_ivf_index(seed=0)
+  with ShardedMemory(memory, n_shards=3, partition=partition) as sharded_memory:
+    for use_transform, filters in [(False, None), (True, None), (False, {'category': categories})]:
+      expected = memory.match_batch(queries, 10, use_transform=use_transform, backend='exact', filters=filters)
+      indices, cos_distances, paths = sharded_memory.match_batch(queries, 10, use_transform=use_transform, filters=filters)
+      np.testing.assert_array_equal(indices, expected[0])
+      np.testing.assert_allclose(cos_distances, expected[1], atol=1e-5)
+      assert paths == expected[2]
+    single_indices, _, _, _ = sharded_memory.matching(queries[0], 10, filters={'category': categories})
+    np.testing.assert_array_equal(single_indices, expected[0][0])
+
+    # other backends are searched on the memory version of the shards
+    indices, _, _ = sharded_memory.match_batch(queries, 10, backend='ivf')
+    np.testing.assert_array_equal(indices, memory.match_batch(queries, 10, backend='ivf')[0])
+    assert sharded_memory.match_batch(queries, 10, filters={'category': 'unknown'})[0].shape == (50, 0)
@@ -0,0 +1,106 @@
+import os, json, hashlib, threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'deep_episodic_memory')
+
+
+class FileManifest:
+
+  def __init__(self, base_dir, cache_path=None, n_threads=16):
+    ''' Cached manifest of the files below base_dir. For every directory it stores the directory mtime and path,
+    size and mtime of the files looked up in it. Validation only lists directories whose mtime changed since the
+    cache was written (creating, deleting or renaming a file changes the mtime of its directory), the directories
+    are stat'ed and listed in parallel by a thread pool
+    :param base_dir: directory the validated paths are relative to
+    :param cache_path: (optional) path of the json cache, defaults to a file per base_dir in ~/.cache
+    :param n_threads: number of threads that stat / list directories concurrently
+    '''
+    self.base_dir = os.path.abspath(base_dir)
+    if cache_path is None:
+      cache_path = os.path.join(DEFAULT_CACHE_DIR,
+                                'manifest_%s.json' % hashlib.sha1(self.base_dir.encode('utf-8')).hexdigest())
+    self.cache_path = cache_path
+    self.n_threads = n_threads
+    self.lock = threading.Lock()
+    self.dirs = {}
+    if os.path.isfile(cache_path):
+      try:
+        with open(cache_path, 'r') as f:
+          cache = json.load(f)
+        if cache.get('base_dir') == self.base_dir:
+          self.dirs = cache['dirs']
+      except ValueError: # corrupted cache, is rebuilt
+        pass
+
+  def _validate_dir(self, dir_path, file_names):
+    '''
+    :return: dict with the entries of the files of file_names that exist in dir_path, name -> [size, mtime]
+    '''
+    abs_dir = os.path.join(self.base_dir, dir_path)
+    try:
+      dir_mtime = os.stat(abs_dir).st_mtime
+    except OSError:
+      return {'mtime': None, 'files': {}}
+
+    with self.lock:
+      cached = self.dirs.get(dir_path)
+    if cached is not None and cached['mtime'] == dir_mtime and all(name in cached['files'] for name in file_names):
+      return cached
+    if cached is not None and cached['mtime'] == dir_mtime:
+      files = dict(cached['files']) # same directory content, only files that were not looked up before are stat'ed
+      names_to_stat = [name for name in file_names if name not in files]
+    else:
+      files, names_to_stat = {}, file_names
+
+    existing_names = set(os.listdir(abs_dir))
+    for name in names_to_stat:
+      if name in existing_names:
+        stat = os.stat(os.path.join(abs_dir, name))
+        files[name] = [stat.st_size, stat.st_mtime]
+      else:
+        files[name] = None
+    return {'mtime': dir_mtime, 'files': files}
+
+  def validate(self, paths, on_missing=None):
+    '''
+    checks which of the paths exist, directory by directory in parallel, and updates the cache
+    :param paths: file paths relative to base_dir
+    :param on_missing: (optional) callback that is called with the list of missing paths of a directory as soon as
+    that directory is validated
+    :return: set of the missing paths
+    '''
+    paths_by_dir = {}
+    for path in paths:
+      dir_path, name = os.path.split(os.path.normpath(path))
+      paths_by_dir.setdefault(dir_path, {})[name] = path
+
+    missing = set()
+    with ThreadPoolExecutor(max_workers=self.n_threads) as executor:
+      futures = {executor.submit(self._validate_dir, dir_path, list(names)): dir_path
+                 for dir_path, names in paths_by_dir.items()}
+      for future in as_completed(futures):
+        dir_path = futures[future]
+        entry = future.result()
+        with self.lock:
+          if entry['mtime'] is not None:
+            self.dirs[dir_path] = entry
+          else:
+            self.dirs.pop(dir_path, None)
+        dir_missing = [path for name, path in paths_by_dir[dir_path].items() if entry['files'].get(name) is None]
+        missing.update(dir_missing)
+        if dir_missing and on_missing is not None:
+          on_missing(dir_missing)
+    self.save()
+    return missing
+
+  def save(self):
+    ''' writes the cache atomically '''
+    cache_dir = os.path.dirname(self.cache_path)
+    if cache_dir and not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+    with self.lock:
+      cache = {'base_dir': self.base_dir, 'dirs': self.dirs}
+      tmp_path = self.cache_path + '.tmp'
+      with open(tmp_path, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, self.cache_path)
@@ -1,4 +1,4 @@
-import os, re, math
+import os, re, math, glob, hashlib
 from tensorflow.python.client import device_lib
 
 def get_iter_from_pretrained_model(checkpoint_file_name):
@@ -12,6 +12,38 @@ def get_iter_from_pretrained_model(checkpoint_file_name):
   return int(idx)
 
 
+def latest_checkpoint_path(pretrained_model):
+  ''' resolves the checkpoint that is restored for FLAGS.pretrained_model (see Initializer.start_saver)
+  :param pretrained_model: checkpoint directory (with a 'checkpoint' state file) or checkpoint path prefix
+  :return: checkpoint path prefix, e.g. <dir>/model.ckpt-30000
+  '''
+  if not os.path.isdir(pretrained_model):
+    return pretrained_model
+  with open(os.path.join(pretrained_model, 'checkpoint'), 'r') as f:
+    checkpoint_path = re.findall(r'^model_checkpoint_path:\s*"(.*)"', f.read(), re.MULTILINE)[0]
+  return checkpoint_path if os.path.isabs(checkpoint_path) else os.path.join(pretrained_model, checkpoint_path)
+
+
+def checkpoint_fingerprint(pretrained_model):
+  ''' fingerprint of the checkpoint that produced hidden representations, memories are stamped with it so that
+  episodes of another checkpoint can be detected (see Memory.stale_ids)
+  :param pretrained_model: checkpoint directory or checkpoint path prefix
+  :return: string '<checkpoint name>:<hash>', the hash covers the names and sizes of the checkpoint files and the
+           content of the .index file (which holds the checksums of all tensors)
+  '''
+  checkpoint_path = latest_checkpoint_path(pretrained_model)
+  # model.ckpt-300* would also match the files of model.ckpt-3000
+  file_paths = sorted(p for p in glob.glob(checkpoint_path + '*') if p == checkpoint_path or p.startswith(checkpoint_path + '.'))
+  assert file_paths, 'no checkpoint files found for ' + str(checkpoint_path)
+  digest = hashlib.sha1()
+  for file_path in file_paths:
+    digest.update(('%s:%i;' % (os.path.basename(file_path), os.path.getsize(file_path))).encode('utf-8'))
+    if file_path.endswith('.index'):
+      with open(file_path, 'rb') as f:
+        digest.update(f.read())
+  return '%s:%s' % (os.path.basename(checkpoint_path), digest.hexdigest()[:16])
+
+
 def learning_rate_decay(initial_learning_rate, itr, decay_factor=0.0):
   return initial_learning_rate * math.e**(- decay_factor * itr)
 
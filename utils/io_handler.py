@@ -218,7 +218,8 @@ def store_dataframe(dataframe, output_dir, file_name):
   print("Dumped df pickle to ", full_path)
 
 
-def store_latent_vectors_as_df(output_dir, hidden_representations, labels, metadata, video_file_paths=None, filename=None):
+def store_latent_vectors_as_df(output_dir, hidden_representations, labels, metadata, video_file_paths=None, filename=None,
+                               model_fingerprint=None):
   """" exports the latent representation of the last encoder layer (possibly activations of fc layer if fc-flag activated)
   and the video metadata as a pandas dataframe in python3 pickle format
 
@@ -228,6 +229,8 @@ def store_latent_vectors_as_df(output_dir, hidden_representations, labels, metad
   :param shapes: the corresponding shape of the object in the video
   :param video_file_paths: path to videos (episodes) corresponding to memory instance
   :param filename: name of the pickle file - if not provided, a filename is created automatically
+  :param model_fingerprint: (optional) fingerprint of the checkpoint that produced the hidden representations
+                            (see helpers.checkpoint_fingerprint), stored in a 'model_fingerprint' column
 
   Example shape of stored objects if no fc layer used
   (each ndarray)
@@ -254,6 +257,9 @@ def store_latent_vectors_as_df(output_dir, hidden_representations, labels, metad
   if 'label_x' in df.columns:
     df = df.drop_duplicates('label_x')
 
+  if model_fingerprint is not None:
+    df['model_fingerprint'] = model_fingerprint
+
   if not filename:
     filename = os.path.join(output_dir, 'metadata_and_hidden_rep_df_' + str(dt.datetime.now().strftime("%m-%d-%y_%H-%M-%S")) +'.pickle')
   print("exported df has shape:", df.shape)
@@ -463,6 +469,17 @@ def convert_gif_to_frames(gif_file_path):
   clip.write_images_sequence(os.path.join(new_dir, 'generated_clip_frame%03d.png'))
 
 
+def load_video_frames(video_path, image_type='.png'):
+  """ loads the frames of an episode, either from a video/gif file or from a directory with one image per frame
+  :return: ndarray of shape (n_frames, height, width, 3) with dtype uint8
+  """
+  if os.path.isdir(video_path):
+    file_names = sorted((os.path.join(video_path, fn) for fn in os.listdir(video_path) if fn.endswith(image_type)))
+    return np.stack([np.asarray(Image.open(fn).convert('RGB'), np.uint8) for fn in file_names])
+  clip = mpy.VideoFileClip(video_path)
+  return np.stack([frame.astype(np.uint8) for frame in clip.iter_frames()])
+
+
 def frames_to_gif_in_dir_tree(root_dir):
   subdirs = get_subdirectory_files(root_dir, depth=2)
   for subdir in subdirs: